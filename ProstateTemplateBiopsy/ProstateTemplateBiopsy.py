@@ -15,6 +15,7 @@ import vtk, qt, ctk, slicer, ast
 from slicer.ScriptedLoadableModule import *
 import time
 import glob
+import gzip
 import datetime
 import os
 import re
@@ -22,13 +23,17 @@ import math
 import ast
 import numpy as np
 import configparser
-
-# To draw synthetic fiducials for fiducial image repair
-try:
-  from skimage.draw import line_nd
-except:
-  slicer.util.pip_install('scikit-image')
-  from skimage.draw import line_nd
+import json
+import hashlib
+import queue
+import sqlite3
+import threading
+import pydicom
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import dataclasses
+from dataclasses import dataclass
+
+from scipy import ndimage
 
 from SlicerDevelopmentToolboxUtils.constants import DICOMTAGS, STYLE
 from SlicerDevelopmentToolboxUtils.exceptions import DICOMValueError, UnknownSeriesError
@@ -38,6 +43,12 @@ from DICOMLib import DICOMUtils
 # For ZFrameRegistration
 import ZFrameRegistrationScripted
 
+from ProstateTemplateBiopsyLib.RegistrationHistory import PROTOCOL_TAGS, RegistrationHistory, getProtocolTagsFromDataset
+from ProstateTemplateBiopsyLib.ThresholdSelection import selectThresholdPercentage
+from ProstateTemplateBiopsyLib.Tracing import tracer, traced
+from ProstateTemplateBiopsyLib.ZFramePoseSearch import ZFramePoseSearch
+from ProstateTemplateBiopsyLib.ZFramePoseSolver import ZFramePoseSolver
+
 class ProstateTemplateBiopsy(ScriptedLoadableModule):
   def __init__(self, parent):
     ScriptedLoadableModule.__init__(self, parent)
@@ -58,10 +69,660 @@ class ProstateTemplateBiopsy(ScriptedLoadableModule):
         parent.icon = qt.QIcon(iconPath)
         break
 
+class DICOMStoreReceiver:
+  # In-process C-STORE SCP for the case directory. Received instances are written to disk for archival and
+  # queued in memory so that the module does not have to read them back.
+  def __init__(self, storageDirectory, port, aeTitle):
+    self.storageDirectory = storageDirectory
+    self.port = port
+    self.aeTitle = aeTitle
+    self.server = None
+    self.receivedDatasets = queue.Queue()
+
+  def start(self):
+    try:
+      from pynetdicom import AE, evt, AllStoragePresentationContexts, VerificationPresentationContexts
+    except ImportError:
+      slicer.util.pip_install('pynetdicom')
+      from pynetdicom import AE, evt, AllStoragePresentationContexts, VerificationPresentationContexts
+
+    ae = AE(ae_title=self.aeTitle)
+    ae.supported_contexts = AllStoragePresentationContexts + VerificationPresentationContexts
+    self.server = ae.start_server(('', self.port), block=False, evt_handlers=[(evt.EVT_C_STORE, self.handleStore)])
+    print(f'DICOM receiver {self.aeTitle} listening on port {self.port}')
+
+  def stop(self):
+    if self.server:
+      self.server.shutdown()
+      self.server = None
+      print(f'DICOM receiver {self.aeTitle} stopped')
+
+  def handleStore(self, event):
+    # Runs on the receiver thread; only file I/O and the thread-safe queue are touched here
+    dataset = event.dataset
+    dataset.file_meta = event.file_meta
+    seriesDirectory = f'{self.storageDirectory}/{dataset.SeriesInstanceUID}'
+    os.makedirs(seriesDirectory, exist_ok=True)
+    filePath = f'{seriesDirectory}/{dataset.SOPInstanceUID}.dcm'
+    # Write under a temporary name so that a partially written file is never picked up
+    with open(f'{filePath}.part', 'wb') as f:
+      f.write(event.encoded_dataset())
+    os.replace(f'{filePath}.part', filePath)
+    self.receivedDatasets.put((filePath, dataset))
+    return 0x0000
+
+  def takeReceivedDatasets(self):
+    received = []
+    while True:
+      try:
+        received.append(self.receivedDatasets.get_nowait())
+      except queue.Empty:
+        return received
+
+class CaseSaveEngine:
+  # Saves the scene of a case as an MRML scene folder. Only nodes modified since the previous checkpoint are written
+  # and bulk voxel data is written by a background worker.
+  NRRD_TYPES = {'int8': 'int8', 'uint8': 'uint8', 'int16': 'short', 'uint16': 'ushort', 'int32': 'int',
+                'uint32': 'uint', 'int64': 'longlong', 'uint64': 'ulonglong', 'float32': 'float', 'float64': 'double'}
+
+  def __init__(self, caseDirPath, compress=False):
+    self.caseDirPath = caseDirPath
+    self.sceneDirPath = f'{caseDirPath}/scene'
+    self.compress = compress
+    self.checkpointTimes = dict()
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.pendingWrites = []
+
+  def checkpoint(self):
+    # Runs on the main thread: node data is snapshotted here and only the file writing happens in the background
+    os.makedirs(f'{self.sceneDirPath}/Data', exist_ok=True)
+    startTime = time.time()
+    numberOfNodesWritten = 0
+    for node in slicer.util.getNodesByClass('vtkMRMLStorableNode'):
+      if not node.GetSaveWithScene():
+        continue
+      modifiedTime = self.getModifiedTime(node)
+      if self.checkpointTimes.get(node.GetID()) == modifiedTime:
+        continue
+      storageNode = node.GetStorageNode()
+      # Unmodified nodes read from a file (e.g. template models) keep referencing that file
+      if storageNode and storageNode.GetFileName() and not node.GetModifiedSinceRead() and node.GetID() not in self.checkpointTimes:
+        self.checkpointTimes[node.GetID()] = modifiedTime
+        continue
+      if self.writeNode(node):
+        # Writing replaces the storage node and bumps the node MTime, so the time is recorded afterwards
+        self.checkpointTimes[node.GetID()] = self.getModifiedTime(node)
+        numberOfNodesWritten += 1
+    print(f'Scene checkpoint: {numberOfNodesWritten} modified nodes queued for writing in {time.time() - startTime:.2f} s')
+
+  def getModifiedTime(self, node):
+    modifiedTime = node.GetMTime()
+    if isinstance(node, slicer.vtkMRMLVolumeNode) and node.GetImageData():
+      modifiedTime = max(modifiedTime, node.GetImageData().GetMTime())
+    elif isinstance(node, slicer.vtkMRMLModelNode) and node.GetPolyData():
+      modifiedTime = max(modifiedTime, node.GetPolyData().GetMTime())
+    return modifiedTime
+
+  def getDataFileName(self, node, extension):
+    # Short, unique file names; long DICOM series names used to make the scene fail to save
+    nodeName = re.sub(r'[^\w-]+', '_', node.GetName())[:41]
+    return f'{self.sceneDirPath}/Data/{nodeName}_{node.GetID()}{extension}'
+
+  def writeNode(self, node):
+    if isinstance(node, slicer.vtkMRMLScalarVolumeNode) and node.GetImageData():
+      fileName = self.getDataFileName(node, '.nrrd')
+      ijkToRAS = vtk.vtkMatrix4x4()
+      node.GetIJKToRASMatrix(ijkToRAS)
+      ijkToRAS = np.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+      voxels = slicer.util.arrayFromVolume(node).copy()
+      future = self.executor.submit(self.writeNrrd, fileName, voxels, ijkToRAS, self.compress)
+      future.add_done_callback(self.onWriteFinished)
+      self.pendingWrites.append(future)
+      # Point a fresh storage node at the file being written so that the scene file references it instead of the DICOM files
+      if node.GetStorageNode():
+        slicer.mrmlScene.RemoveNode(node.GetStorageNode())
+      node.AddDefaultStorageNode()
+      storageNode = node.GetStorageNode()
+      storageNode.SetFileName(fileName)
+      storageNode.SetUseCompression(self.compress)
+      return True
+    # Markups, transforms and generated models are small enough to be written directly
+    if not node.GetStorageNode():
+      node.AddDefaultStorageNode()
+    storageNode = node.GetStorageNode()
+    if not storageNode:
+      return False
+    storageNode.SetFileName(self.getDataFileName(node, f'.{storageNode.GetDefaultWriteFileExtension()}'))
+    storageNode.SetUseCompression(self.compress)
+    return bool(storageNode.WriteData(node))
+
+  def writeNrrd(self, fileName, voxels, ijkToRAS, compress):
+    # Runs on the background worker
+    ijkToLPS = np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijkToRAS
+    voxels = np.ascontiguousarray(voxels, dtype=voxels.dtype.newbyteorder('<'))
+    directions = ' '.join('(' + ','.join(f'{x:.17g}' for x in ijkToLPS[:3, axis]) + ')' for axis in range(3))
+    origin = '(' + ','.join(f'{x:.17g}' for x in ijkToLPS[:3, 3]) + ')'
+    header = ('NRRD0004\n'
+              f'type: {self.NRRD_TYPES[voxels.dtype.name]}\n'
+              'dimension: 3\n'
+              'space: left-posterior-superior\n'
+              f'sizes: {voxels.shape[2]} {voxels.shape[1]} {voxels.shape[0]}\n'
+              f'space directions: {directions}\n'
+              'kinds: domain domain domain\n'
+              'endian: little\n'
+              f'encoding: {"gzip" if compress else "raw"}\n'
+              f'space origin: {origin}\n\n')
+    with open(f'{fileName}.part', 'wb') as f:
+      f.write(header.encode('ascii'))
+      if compress:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as gzipFile:
+          gzipFile.write(voxels.tobytes())
+      else:
+        f.write(voxels.tobytes())
+    os.replace(f'{fileName}.part', fileName)
+
+  def onWriteFinished(self, future):
+    if future.exception():
+      print(f'Scene data write failed: {future.exception()}')
+
+  def cacheVolume(self, cachePath, voxels, metadata):
+    future = self.executor.submit(self.writeCachedVolume, cachePath, voxels, metadata)
+    future.add_done_callback(self.onWriteFinished)
+    self.pendingWrites.append(future)
+
+  def writeCachedVolume(self, cachePath, voxels, metadata):
+    # Runs on the background worker; written under a temporary name so that a reopened case never maps a partial file
+    with open(f'{cachePath}.npy.part', 'wb') as f:
+      np.save(f, voxels)
+    os.replace(f'{cachePath}.npy.part', f'{cachePath}.npy')
+    with open(f'{cachePath}.json', 'w') as f:
+      json.dump(metadata, f)
+
+  def commitScene(self):
+    sceneFileName = f'{self.sceneDirPath}/saved-scene-{time.strftime("%Y%m%d-%H%M%S")}.mrml'
+    slicer.mrmlScene.SetRootDirectory(self.sceneDirPath)
+    slicer.mrmlScene.SetURL(sceneFileName)
+    if not slicer.mrmlScene.Commit():
+      return None
+    return sceneFileName
+
+  def wait(self):
+    # Returns the errors of the background writes queued since the previous wait
+    errors = [future.exception() for future in self.pendingWrites]
+    self.pendingWrites = []
+    return [error for error in errors if error]
+
+class CaseJournal:
+  # Append-only record of case state changes (one JSON object per line) used to resume a case after a crash
+  def __init__(self, caseDirPath):
+    self.journalPath = f'{caseDirPath}/case-journal.jsonl'
+    # Terminate a record left incomplete by a crash so that new records start on their own line
+    if os.path.exists(self.journalPath) and os.path.getsize(self.journalPath) > 0:
+      with open(self.journalPath, 'rb+') as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b'\n':
+          f.write(b'\n')
+
+  def record(self, recordType, **values):
+    record = dict(values, type=recordType, time=time.time())
+    with open(self.journalPath, 'a') as f:
+      f.write(json.dumps(record) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+
+  def read(self):
+    records = []
+    if not os.path.exists(self.journalPath):
+      return records
+    with open(self.journalPath, 'r') as f:
+      for line in f:
+        try:
+          records.append(json.loads(line))
+        except ValueError:
+          # Last record may be incomplete if Slicer crashed while writing it
+          print(f'Skipping incomplete journal record in {self.journalPath}')
+    return records
+
+@dataclass(frozen=True)
+class RegistrationParameters:
+  # Snapshot of the registration settings taken on the main thread; the logic never reads the widgets
+  zFrameFiducials: tuple
+  zframeConfig: str
+  startingThreshold: float
+  minimumSize: float
+  maximumSize: float
+  borderMargin: int
+  removeBorderIslands: bool
+  removeOrientation: bool
+  retryFailed: bool
+  repairFiducials: bool = False
+  minimumThreshold: float = 0.0
+  maximumThreshold: float = 0.2
+  fiducialDetector: str = 'islands'
+  projectionSlabSlices: int = 10
+  poseSolver: str = 'native'
+
+class ProstateTemplateBiopsyLogic(ScriptedLoadableModuleLogic):
+  """Z-frame registration on voxel arrays, without MRML nodes or widgets, so that it can run on a worker thread.
+
+  Follows the same threshold ladders as the widget: the fiducials are masked by thresholding and keeping the islands
+  in the fiducial size range, the pose is solved with the native pose solver and checked against the mask. The plain
+  retry ladder and the fiducial count and repair ladder race each other, and the first valid result stops the other.
+  Progress is reported through a callback after every attempt. The ladders stop early when the deadline passes or
+  the cancel event is set, keeping the best scoring pose found so far.
+  """
+
+  def __init__(self):
+    ScriptedLoadableModuleLogic.__init__(self)
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    # One thread per registration strategy
+    self.strategyExecutor = ThreadPoolExecutor(max_workers=2)
+
+  def shutdown(self):
+    # Queued work is dropped; running work is not waited for
+    self.executor.shutdown(wait=False, cancel_futures=True)
+    self.strategyExecutor.shutdown(wait=False, cancel_futures=True)
+
+  def registerInBackground(self, volumeArray, ijkToRAS, parameters, progress=None, deadline=None, cancelEvent=None):
+    # Returns a future; the arrays must not be modified until it is done
+    return self.executor.submit(self.raceStrategies, volumeArray, ijkToRAS, parameters, progress, deadline, cancelEvent)
+
+  def raceStrategies(self, volumeArray, ijkToRAS, parameters, progress=None, deadline=None, cancelEvent=None):
+    """Runs the retry ladder and, if repairFiducials is set, the repair ladder concurrently.
+
+    Returns the first valid result, otherwise the best scoring one with the reason the ladders were 'stopped' early.
+    """
+    strategies = [self.register]
+    if parameters.repairFiducials:
+      strategies.append(self.registerWithRepair)
+    # Set by the first valid result or by the caller's cancel event
+    stopEvent = threading.Event()
+    futures = [self.strategyExecutor.submit(strategy, volumeArray, ijkToRAS, parameters, progress, deadline, stopEvent) for strategy in strategies]
+    winner = None
+    pending = set(futures)
+    try:
+      while pending:
+        done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+        if cancelEvent is not None and cancelEvent.is_set():
+          stopEvent.set()
+        for future in done:
+          if winner is None and future.result()['valid']:
+            winner = future.result()
+            stopEvent.set()
+    finally:
+      stopEvent.set()
+    results = [future.result() for future in futures]
+    attempts = sum(result['attempts'] for result in results)
+    if winner:
+      print(f'Registration won by the {winner["strategy"]} strategy after {attempts} attempts in total')
+      return dict(winner, totalAttempts=attempts)
+    best = max(results, key=lambda result: (result['pose'] is not None, result['score']))
+    stopped = next((result['stopped'] for result in results if result['stopped']), None)
+    return dict(best, totalAttempts=attempts, stopped=stopped)
+
+  @staticmethod
+  def getStopReason(deadline=None, cancelEvent=None):
+    # deadline is a time.perf_counter() value
+    if cancelEvent is not None and cancelEvent.is_set():
+      return 'cancelled'
+    if deadline is not None and time.perf_counter() > deadline:
+      return 'timeout'
+    return None
+
+  def register(self, volumeArray, ijkToRAS, parameters, progress=None, deadline=None, cancelEvent=None):
+    """Returns a dict with 'valid', the zFrame to RAS 'pose' with its 'score', 'residual', 'threshold' and 'mask', the
+    number of 'attempts' and the reason the ladder was 'stopped' early ('cancelled', 'timeout' or None).
+
+    The pose is the one of the valid attempt, otherwise that of the best scoring attempt.
+    """
+    threshold = parameters.startingThreshold
+    increaseThreshold = False
+    attempt = 0
+    best = None
+    stopped = None
+    while True:
+      attempt += 1
+      with tracer.span('registrationAttempt', attempt=attempt, threshold=threshold, repair=False, thread='worker') as attemptSpan:
+        mask = self.createFiducialMask(volumeArray, threshold, parameters)
+        attemptResult = self.solveAndCheck(mask, ijkToRAS, parameters, threshold)
+        attemptSpan.args.update(valid=attemptResult['valid'], score=attemptResult['score'])
+      valid = attemptResult['valid']
+      if best is None or valid or (attemptResult['pose'] is not None and attemptResult['score'] > best['score']):
+        best = attemptResult
+      if progress:
+        progress({'strategy': 'retry', 'attempt': attempt, 'threshold': threshold, 'valid': valid, 'score': attemptResult['score']})
+      if valid or not parameters.retryFailed:
+        break
+      stopped = self.getStopReason(deadline, cancelEvent)
+      if stopped:
+        break
+      # Same steps as the widget retry ladder: down by 0.02 to the minimum, then up by 0.04 from the starting threshold
+      if not increaseThreshold:
+        if threshold > parameters.minimumThreshold:
+          threshold = round(max(threshold - 0.02, parameters.minimumThreshold), 2)
+        else:
+          increaseThreshold = True
+          threshold = round(parameters.startingThreshold + 0.04, 2)
+      elif threshold < parameters.maximumThreshold:
+        threshold = round(threshold + 0.04, 2)
+      else:
+        break
+    return dict(best, attempts=attempt, stopped=stopped, strategy='retry')
+
+  def registerWithRepair(self, volumeArray, ijkToRAS, parameters, progress=None, deadline=None, cancelEvent=None):
+    # Same ladder as the widget's fiducial repair: at each threshold, predict the fiducials from the frame geometry and
+    # draw up to two missing ones, then register once
+    threshold = parameters.startingThreshold
+    increaseThreshold = False
+    attempt = 0
+    stopped = None
+    while True:
+      attempt += 1
+      with tracer.span('registrationAttempt', attempt=attempt, threshold=threshold, repair=True, thread='worker') as attemptSpan:
+        mask = self.createFiducialMask(volumeArray, threshold, parameters)
+        result = self.predictMissingFiducials(mask, ijkToRAS, parameters)
+        attemptSpan.args['result'] = result
+      if progress:
+        progress({'strategy': 'repair', 'attempt': attempt, 'threshold': threshold, 'valid': False, 'score': None})
+      if result in ["accepted", "success"]:
+        break
+      stopped = self.getStopReason(deadline, cancelEvent)
+      if stopped:
+        break
+      if not increaseThreshold:
+        if threshold > parameters.minimumThreshold:
+          threshold = round(max(threshold - 0.01, parameters.minimumThreshold), 2)
+        else:
+          increaseThreshold = True
+          threshold = round(parameters.startingThreshold + 0.02, 2)
+      elif threshold < parameters.maximumThreshold:
+        threshold = round(threshold + 0.02, 2)
+      else:
+        print("Fiducial repair failed")
+        break
+    with tracer.span('registrationAttempt', attempt=attempt, threshold=threshold, repair=True, thread='worker') as attemptSpan:
+      attemptResult = self.solveAndCheck(mask, ijkToRAS, parameters, threshold)
+      attemptSpan.args.update(valid=attemptResult['valid'], score=attemptResult['score'])
+    if progress:
+      progress({'strategy': 'repair', 'attempt': attempt, 'threshold': threshold, 'valid': attemptResult['valid'], 'score': attemptResult['score']})
+    return dict(attemptResult, attempts=attempt, stopped=None if attemptResult['valid'] else stopped, strategy='repair')
+
+  def detectTemplate(self, volumeArray, ijkToRAS, candidates, threshold):
+    """Registers every candidate template on the same fiducial mask concurrently.
+
+    candidates maps the template id (e.g. 'z001') to its RegistrationParameters; the masking parameters of the first
+    one are used for all. Only the templates with as many fiducials as there are islands in the slices around the
+    center of the mask are registered. Returns the id of the template that fits best (valid results first, then by
+    score, then by residual, then the lowest id), or None if no template has that many fiducials, and a dict of the
+    result of each registered template.
+    """
+    with tracer.span('detectTemplate', threshold=threshold, thread='worker') as span:
+      # The projection detector keeps as many blobs as the template with the most fiducials has
+      mask = self.createFiducialMask(volumeArray, threshold, max(candidates.values(), key=lambda parameters: len(parameters.zFrameFiducials)))
+      fiducialCount = self.countFiducials(mask)
+      candidates = {zframeConfig: parameters for zframeConfig, parameters in candidates.items() if len(parameters.zFrameFiducials) == fiducialCount}
+      span.args.update(fiducialCount=fiducialCount)
+      if not candidates:
+        return None, dict()
+      with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        futures = {zframeConfig: executor.submit(self.solveAndCheck, mask, ijkToRAS, parameters, threshold)
+                   for zframeConfig, parameters in candidates.items()}
+        results = {zframeConfig: future.result() for zframeConfig, future in futures.items()}
+
+      def rank(zframeConfig):
+        result = results[zframeConfig]
+        residual = result['residual'] if result['residual'] is not None else math.inf
+        return (not result['valid'], -result['score'], residual, zframeConfig)
+
+      best = min(results, key=rank)
+      span.args.update(template=best, scores={zframeConfig: float(result['score']) for zframeConfig, result in results.items()})
+    return best, results
+
+  def registerPartialSeries(self, volumeArray, ijkToRAS, parameters, slabSlices=3):
+    """Registers a calibration series that is still being received, once at the starting threshold.
+
+    Returns the same dict as solveAndCheck, or None if the slices around the centre of the fiducials have not all
+    been received yet.
+    """
+    mask = self.createFiducialMask(volumeArray, parameters.startingThreshold, parameters)
+    if not np.any(mask):
+      return None
+    centerOfMassSlice = int(ndimage.center_of_mass(mask)[0])
+    if centerOfMassSlice - slabSlices < 0 or centerOfMassSlice + slabSlices >= len(volumeArray):
+      return None
+    return self.solveAndCheck(mask, ijkToRAS, parameters, parameters.startingThreshold)
+
+  def reregister(self, volumeArray, ijkToRAS, parameters, previousPose, neighbourhood=10.0):
+    """Registers a new calibration image starting from the zFrame to RAS pose of the previous registration.
+
+    Only voxels within neighbourhood (mm) of the fiducial lines at the previous pose are masked, at the starting
+    threshold, and the pose solver starts from the previous pose alone. Returns the same dict as solveAndCheck, with a
+    mask of the whole volume and the 'motion' from the previous pose (translation in mm, rotation in degrees), or None
+    if the fiducials at the previous pose are outside of the volume.
+    """
+    ijkToRAS = np.asarray(ijkToRAS, dtype=float)
+    previousPose = np.asarray(previousPose, dtype=float)
+    spacing = np.linalg.norm(ijkToRAS[0:3, 0:3], axis=0)[::-1]
+    # Points about a voxel apart along the fiducial lines at the previous pose, in KJI array coordinates
+    fiducials = np.asarray(parameters.zFrameFiducials, dtype=float)
+    lineLength = np.max(np.linalg.norm(fiducials[:, 3:6] - fiducials[:, 0:3], axis=1))
+    samples = np.linspace(0.0, 1.0, int(lineLength / spacing.min()) + 2)
+    points = (fiducials[:, None, 0:3] + samples[None, :, None] * (fiducials[:, None, 3:6] - fiducials[:, None, 0:3])).reshape(-1, 3)
+    kji = (np.column_stack([points, np.ones(len(points))]) @ (np.linalg.inv(ijkToRAS) @ previousPose).T)[:, 2::-1]
+    margin = np.ceil(neighbourhood / spacing).astype(int)
+    lower = np.maximum(np.floor(kji.min(axis=0)).astype(int) - margin, 0)
+    upper = np.minimum(np.ceil(kji.max(axis=0)).astype(int) + margin + 1, volumeArray.shape)
+    if np.any(upper <= lower):
+      return None
+    region = tuple(slice(start, end) for start, end in zip(lower, upper))
+
+    predicted = np.zeros(upper - lower, dtype=bool)
+    indices = np.rint(kji - lower).astype(int)
+    predicted[tuple(indices[np.all((indices >= 0) & (indices < predicted.shape), axis=1)].T)] = True
+    near = ndimage.distance_transform_edt(~predicted, sampling=spacing) <= neighbourhood
+    # Threshold relative to the scalar range of the whole volume, as for the full registration
+    low, high = float(volumeArray.min()), float(volumeArray.max())
+    labels, count = ndimage.label((volumeArray[region] >= int((high - low) * parameters.startingThreshold + low)) & near)
+    sizes = np.bincount(labels.ravel())
+    keep = (sizes >= parameters.minimumSize) & (sizes < parameters.maximumSize)
+    keep[0] = False
+    # Islands near the image edges are dropped as in the full registration, measured from the edges of the whole volume
+    if parameters.removeBorderIslands:
+      keep[np.unique(labels[:, self.getBorderMask(volumeArray.shape[1:], parameters.borderMargin)[region[1:]]])] = False
+    regionMask = keep[labels].astype(np.uint8)
+
+    regionToRAS = ijkToRAS.copy()
+    regionToRAS[0:3, 3] = ijkToRAS[0:3, 0:3] @ lower[::-1] + ijkToRAS[0:3, 3]
+    solution = self.solvePose(regionMask, regionToRAS, parameters, initialPoses=[previousPose])
+    mask = np.zeros(volumeArray.shape, dtype=np.uint8)
+    mask[region] = regionMask
+    result = {'valid': False, 'pose': None, 'score': 0.0, 'threshold': parameters.startingThreshold, 'mask': mask, 'residual': None, 'motion': None}
+    if solution is None:
+      return result
+    pose = solution['pose']
+    difference = np.linalg.inv(previousPose) @ pose
+    rotation = math.degrees(math.acos(min(1.0, max(-1.0, (np.trace(difference[0:3, 0:3]) - 1) / 2))))
+    result.update(valid=self.checkPose(pose, regionMask, regionToRAS, parameters.zFrameFiducials), pose=pose,
+                  score=self.scorePose(pose, regionMask, regionToRAS, parameters.zFrameFiducials), residual=solution['residual'],
+                  motion={'translation': float(np.linalg.norm(pose[0:3, 3] - previousPose[0:3, 3])), 'rotation': rotation})
+    return result
+
+  @staticmethod
+  def readZFrameFiducials(zframeConfigFilePath):
+    # Fiducial lines of a zframe00N.txt configuration file as [x1, y1, z1, x2, y2, z2] in zFrame coordinates
+    fiducials = []
+    with open(zframeConfigFilePath, 'r') as f:
+      for line in f:
+        if line.startswith('Fiducial'):
+          point1, point2 = line.split(': ')[1].strip('()\n').replace(' ', '').split('),(')
+          fiducials.append([float(x) for x in point1.split(',')] + [float(x) for x in point2.split(',')])
+    return fiducials
+
+  def solveAndCheck(self, mask, ijkToRAS, parameters, threshold):
+    solution = self.solvePose(mask, ijkToRAS, parameters)
+    valid = solution is not None and self.checkPose(solution['pose'], mask, ijkToRAS, parameters.zFrameFiducials)
+    score = self.scorePose(solution['pose'], mask, ijkToRAS, parameters.zFrameFiducials) if solution else 0.0
+    return {'valid': bool(valid), 'pose': solution['pose'] if solution else None, 'score': score, 'threshold': threshold, 'mask': mask,
+            'residual': solution['residual'] if solution else None}
+
+  def createFiducialMask(self, volumeArray, thresholdPercentage, parameters):
+    # Same result as the Segment Editor masking: threshold at a percentage of the scalar range, keep islands of
+    # minimumSize up to (not including) maximumSize voxels and drop islands within borderMargin of the image edges
+    if parameters.fiducialDetector == 'projection':
+      return self.createFiducialMaskFromProjection(volumeArray, thresholdPercentage, parameters)
+    low, high = float(volumeArray.min()), float(volumeArray.max())
+    labels, count = ndimage.label(volumeArray >= int((high - low) * thresholdPercentage + low))
+    sizes = np.bincount(labels.ravel())
+    keep = (sizes >= parameters.minimumSize) & (sizes < parameters.maximumSize)
+    keep[0] = False
+    if parameters.removeBorderIslands:
+      keep[np.unique(labels[:, self.getBorderMask(labels.shape[1:], parameters.borderMargin)])] = False
+    return keep[labels].astype(np.uint8)
+
+  @staticmethod
+  def getBorderMask(sliceShape, borderMargin):
+    # In-plane voxels (JI) within borderMargin of the image edges
+    margin = int(borderMargin)
+    border = np.zeros(sliceShape, dtype=bool)
+    border[0:margin, :] = True
+    border[(-margin-1):-1, :] = True
+    border[:, 0:margin] = True
+    border[:, (-margin-1):-1] = True
+    return border
+
+  def createFiducialMaskFromProjection(self, volumeArray, thresholdPercentage, parameters):
+    """Masks the fiducials in a slab of projectionSlabSlices on either side of the frame center, found as blobs of its
+    maximum intensity projection.
+
+    The fiducial rods cross the slab, so each one is a blob of the projection. The blobs are labelled in 2D and
+    scored by the number of voxels above the threshold in their footprint within the slab, with the fiducial size
+    range scaled to the slab thickness. Only the voxels of the chosen blobs (at most one per fiducial, largest
+    first) are labelled in 3D. The mask is empty outside of the slab, which is centered on the slice with the most
+    voxels above the threshold. The slab is wider than the one the pose is solved from, so that it contains the
+    fiducial midpoints the registration check looks for.
+    """
+    slabSlices = parameters.projectionSlabSlices
+    low, high = float(volumeArray.min()), float(volumeArray.max())
+    threshold = int((high - low) * thresholdPercentage + low)
+    margin = int(parameters.borderMargin) if parameters.removeBorderIslands else 0
+    # Every fourth row and column is enough to locate the frame along the slice axis
+    inner = volumeArray[:, margin:volumeArray.shape[1] - margin:4, margin:volumeArray.shape[2] - margin:4]
+    profile = np.count_nonzero(inner >= threshold, axis=(1, 2))
+    mask = np.zeros(volumeArray.shape, dtype=np.uint8)
+    if not np.any(profile):
+      return mask
+    centerSlice = int(round(np.average(np.arange(len(profile)), weights=profile)))
+    firstSlice = max(0, centerSlice - slabSlices)
+    slab = volumeArray[firstSlice:centerSlice + slabSlices + 1]
+
+    labels, count = ndimage.label(slab.max(axis=0) >= threshold)
+    if count == 0:
+      return mask
+    index = np.arange(1, count + 1)
+    sizes = ndimage.sum_labels(np.count_nonzero(slab >= threshold, axis=0), labels, index)
+    slabFraction = len(slab) / len(volumeArray)
+    candidate = (sizes >= parameters.minimumSize * slabFraction) & (sizes < parameters.maximumSize * slabFraction)
+    if margin:
+      border = np.zeros(labels.shape, dtype=bool)
+      border[0:margin, :] = True
+      border[(-margin-1):-1, :] = True
+      border[:, 0:margin] = True
+      border[:, (-margin-1):-1] = True
+      candidate[np.unique(labels[border])[1:] - 1] = False
+    chosen = index[candidate][np.argsort(-sizes[candidate], kind='stable')][:len(parameters.zFrameFiducials)]
+    objects = ndimage.find_objects(labels)
+    for label in chosen:
+      rows, columns = objects[label - 1]
+      footprint = labels[rows, columns] == label
+      blobMask = (slab[:, rows, columns] >= threshold) & footprint
+      # The largest 3D component of the footprint, as clutter may overlap the fiducial in the projection only
+      blobLabels, blobCount = ndimage.label(blobMask)
+      if blobCount > 1:
+        blobMask = blobLabels == np.argmax(np.bincount(blobLabels.ravel())[1:]) + 1
+      mask[firstSlice:firstSlice + len(slab), rows, columns] |= blobMask.astype(np.uint8)
+    return mask
+
+  def solvePose(self, mask, ijkToRAS, parameters, slabSlices=3, initialPoses=None):
+    if not np.any(mask):
+      return None
+    solver = ZFramePoseSolver(parameters.zFrameFiducials)
+    if parameters.poseSolver == 'ransac':
+      # All slices, with the centroids off the fiducial lines rejected by RANSAC
+      with tracer.span('ZFramePoseSolver.solve', fitLines=True):
+        solution = solver.solve(mask, ijkToRAS, initialPoses=initialPoses, fitLines=True)
+    else:
+      centerOfMassSlice = int(ndimage.center_of_mass(mask)[0])
+      with tracer.span('ZFramePoseSolver.solve', startSlice=centerOfMassSlice-slabSlices, endSlice=centerOfMassSlice+slabSlices):
+        solution = solver.solve(mask, ijkToRAS, (centerOfMassSlice - slabSlices, centerOfMassSlice + slabSlices), initialPoses)
+    if solution and parameters.removeOrientation:
+      solution['pose'][0:3, 0:3] = np.eye(3)
+    return solution
+
+  def scorePose(self, zFrameToRAS, mask, arrayToRAS, zFrameFiducials, samplesPerFiducial=21, tolerance=5.0):
+    """Symmetric coverage of the mask by the zFrame fiducials at zFrameToRAS, from 0 to 1.
+
+    The harmonic mean of the fraction of points sampled along each fiducial that land on a mask voxel and the fraction
+    of mask voxels within tolerance (mm) of a fiducial. Mask voxels that no fiducial explains lower the score, so a
+    template whose fiducials match only some of the rods in the image scores below the one that matches all of them.
+    """
+    fiducials = np.asarray(zFrameFiducials, dtype=float)
+    if len(fiducials) == 0:
+      return 0.0
+    samples = np.linspace(0.0, 1.0, samplesPerFiducial)
+    points = (fiducials[:, None, 0:3] + samples[None, :, None] * (fiducials[:, None, 3:6] - fiducials[:, None, 0:3])).reshape(-1, 3)
+    points = np.column_stack([points, np.ones(len(points))])
+    ijkPoints = np.rint(points @ (np.linalg.inv(arrayToRAS) @ zFrameToRAS).T)[:, 0:3].astype(int)
+    inside = np.all((ijkPoints >= 0) & (ijkPoints < np.array(mask.shape[::-1])), axis=1)
+    ijkPoints = ijkPoints[inside]
+    hits = np.count_nonzero(mask[ijkPoints[:, 2], ijkPoints[:, 1], ijkPoints[:, 0]] > 0)
+    fiducialCoverage = hits / len(points)
+
+    # Mask voxels in frame coordinates, against the fiducial segments
+    kji = np.argwhere(mask > 0)
+    if len(kji) == 0 or fiducialCoverage == 0:
+      return 0.0
+    voxels = np.column_stack([kji[:, ::-1], np.ones(len(kji))]) @ (np.linalg.inv(zFrameToRAS) @ np.asarray(arrayToRAS)).T
+    residuals = ZFramePoseSolver(zFrameFiducials).pointToLineResiduals(voxels[:, 0:3])
+    maskCoverage = np.count_nonzero(np.linalg.norm(residuals, axis=2).min(axis=1) <= tolerance) / len(kji)
+    return 2 * fiducialCoverage * maskCoverage / (fiducialCoverage + maskCoverage)
+
+  def countFiducials(self, mask, slabSlices=3):
+    # Median number of in-plane islands per slice in the slab around the center of the mask (KJI)
+    if not np.any(mask):
+      return 0
+    centerOfMassSlice = int(ndimage.center_of_mass(mask)[0])
+    slab = mask[max(0, centerOfMassSlice - slabSlices):centerOfMassSlice + slabSlices + 1] > 0
+    return int(np.median([ndimage.label(maskSlice)[1] for maskSlice in slab]))
+
+  def checkPose(self, zFrameToRAS, mask, ijkToRAS, zFrameFiducials):
+    # Same check as the widget: the midpoint of each fiducial, or a voxel 2 voxels away from it, must be in the mask
+    fiducials = np.asarray(zFrameFiducials, dtype=float)
+    midpoints = np.column_stack([(fiducials[:, 0:3] + fiducials[:, 3:6]) / 2, np.ones(len(fiducials))])
+    ijkMidpoints = (midpoints @ (np.linalg.inv(ijkToRAS) @ zFrameToRAS).T)[:, 0:3]
+    dimensions = np.array(mask.shape[::-1])
+    if not np.all((ijkMidpoints >= 0) & (ijkMidpoints <= dimensions - 1)):
+      return False
+    offsets = np.array([[0, 0, 0], [-2, 0, 0], [2, 0, 0], [0, -2, 0], [0, 2, 0], [0, 0, -2], [0, 0, 2]])
+    ijk = ijkMidpoints.astype(int)[:, None, :] + offsets[None, :, :]
+    inside = np.all((ijk >= 0) & (ijk < dimensions), axis=2)
+    ijk = np.clip(ijk, 0, dimensions - 1)
+    found = (mask[ijk[..., 2], ijk[..., 1], ijk[..., 0]] > 0) & inside
+    return bool(np.all(np.any(found, axis=1)))
+
+  def predictMissingFiducials(self, mask, ijkToRAS, parameters, slabSlices=3, maximumMissing=2):
+    """Draws the fiducials missing from the mask (KJI) into it where the detected fiducials put them, for any template.
+
+    See ZFramePoseSolver.predictMissingFiducials. Returns "accepted" if no fiducial is missing, "success" if up to
+    maximumMissing were drawn, otherwise "anomaly".
+    """
+    result, pose = ZFramePoseSolver(parameters.zFrameFiducials).predictMissingFiducials(mask, ijkToRAS, slabSlices, maximumMissing)
+    return result
+
 class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
   def __init__(self, parent=None):
     ScriptedLoadableModuleWidget.__init__(self, parent)
-    self.ignoredVolumeNames = ['MaskedCalibrationVolume', 'MaskedCalibrationLabelMapVolume', 'TempLabelMapVolume']
+    self.ignoredVolumeNames = ['MaskedCalibrationVolume', 'MaskedCalibrationLabelMapVolume', 'TempLabelMapVolume', 'ZFramePhantomVolume',
+                               'ZFramePhantomLabelMapVolume', 'BatchCalibrationVolume']
     self.currentPhase = 'START'
     self.imageRoles = ['N/A', 'CALIBRATION', 'PLANNING', 'CONFIRMATION']
     self.caseDirPath = None
@@ -101,8 +762,41 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.observationTimer.setInterval(1250)
     self.observationTimer.timeout.connect(self.observeDicomFolder)
 
+    # Target edits are journaled once they settle instead of on every point modification while dragging
+    self.journalTargetsTimer = qt.QTimer()
+    self.journalTargetsTimer.setSingleShot(True)
+    self.journalTargetsTimer.setInterval(500)
+    self.journalTargetsTimer.timeout.connect(self.journalTargets)
+
     self.seriesList = []
     self.seriesTimeStamps = dict()
+    self.fastCalibrationLoad = True
+    self.streamCalibration = True
+    self.streamingSeries = dict()
+    self.streamingPendingFiles = []
+    self.streamingDecode = None
+    self.streamingRetries = dict()
+    self.speculativeTransforms = dict()
+    self.seriesLoadQueue = []
+    self.seriesLoadScheduled = False
+    self.seriesLoad = None
+    self.seriesLoadPriorities = ['CALIBRATION', 'PLANNING', 'N/A']
+    self.dicomReceiver = None
+    self.dicomIndexer = None
+    self.caseSaveEngine = None
+    self.caseJournal = None
+    self.replayingJournal = False
+    self.receivedFiles = []
+    self.receivedDatasets = dict()
+    self.registrationPending = False
+    self.registrationResidual = None
+    self.logic = ProstateTemplateBiopsyLogic()
+    self.backgroundRegistration = None
+    self.templateDetection = None
+    self.reregistration = None
+    self.registrationDeadline = None
+    self.registrationCancelEvent = threading.Event()
+    self.registrationStopped = None
     self.nodeAddedObserver = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAddedEvent,self.onNodeAddedEvent)
 
     slicer.util.setDataProbeVisible(False)
@@ -117,8 +811,24 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.seriesList = []
     self.loadedFiles = []
     self.filesToBeLoaded = []
+    self.streamingSeries = dict()
+    self.streamingPendingFiles = []
+    self.streamingDecode = None
+    self.streamingRetries = dict()
+    self.speculativeTransforms = dict()
+    self.seriesLoadQueue = []
+    self.seriesLoad = None
+    self.receivedFiles = []
+    self.receivedDatasets = dict()
     self.continueObserving = True
     self.observationTimer.stop()
+    self.stopDICOMReceiver()
+    self.backgroundRegistration = None
+    self.templateDetection = None
+    self.reregistration = None
+    # A running registration stops at its next attempt
+    self.registrationCancelEvent.set()
+    self.logic.shutdown()
     if self.nodeAddedObserver: slicer.mrmlScene.RemoveObserver(self.nodeAddedObserver)
     if self.fiducialAddedObserver: slicer.mrmlScene.RemoveObserver(self.fiducialAddedObserver)
     if self.fiducialModifiedObserver: slicer.mrmlScene.RemoveObserver(self.fiducialModifiedObserver)
@@ -131,8 +841,24 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.seriesList = []
     self.loadedFiles = []
     self.filesToBeLoaded = []
+    self.streamingSeries = dict()
+    self.streamingPendingFiles = []
+    self.streamingDecode = None
+    self.streamingRetries = dict()
+    self.speculativeTransforms = dict()
+    self.seriesLoadQueue = []
+    self.seriesLoad = None
+    self.receivedFiles = []
+    self.receivedDatasets = dict()
     self.continueObserving = True
     self.observationTimer.stop()
+    self.stopDICOMReceiver()
+    self.backgroundRegistration = None
+    self.templateDetection = None
+    self.reregistration = None
+    # A running registration stops at its next attempt
+    self.registrationCancelEvent.set()
+    self.logic.shutdown()
     if self.nodeAddedObserver: slicer.mrmlScene.RemoveObserver(self.nodeAddedObserver)
     if self.fiducialAddedObserver: slicer.mrmlScene.RemoveObserver(self.fiducialAddedObserver)
     if self.fiducialModifiedObserver: slicer.mrmlScene.RemoveObserver(self.fiducialModifiedObserver)
@@ -168,6 +894,16 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.initializeButton.connect('clicked()', self.initializeCase)
     initializeLayout.addRow(self.initializeButton)
 
+    reopenFont = qt.QFont()
+    reopenFont.setPointSize(12)
+    reopenFont.setBold(False)
+    self.reopenButton = qt.QPushButton("Reopen Case")
+    self.reopenButton.setFont(reopenFont)
+    self.reopenButton.toolTip = "Reopen an existing case directory from its cached volumes"
+    self.reopenButton.enabled = True
+    self.reopenButton.connect('clicked()', self.onReopenCase)
+    initializeLayout.addRow(self.reopenButton)
+
     self.casesPathBox = qt.QLineEdit(config['START']['cases_path'])
     self.casesPathBox.setReadOnly(True)
     self.casesPathBrowseButton = qt.QPushButton("...")
@@ -180,6 +916,20 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.caseDirLabel = qt.QLabel()
     self.caseDirLabel.text = "Waiting to Initialize Case"
     initializeLayout.addRow("Case Directory: ", self.caseDirLabel)
+
+    # Calibration series are assembled directly from the DICOM slices instead of going through the DICOM database
+    self.fastCalibrationLoad = config['START'].getboolean('fast_calibration_load', fallback=True)
+    # Registration is attempted on calibration series while they are still being received
+    self.streamCalibration = config['START'].getboolean('stream_calibration', fallback=True)
+    # Optional in-process DICOM receiver used instead of the DICOM module listener
+    self.useEmbeddedReceiver = config['START'].getboolean('embedded_receiver', fallback=False)
+    self.receiverPort = config['START'].getint('receiver_port', fallback=11112)
+    self.receiverAETitle = config['START'].get('receiver_ae_title', fallback='PROSTATEBIOPSY')
+    # Scene data is written uncompressed by default so that closing a case does not wait on compression
+    self.compressScene = config.getboolean('SAVE', 'compress_scene', fallback=False)
+    # Timing spans of registration and worksheet generation are written to the case directory as 'chrome' or 'json', or 'off'
+    self.traceFormat = config['GENERAL'].get('trace_format', fallback='chrome')
+    tracer.enabled = self.traceFormat != 'off'
     # -------------------------------------- ----------  --------------------------------------
 
     # ------------------------------------ Image List UI --------------------------------------
@@ -221,6 +971,17 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.registrationButton.connect('clicked()', self.onRegister)
     registrationLayout.addRow(self.registrationButton)
 
+    self.reregistrationButton = qt.QPushButton("Re-register from Current Transform")
+    self.reregistrationButton.toolTip = "Register a new calibration image of a frame that moved by a few millimeters, starting from the current registration"
+    self.reregistrationButton.connect('clicked()', self.onReregister)
+    registrationLayout.addRow(self.reregistrationButton)
+
+    self.cancelRegistrationButton = qt.QPushButton("Cancel Registration")
+    self.cancelRegistrationButton.toolTip = "Stop the registration retries and keep the best transform found so far"
+    self.cancelRegistrationButton.visible = False
+    self.cancelRegistrationButton.connect('clicked()', self.onCancelRegistration)
+    registrationLayout.addRow(self.cancelRegistrationButton)
+
     validRegistrationFont = qt.QFont()
     validRegistrationFont.setPointSize(18)
     validRegistrationFont.setBold(False)
@@ -232,6 +993,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.configFileSelectionBox = qt.QComboBox()
     self.configFileSelectionBox.addItems(['Template 001 - Seven Fiducials', 'Template 002 - Nine Fiducials', 'Template 003 - BRP Robot - Nine Fiducials', 'Template 004 - Wide Z-frame - Seven Fiducials', 'Template 005 - Integrated Z-frame - Seven Fiducials'])
     self.configFileSelectionBox.setCurrentIndex(config['REGISTRATION'].getint('template_index'))
+    self.configFileSelectionBox.currentIndexChanged.connect(lambda index: self.journal('template', index=index))
     registrationLayout.addRow('Template Configuration:', self.configFileSelectionBox)
 
     registrationParametersGroupBox = ctk.ctkCollapsibleGroupBox()
@@ -241,6 +1003,11 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     registrationLayout.addRow(registrationParametersGroupBox)
 
     self.defaultThresholdPercentage = config['REGISTRATION'].getfloat('threshold_percentage')
+    # Threshold the retry ladder starts from and returns to; chosen from the calibration volume histogram when auto_threshold is set
+    self.startingThresholdPercentage = self.defaultThresholdPercentage
+    self.autoThreshold = config['REGISTRATION'].getboolean('auto_threshold', fallback=False)
+    self.useRegistrationHistory = config['REGISTRATION'].getboolean('registration_history', fallback=True)
+    self.registrationAttempts = 0
     self.thresholdSliderWidget = ctk.ctkSliderWidget()
     self.thresholdSliderWidget.setToolTip("Set range for threshold percentage for isolating registration fiducial markers")
     self.thresholdSliderWidget.setDecimals(2)
@@ -285,6 +1052,27 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.retryFailedRegistrationCheckBox.setChecked(config['REGISTRATION'].getboolean('retry_failed'))
     registrationParametersLayout.addRow(self.retryFailedRegistrationCheckBox)
 
+    self.detectTemplateCheckBox = qt.QCheckBox("Detect template configuration from the calibration image")
+    self.detectTemplateCheckBox.setToolTip("Register all template configurations and switch to the one that fits best")
+    self.detectTemplateCheckBox.setChecked(config['REGISTRATION'].getboolean('detect_template', fallback=False))
+    registrationParametersLayout.addRow(self.detectTemplateCheckBox)
+
+    # Registration results are reused when the same calibration volume is registered again with the same parameters
+    self.cacheRegistration = config['REGISTRATION'].getboolean('cache_registration', fallback=True)
+    # 'native' solves the pose from all slab slices at once; 'ransac' from all slices, after rejecting the fiducial points
+    # that are not on a straight line; 'scripted' uses ZFrameRegistrationScripted
+    self.poseSolver = config['REGISTRATION'].get('pose_solver', fallback='scripted')
+    # 'islands' masks the fiducials by 3D island size in the whole volume; 'projection' finds them as blobs of a slab
+    # maximum intensity projection. Only used by the registration on the worker thread.
+    self.fiducialDetector = config['REGISTRATION'].get('fiducial_detector', fallback='islands')
+    self.projectionSlabSlices = config['REGISTRATION'].getint('projection_slab_slices', fallback=10)
+    self.proposeFallbackRegistration = config['REGISTRATION'].getboolean('propose_fallback', fallback=True)
+    self.registerInBackground = config['REGISTRATION'].getboolean('background_registration', fallback=True)
+    # Seconds; 0 lets the retries run until the threshold ladder is exhausted
+    self.registrationTimeBudget = config['REGISTRATION'].getfloat('time_budget', fallback=60)
+    # mm around the fiducials at the current transform that re-registration searches; larger frame motion needs a full registration
+    self.reregistrationNeighbourhood = config['REGISTRATION'].getfloat('reregistration_neighbourhood', fallback=10.0)
+
     self.manualRegistrationGroupBox = ctk.ctkCollapsibleGroupBox()
     self.manualRegistrationGroupBox.title = "Manual Registration"
     self.manualRegistrationGroupBox.collapsed = True
@@ -535,7 +1323,9 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
         self.registrationCollapsibleButton.collapsed = False
         self.planningCollapsibleButton.collapsed = True
 
-        qt.QTimer.singleShot(1000, lambda: self.onRegister())
+        # A case resumed from its journal keeps its registration
+        if not self.validRegistration:
+          qt.QTimer.singleShot(1000, lambda: self.onRegister())
     elif phase == "PLANNING": 
       self.currentPhase = 'PLANNING'
       # self.casesPathBrowseButton.enabled = False
@@ -560,6 +1350,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
         sliceNode.SetFieldOfView(x,y,z)
 
     print(f'Current phase: {self.currentPhase}')
+    self.journal('phase', phase=self.currentPhase)
 
   # ------------------------------------- Connection -------------------------------------
 
@@ -580,30 +1371,156 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     os.mkdir(self.caseDirPath)
     self.caseDirLabel.text = self.caseDirPath
 
+    self.startReceivingImages()
+    self.journal('case', path=self.caseDirPath, template=self.configFileSelectionBox.currentIndex)
+    self.onPhaseChange("REGISTRATION")
+
+  def onReopenCase(self):
+    caseDirPath = qt.QFileDialog.getExistingDirectory(self.parent, "Select Case Directory", self.casesPathBox.text)
+    if caseDirPath:
+      self.reopenCase(caseDirPath)
+
+  def reopenCase(self, caseDirPath):
+    self.caseDirPath = caseDirPath
+    self.caseDirLabel.text = self.caseDirPath
+
+    # Images already in the case directory are mapped in from the cache instead of being imported again
+    self.loadedFiles = self.getFileList(f'{self.caseDirPath}/dicom')
+    self.receivedFiles = list(self.loadedFiles)
+    startTime = time.time()
+    self.loadCachedVolumes()
+    self.caseJournal = CaseJournal(self.caseDirPath)
+    resumedPhase = self.resumeFromJournal()
+    print(f'Case resumed in {time.time() - startTime:.3f} s')
+
+    self.startReceivingImages()
+    self.onPhaseChange(resumedPhase)
+
+  def journal(self, recordType, **values):
+    if self.caseJournal and not self.replayingJournal:
+      self.caseJournal.record(recordType, **values)
+
+  def journalTargets(self):
+    targets = []
+    for index in range(self.biopsyFiducialListNode.GetNumberOfControlPoints()):
+      position = [0, 0, 0]
+      self.biopsyFiducialListNode.GetNthControlPointPosition(index, position)
+      targets.append({'label': self.biopsyFiducialListNode.GetNthControlPointLabel(index), 'position': position})
+    self.journal('targets', targets=targets)
+
+  def resumeFromJournal(self):
+    # Rebuilds the session recorded in the case journal on top of the cached volumes; returns the phase to resume in
+    records = self.caseJournal.read()
+    latestRecords = dict()
+    imageRoles = dict()
+    for record in records:
+      latestRecords[record['type']] = record
+      if record['type'] == 'imageRole':
+        imageRoles[record['name']] = record['role']
+    if not latestRecords:
+      return "REGISTRATION"
+
+    self.replayingJournal = True
+    if 'template' in latestRecords:
+      self.configFileSelectionBox.setCurrentIndex(latestRecords['template']['index'])
+    elif 'case' in latestRecords:
+      self.configFileSelectionBox.setCurrentIndex(latestRecords['case']['template'])
+
+    for index in range(self.imageListTableWidget.rowCount):
+      imageRole = imageRoles.get(self.imageListTableWidget.item(index, 0).text())
+      if imageRole:
+        self.imageListTableWidget.cellWidget(index, 2).setCurrentIndex(self.imageRoles.index(imageRole))
+
+    registration = latestRecords.get('registration')
+    if registration:
+      self.loadTemplateConfiguration()
+      self.ZFrameCalibrationTransformNode.SetMatrixTransformToParent(self.arrayToVtkMatrix(registration['matrix']))
+      self.showTemplateModels(self.ZFrameCalibrationTransformNode)
+      if 'threshold' in registration:
+        self.thresholdSliderWidget.value = registration['threshold']
+      self.validRegistration = registration['valid']
+      if registration['valid'] and registration['manual']:
+        self.validRegistrationLabel.text = "Manual Registration"
+        self.validRegistrationLabel.setStyleSheet("QLabel {background-color: #8fce00}")
+      elif registration['valid']:
+        self.validRegistrationLabel.text = "Registration Successful"
+        self.validRegistrationLabel.setStyleSheet("QLabel {background-color: #1A9A30}")
+
+    if self.validRegistration and 'targets' in latestRecords:
+      for target in latestRecords['targets']['targets']:
+        self.biopsyFiducialListNode.AddControlPoint(vtk.vtkVector3d(*target['position']), target['label'])
+    self.replayingJournal = False
+
+    resumedPhase = latestRecords['phase']['phase'] if 'phase' in latestRecords else "REGISTRATION"
+    if resumedPhase == "PLANNING" and not (self.validRegistration and self.getNodeFromImageRole("PLANNING")):
+      resumedPhase = "REGISTRATION"
+    print(f'Resumed case from {len(records)} journal records')
+    return resumedPhase
+
+  def getTransformArray(self, transformNode):
+    matrix = vtk.vtkMatrix4x4()
+    transformNode.GetMatrixTransformToParent(matrix)
+    return self.vtkMatrixToArray(matrix)
+
+  def vtkMatrixToArray(self, matrix):
+    return np.array([[matrix.GetElement(row, column) for column in range(4)] for row in range(4)])
+
+  def arrayToVtkMatrix(self, array):
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        matrix.SetElement(row, column, array[row][column])
+    return matrix
+
+  def startReceivingImages(self):
+    tracer.clear()
+    self.caseSaveEngine = CaseSaveEngine(self.caseDirPath, self.compressScene)
+    self.caseJournal = CaseJournal(self.caseDirPath)
+
     slicer.util.selectModule('DICOM')
     # Set DICOM Database
     slicer.modules.DICOMWidget.updateDatabaseDirectoryFromWidget(self.caseDirPath)
     # Start Listener
-    slicer.modules.DICOMWidget.onToggleListener(True)
+    if self.useEmbeddedReceiver:
+      self.dicomReceiver = DICOMStoreReceiver(f'{self.caseDirPath}/dicom', self.receiverPort, self.receiverAETitle)
+      self.dicomReceiver.start()
+    else:
+      slicer.modules.DICOMWidget.onToggleListener(True)
     
     slicer.util.selectModule('ProstateTemplateBiopsy')
     self.observationTimer.start()
 
     self.initializeButton.enabled = False
+    self.reopenButton.enabled = False
     self.casesPathBrowseButton.enabled = False
     self.closeCaseButton.enabled = True
 
-    self.onPhaseChange("REGISTRATION")
+  def stopDICOMReceiver(self):
+    if self.dicomReceiver:
+      self.dicomReceiver.stop()
+      self.dicomReceiver = None
 
   def observeDicomFolder(self):
+    if self.dicomReceiver:
+      for filePath, dataset in self.dicomReceiver.takeReceivedDatasets():
+        self.receivedFiles.append(filePath)
+        self.receivedDatasets[filePath] = dataset
     if self.continueObserving:
-      currentFileList = self.getFileList(f'{self.caseDirPath}/dicom')
+      # Instances from the embedded receiver are already known, no need to scan the folder
+      if self.dicomReceiver:
+        currentFileList = self.receivedFiles
+      else:
+        currentFileList = self.getFileList(f'{self.caseDirPath}/dicom')
       # Files still being added
       if (len(self.loadedFiles) + len(self.filesToBeLoaded)) < len(currentFileList):
         print("New files observed")
+        newFiles = []
         for file in currentFileList:
           if (file not in self.loadedFiles) and (file not in self.filesToBeLoaded):
             self.filesToBeLoaded.append(file)
+            newFiles.append(file)
+        if self.streamCalibration:
+          self.updateStreamingCalibration(newFiles)
       # Files no longer being added
       # (len(self.loadedFiles) + len(self.filesToBeLoaded)) >= len(currentFileList)
       else:
@@ -627,12 +1544,388 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     return filenames
   
   def loadSeries(self, newFilesAdded):
-    seriesUIDs = []
+    seriesFiles = dict()
     for file in newFilesAdded:
-      seriesUIDs.append(StepBasedSession.getDICOMValue(file, '0020,000E'))
-    seriesUIDs = list(set(seriesUIDs))
-    loadedNodeIDs = DICOMUtils.loadSeriesByUID(seriesUIDs)
-  
+      seriesFiles.setdefault(self.getDICOMValue(file, '0020,000E'), []).append(file)
+    # Calibration series are loaded right away, planning and other series are queued behind registration
+    for seriesUID, files in seriesFiles.items():
+      imageRole = self.getImageRoleFromDescription(self.getDICOMValue(files[0], '0008,103E'))
+      if imageRole == "CALIBRATION":
+        self.loadSeriesByRole(seriesUID, files, imageRole)
+      else:
+        self.seriesLoadQueue.append((self.seriesLoadPriorities.index(imageRole), seriesUID, files, imageRole))
+    # Stable sort keeps arrival order within the same role
+    self.seriesLoadQueue.sort(key=lambda queuedSeries: queuedSeries[0])
+    if self.seriesLoadQueue:
+      self.scheduleSeriesLoadQueue(0)
+
+  def getDICOMValue(self, file, tag):
+    # Instances from the embedded receiver are still in memory
+    dataset = self.receivedDatasets.get(file)
+    if dataset is None:
+      return StepBasedSession.getDICOMValue(file, tag)
+    group, element = tag.split(',')
+    dataElement = dataset.get(pydicom.tag.Tag(int(group, 16), int(element, 16)))
+    return str(dataElement.value) if dataElement is not None else ''
+
+  def loadSeriesByRole(self, seriesUID, files, imageRole):
+    # Calibration series skip the DICOM database import so that registration can start right away
+    if imageRole == "CALIBRATION" and self.fastCalibrationLoad and self.loadCalibrationSeriesFast(seriesUID, files):
+      self.releaseReceivedDatasets(files)
+      return
+    self.streamingSeries.pop(seriesUID, None)
+    self.loadSeriesFromDatabase(seriesUID, files)
+
+  def loadSeriesFromDatabase(self, seriesUID, files):
+    # Instances from the embedded receiver are not indexed by the DICOM listener; the series is loaded from the database
+    self.archiveSeries(seriesUID, files)
+    if self.dicomIndexer:
+      self.dicomIndexer.waitForImportFinished()
+    loadedNodeIDs = DICOMUtils.loadSeriesByUID([seriesUID])
+    self.releaseReceivedDatasets(files)
+
+  def releaseReceivedDatasets(self, files):
+    for file in files:
+      self.receivedDatasets.pop(file, None)
+
+  def scheduleSeriesLoadQueue(self, delay):
+    # A single drain of the queue is scheduled at a time
+    if self.seriesLoadScheduled:
+      return
+    self.seriesLoadScheduled = True
+    qt.QTimer.singleShot(delay, lambda: self.processSeriesLoadQueue())
+
+  def processSeriesLoadQueue(self):
+    self.seriesLoadScheduled = False
+    # A series being read on the worker thread schedules the next one when it is added
+    if not self.seriesLoadQueue or self.seriesLoad:
+      return
+    # Hold lower priority series back until the pending registration has run, including on the worker thread
+    if self.registrationPending or self.backgroundRegistration or self.templateDetection or self.reregistration:
+      self.scheduleSeriesLoadQueue(500)
+      return
+    priority, seriesUID, files, imageRole = self.seriesLoadQueue.pop(0)
+    print(f'Loading queued {imageRole} series {seriesUID}')
+    if not self.fastCalibrationLoad:
+      self.loadSeriesByRole(seriesUID, files, imageRole)
+      self.scheduleSeriesLoadQueue(0)
+      return
+    # The slices are read and assembled on the worker thread; only the volume node is created on the main thread
+    streamedSlices = self.streamingSeries.pop(seriesUID, dict()).get('slices', dict())
+    future = self.logic.executor.submit(self.readSeries, files, streamedSlices)
+    self.seriesLoad = {'future': future, 'seriesUID': seriesUID, 'files': files, 'imageRole': imageRole, 'startTime': time.time()}
+    qt.QTimer.singleShot(50, lambda: self.pollSeriesLoad())
+
+  def pollSeriesLoad(self):
+    seriesLoad = self.seriesLoad
+    # Cleared when the module is cleaned up or reloaded
+    if not seriesLoad:
+      return
+    if not seriesLoad['future'].done():
+      qt.QTimer.singleShot(50, lambda: self.pollSeriesLoad())
+      return
+    self.seriesLoad = None
+    seriesUID, files = seriesLoad['seriesUID'], seriesLoad['files']
+    try:
+      header, volume = seriesLoad['future'].result()
+    except Exception as e:
+      print(f'Failed to read series {seriesUID}: {e}')
+      header, volume = None, None
+    if volume is None:
+      print(f'Series {seriesUID} could not be assembled directly; loading through DICOM database')
+      self.loadSeriesFromDatabase(seriesUID, files)
+    else:
+      self.addSeriesVolumeNode(seriesUID, files, header, volume)
+      print(f'{seriesLoad["imageRole"]} series loaded directly from {len(volume[2])} slices in {time.time() - seriesLoad["startTime"]:.2f} s')
+    self.releaseReceivedDatasets(files)
+    if self.seriesLoadQueue:
+      self.scheduleSeriesLoadQueue(0)
+
+  def readSeries(self, files, streamedSlices):
+    # Runs on the worker thread; returns the header of the first file and the assembled volume, or None for the volume
+    header = self.readDICOMDataset(files[0], headerOnly=True)
+    return header, self.readSeriesVolume(files, streamedSlices)
+
+  def getImageRoleFromDescription(self, description):
+    # Same keywords used for automatic role assignment in the image list
+    if "template" in description.casefold():
+      return "CALIBRATION"
+    elif "cover" in description.casefold():
+      return "PLANNING"
+    return "N/A"
+
+  def loadCalibrationSeriesFast(self, seriesUID, files):
+    # Returns False if the series should go through the regular DICOM database loading instead
+    try:
+      header = self.readDICOMDataset(files[0], headerOnly=True)
+    except Exception as e:
+      print(f'Failed to read DICOM header from {files[0]}: {e}')
+      return False
+    seriesDescription = str(header.get('SeriesDescription', ''))
+    if self.getImageRoleFromDescription(seriesDescription) != "CALIBRATION":
+      return False
+
+    startTime = time.time()
+    # Slices already decoded while the series was streaming in are reused
+    streamedSlices = self.streamingSeries.pop(seriesUID, dict()).get('slices', dict())
+    volume = self.readSeriesVolume(files, streamedSlices)
+    if volume is None:
+      print(f'Series {seriesUID} could not be assembled directly; loading through DICOM database')
+      return False
+    self.addSeriesVolumeNode(seriesUID, files, header, volume)
+    print(f'Calibration series loaded directly from {len(volume[2])} slices in {time.time() - startTime:.2f} s')
+    return True
+
+  def readSeriesVolume(self, files, streamedSlices=None):
+    # Decodes the slices in parallel; does not touch the scene, so it can run on the worker thread
+    streamedSlices = streamedSlices if streamedSlices else dict()
+    filesToRead = [file for file in files if file not in streamedSlices]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+      slices = [s for s in executor.map(self.readDICOMSlice, filesToRead) if s is not None]
+    slices += [streamedSlices[file] for file in files if file in streamedSlices]
+    return self.assembleDICOMSlices(slices)
+
+  def addSeriesVolumeNode(self, seriesUID, files, header, volume):
+    volumeArray, ijkToRAS, instanceUIDs = volume
+    seriesDescription = str(header.get('SeriesDescription', ''))
+    seriesNumber = header.get('SeriesNumber', None)
+    volumeName = f'{seriesNumber}: {seriesDescription}' if seriesNumber is not None else seriesDescription
+    volumeNode = slicer.vtkMRMLScalarVolumeNode()
+    volumeNode.SetName(slicer.mrmlScene.GenerateUniqueName(volumeName))
+    self.setVolumeNodeFromArray(volumeNode, volumeArray, ijkToRAS)
+    volumeNode.SetAttribute('DICOM.instanceUIDs', ' '.join(instanceUIDs))
+    volumeNode.SetAttribute('DICOM.SeriesInstanceUID', seriesUID)
+    volumeNode.SetAttribute('ProstateTemplateBiopsy.FastLoad', '1')
+    protocol = getProtocolTagsFromDataset(header)
+    if protocol:
+      volumeNode.SetAttribute('ProstateTemplateBiopsy.Protocol', json.dumps(protocol))
+    # Image data and geometry are set before the node is added so that registration can start as soon as it is listed
+    slicer.mrmlScene.AddNode(volumeNode)
+    volumeNode.CreateDefaultDisplayNodes()
+
+    # Database import for archival; the files are parsed in the background
+    self.archiveSeries(seriesUID, files)
+    return volumeNode
+
+  def readDICOMDataset(self, file, headerOnly=False):
+    # Instances from the embedded receiver are used directly instead of being read back from disk
+    dataset = self.receivedDatasets.get(file)
+    if dataset is not None:
+      return dataset
+    return pydicom.dcmread(file, stop_before_pixels=headerOnly)
+
+  def readDICOMSlice(self, file):
+    try:
+      dataset = self.readDICOMDataset(file)
+    except Exception as e:
+      print(f'Failed to read DICOM file {file}: {e}')
+      return None
+    return self.getSliceFromDataset(dataset)
+
+  def getSliceFromDataset(self, dataset):
+    # Multi-frame and non-image objects are left to the DICOM database plugins
+    if int(dataset.get('NumberOfFrames', 1)) > 1 or 'PixelData' not in dataset or 'ImagePositionPatient' not in dataset:
+      return None
+    pixelArray = dataset.pixel_array
+    slope = float(dataset.get('RescaleSlope', 1))
+    intercept = float(dataset.get('RescaleIntercept', 0))
+    if slope != 1 or intercept != 0:
+      pixelArray = pixelArray.astype(np.float32) * slope + intercept
+    return {'position': np.array([float(x) for x in dataset.ImagePositionPatient]),
+            'orientation': np.array([float(x) for x in dataset.ImageOrientationPatient]),
+            'spacing': [float(x) for x in dataset.PixelSpacing],
+            'instanceUID': str(dataset.SOPInstanceUID),
+            'pixels': pixelArray}
+
+  def assembleDICOMSlices(self, slices):
+    # Returns the voxel array (KJI), the IJK to RAS matrix and the ordered instance UIDs, or None if the slices do not form a regular volume
+    if len(slices) < 2:
+      return None
+    orientation = slices[0]['orientation']
+    rowSpacing, columnSpacing = slices[0]['spacing']
+    shape = slices[0]['pixels'].shape
+    for dicomSlice in slices:
+      if not np.allclose(dicomSlice['orientation'], orientation, atol=1e-4) or dicomSlice['pixels'].shape != shape:
+        return None
+    rowDirection = orientation[:3]
+    columnDirection = orientation[3:]
+    sliceNormal = np.cross(rowDirection, columnDirection)
+    slices = sorted(slices, key=lambda s: float(np.dot(s['position'], sliceNormal)))
+    distances = np.array([np.dot(s['position'], sliceNormal) for s in slices])
+    sliceSpacings = np.diff(distances)
+    sliceSpacing = float(np.median(sliceSpacings))
+    if sliceSpacing <= 0 or not np.allclose(sliceSpacings, sliceSpacing, rtol=0.01, atol=0.01):
+      return None
+
+    volumeArray = np.stack([s['pixels'] for s in slices])
+    ijkToLPS = np.eye(4)
+    ijkToLPS[:3, 0] = rowDirection * columnSpacing
+    ijkToLPS[:3, 1] = columnDirection * rowSpacing
+    ijkToLPS[:3, 2] = sliceNormal * sliceSpacing
+    ijkToLPS[:3, 3] = slices[0]['position']
+    ijkToRAS = np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijkToLPS
+    return volumeArray, ijkToRAS, [s['instanceUID'] for s in slices]
+
+  def setVolumeNodeFromArray(self, volumeNode, volumeArray, ijkToRAS):
+    volumeNode.SetIJKToRASMatrix(self.arrayToVtkMatrix(ijkToRAS))
+    slicer.util.updateVolumeFromArray(volumeNode, volumeArray)
+
+  def updateStreamingCalibration(self, newFiles):
+    # Decode calibration slices as they arrive and attempt registration once the central slab is available; only
+    # while a calibration image is awaited, so that later series do not pay for it
+    if self.currentPhase != 'REGISTRATION' or self.validRegistration:
+      return
+    self.streamingPendingFiles += newFiles
+    # Files arriving while a batch is decoded are picked up when it is done
+    if not self.streamingDecode:
+      self.startStreamingDecode()
+
+  def startStreamingDecode(self):
+    filesToRead = self.streamingPendingFiles
+    self.streamingPendingFiles = []
+    if not filesToRead:
+      return
+    # Decoding runs on the worker thread; the main thread only collects the result
+    self.streamingDecode = {'files': filesToRead, 'future': self.logic.executor.submit(self.readStreamingSlices, filesToRead)}
+    qt.QTimer.singleShot(50, lambda: self.pollStreamingDecode())
+
+  def pollStreamingDecode(self):
+    streamingDecode = self.streamingDecode
+    # Cleared when the module is cleaned up or reloaded
+    if not streamingDecode:
+      return
+    if not streamingDecode['future'].done():
+      qt.QTimer.singleShot(50, lambda: self.pollStreamingDecode())
+      return
+    self.streamingDecode = None
+    try:
+      streamedSlices = streamingDecode['future'].result()
+    except Exception as e:
+      print(f'Decoding streamed slices failed: {e}')
+      return
+    maximumRetries = 10
+    retryFiles = []
+    updatedSeriesUIDs = set()
+    for file, (seriesUID, dicomSlice, incomplete) in zip(streamingDecode['files'], streamedSlices):
+      if incomplete:
+        # File is most likely still being written; retried with the next files a limited number of times
+        retries = self.streamingRetries.get(file, 0) + 1
+        self.streamingRetries[file] = retries
+        if retries < maximumRetries:
+          retryFiles.append(file)
+        else:
+          print(f'Streamed file {file} could not be read after {retries} attempts; left to the series loading')
+        continue
+      self.streamingRetries.pop(file, None)
+      if dicomSlice is not None:
+        state = self.streamingSeries.setdefault(seriesUID, {'slices': dict(), 'attemptedSlices': 0})
+        state['slices'][file] = dicomSlice
+        updatedSeriesUIDs.add(seriesUID)
+    for seriesUID in updatedSeriesUIDs:
+      if seriesUID not in self.speculativeTransforms:
+        self.attemptSpeculativeRegistration(seriesUID)
+    # Files received meanwhile are decoded right away; incomplete ones wait for the next observed files
+    self.startStreamingDecode()
+    self.streamingPendingFiles += retryFiles
+
+  def readStreamingSlices(self, files):
+    # Runs on the worker thread
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+      return list(executor.map(self.readStreamingSlice, files))
+
+  def readStreamingSlice(self, file):
+    # Returns the series UID, the decoded slice for calibration series only, and whether the file is still incomplete
+    try:
+      header = self.readDICOMDataset(file, headerOnly=True)
+      seriesUID = str(header.SeriesInstanceUID)
+    except Exception:
+      return None, None, True
+    if self.getImageRoleFromDescription(str(header.get('SeriesDescription', ''))) != "CALIBRATION":
+      return seriesUID, None, False
+    try:
+      return seriesUID, self.getSliceFromDataset(self.readDICOMDataset(file)), False
+    except Exception as e:
+      # Not retried; the series loading reads the file again
+      print(f'Failed to decode streamed slice {file}: {e}')
+      return seriesUID, None, False
+
+  def getContiguousSlices(self, slices):
+    # Longest run of equally spaced slices received so far
+    if len(slices) < 2:
+      return slices
+    orientation = slices[0]['orientation']
+    sliceNormal = np.cross(orientation[:3], orientation[3:])
+    slices = sorted(slices, key=lambda s: float(np.dot(s['position'], sliceNormal)))
+    sliceSpacings = np.diff([np.dot(s['position'], sliceNormal) for s in slices])
+    sliceSpacing = float(np.min(sliceSpacings[sliceSpacings > 0])) if np.any(sliceSpacings > 0) else 0
+    bestStart, bestLength, start = 0, 1, 0
+    for index, spacing in enumerate(sliceSpacings):
+      if not math.isclose(spacing, sliceSpacing, rel_tol=0.01, abs_tol=0.01):
+        start = index + 1
+      elif index + 2 - start > bestLength:
+        bestStart, bestLength = start, index + 2 - start
+    return slices[bestStart:bestStart + bestLength]
+
+  def attemptSpeculativeRegistration(self, seriesUID):
+    state = self.streamingSeries[seriesUID]
+    # One attempt per series at a time; slices arriving meanwhile are picked up by the next one
+    if state.get('future') and not state['future'].done():
+      return
+    contiguousSlices = self.getContiguousSlices(list(state['slices'].values()))
+    # Registration uses centerOfMassSlice +/- 3; wait for margin on both sides and retry only once another slab has arrived
+    slabSlices = 7
+    minimumSlices = slabSlices + 4
+    if len(contiguousSlices) < max(minimumSlices, state['attemptedSlices'] + slabSlices):
+      return
+    volume = self.assembleDICOMSlices(contiguousSlices)
+    if volume is None:
+      return
+    state['attemptedSlices'] = len(contiguousSlices)
+    volumeArray, ijkToRAS, instanceUIDs = volume
+
+    print(f'Attempting registration on {len(contiguousSlices)} received calibration slices')
+    # The fiducials of the selected template are read directly; the template models are loaded by the full registration
+    index = self.configFileSelectionBox.currentIndex
+    fiducials = ProstateTemplateBiopsyLogic.readZFrameFiducials(self.getZFrameConfigFilePath(index))
+    parameters = dataclasses.replace(self.getRegistrationParameters(), zFrameFiducials=tuple(tuple(fiducial) for fiducial in fiducials),
+                                     zframeConfig=f'z{index + 1:03d}', startingThreshold=self.thresholdSliderWidget.value)
+    # Masking and solving run on the worker thread and never touch the scene
+    state['future'] = self.logic.executor.submit(self.logic.registerPartialSeries, volumeArray, ijkToRAS, parameters)
+    qt.QTimer.singleShot(50, lambda: self.pollSpeculativeRegistration(seriesUID, state['future']))
+
+  def pollSpeculativeRegistration(self, seriesUID, future):
+    if not future.done():
+      qt.QTimer.singleShot(50, lambda: self.pollSpeculativeRegistration(seriesUID, future))
+      return
+    try:
+      registration = future.result()
+    except Exception as e:
+      print(f'Registration on partially received calibration series failed: {e}')
+      return
+    if registration and registration['valid']:
+      print("Registration on partially received calibration series succeeded; validating once the series is complete")
+      self.speculativeTransforms[seriesUID] = self.arrayToVtkMatrix(registration['pose'])
+
+  def getSeriesUIDFromVolume(self, volumeNode):
+    seriesUID = volumeNode.GetAttribute('DICOM.SeriesInstanceUID')
+    if seriesUID:
+      return seriesUID
+    instanceUIDs = volumeNode.GetAttribute('DICOM.instanceUIDs')
+    if instanceUIDs and slicer.dicomDatabase:
+      return slicer.dicomDatabase.instanceValue(instanceUIDs.split()[0], '0020,000E')
+    return None
+
+  def archiveSeries(self, seriesUID, files):
+    # Files received by the listener are usually indexed already
+    if not slicer.dicomDatabase or len(slicer.dicomDatabase.filesForSeries(seriesUID)) >= len(files):
+      return
+    # The indexer reads the files on its own thread and only inserts the results into the database on the main thread
+    if not self.dicomIndexer:
+      self.dicomIndexer = ctk.ctkDICOMIndexer()
+      self.dicomIndexer.database = slicer.dicomDatabase
+      self.dicomIndexer.backgroundImportEnabled = True
+    self.dicomIndexer.addListOfFiles(files)
+
   @vtk.calldata_type(vtk.VTK_OBJECT)
   def onNodeAddedEvent(self, caller, event, calldata):
     newNode = calldata
@@ -641,6 +1934,55 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     if (newNode.GetName() in self.ignoredVolumeNames):
       return
     self.addToImageList(newNode)
+    # Cache once loading has finished and any pending registration has started
+    if not newNode.GetAttribute('ProstateTemplateBiopsy.Cached'):
+      qt.QTimer.singleShot(0, lambda: self.cacheVolumeNode(newNode))
+
+  def cacheVolumeNode(self, volumeNode):
+    # Voxels are stored as .npy next to their geometry so that reopening the case can memory-map them
+    if not self.caseDirPath or not self.caseSaveEngine or not volumeNode or not volumeNode.GetScene() or not volumeNode.GetImageData():
+      return
+    cacheDirPath = f'{self.caseDirPath}/cache'
+    os.makedirs(cacheDirPath, exist_ok=True)
+    # Series names are not unique; derived volumes without a series (e.g. the masked volume) replace their previous version
+    cacheName = self.getSeriesUIDFromVolume(volumeNode) or re.sub(r'[^\w-]+', '_', volumeNode.GetName())
+    cachePath = f'{cacheDirPath}/{cacheName}'
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    metadata = {'name': volumeNode.GetName(),
+                'className': volumeNode.GetClassName(),
+                'ijkToRAS': self.vtkMatrixToArray(ijkToRAS).tolist(),
+                'attributes': {name: volumeNode.GetAttribute(name) for name in volumeNode.GetAttributeNames()}}
+    # The voxels are copied so that the volume can change while the worker writes them
+    self.caseSaveEngine.cacheVolume(cachePath, slicer.util.arrayFromVolume(volumeNode).copy(), metadata)
+
+  def loadCachedVolumes(self):
+    for metadataPath in sorted(glob.glob(f'{self.caseDirPath}/cache/*.json'), key=os.path.getmtime):
+      if os.path.exists(metadataPath[:-len('.json')] + '.npy'):
+        self.loadCachedVolume(metadataPath)
+
+  def loadCachedVolume(self, metadataPath):
+    with open(metadataPath, 'r') as f:
+      metadata = json.load(f)
+    # Copy-on-write mapping: VTK uses the file pages directly and the cache is never modified
+    voxels = np.load(metadataPath[:-len('.json')] + '.npy', mmap_mode='c')
+
+    volumeNode = getattr(slicer, metadata['className'])()
+    volumeNode.SetName(metadata['name'])
+    for name, value in metadata['attributes'].items():
+      volumeNode.SetAttribute(name, value)
+    volumeNode.SetAttribute('ProstateTemplateBiopsy.Cached', '1')
+    volumeNode.SetIJKToRASMatrix(self.arrayToVtkMatrix(metadata['ijkToRAS']))
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+    imageData.GetPointData().SetScalars(vtk.util.numpy_support.numpy_to_vtk(voxels.reshape(-1), deep=False))
+    volumeNode.SetAndObserveImageData(imageData)
+
+    self.removeNodeByName(metadata['name'])
+    slicer.mrmlScene.AddNode(volumeNode)
+    volumeNode.CreateDefaultDisplayNodes()
+    return volumeNode
 
   def addToImageList(self, newNode):
     if not self.imageListTableWidget:
@@ -654,6 +1996,8 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     imageRoleChoice = qt.QComboBox()
     imageRoleChoice.addItems(self.imageRoles) # add some options to the combo box
     imageRoleChoice.currentTextChanged.connect(lambda: self.updateImageListRoles(imageRoleChoice.currentText, rowCount))
+    imageRoleChoice.currentTextChanged.connect(lambda: self.journal('imageRole', name=newNode.GetName(), role=imageRoleChoice.currentText,
+                                                                    seriesUID=self.getSeriesUIDFromVolume(newNode)))
 
     self.imageListTableWidget.insertRow(rowCount)
     self.imageListTableWidget.setItem(rowCount, 0, imageName)
@@ -672,7 +2016,8 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
 
   def autoImageRoleAssignment(self, newNode, imageRoleChoice, rowCount):
     name = newNode.GetName()
-    if "template" in name.casefold():
+    imageRole = self.getImageRoleFromDescription(name)
+    if imageRole == "CALIBRATION":
       imageRoleChoice.setCurrentIndex(self.imageRoles.index("CALIBRATION"))
       self.updateImageListRoles(imageRoleChoice.currentText, rowCount)
       if self.currentPhase == "START":
@@ -680,8 +2025,11 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
         pass
       elif self.currentPhase == "REGISTRATION":
         if self.autoCheckBox.isChecked():
-          qt.QTimer.singleShot(1000, lambda: self.onRegister())
-    elif "cover" in name.casefold():
+          self.registrationPending = True
+          # Directly assembled volumes are complete when added, no need to wait for the DICOM plugin to finish
+          registrationDelay = 0 if newNode.GetAttribute('ProstateTemplateBiopsy.FastLoad') else 1000
+          qt.QTimer.singleShot(registrationDelay, lambda: self.onRegister())
+    elif imageRole == "PLANNING":
       imageRoleChoice.setCurrentIndex(self.imageRoles.index("PLANNING"))
       self.updateImageListRoles(imageRoleChoice.currentText, rowCount)
       if self.validRegistration:
@@ -705,16 +2053,335 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
   
   # ------------------------------------- Registration -----------------------------------
 
+  @traced
   def onRegister(self):
-    if not self.getNodeFromImageRole("CALIBRATION"):
+    self.registrationPending = False
+    # A registration already running on the worker thread finishes first
+    if self.backgroundRegistration or self.templateDetection or self.reregistration:
+      return
+    self.registrationResidual = None
+    inputVolume = self.getNodeFromImageRole("CALIBRATION")
+    if not inputVolume:
       return
 
     self.loadTemplateConfiguration()
+    # The budget and the cancel button cover the template detection too
+    self.startRegistrationBudget()
+    if self.detectTemplateCheckBox.isChecked() and inputVolume.GetImageData():
+      self.startTemplateDetection(inputVolume)
+      return
+    self.registerCalibrationVolume(inputVolume)
 
+  @traced
+  def registerCalibrationVolume(self, inputVolume):
+    # The cache key covers the template, so this runs once the template detection has settled it
     result = False
-    result, outputTransform = self.registerZFrame()
+    score = None
+    cacheKey = self.getRegistrationCacheKey(inputVolume)
+    cachedRegistration = self.readCachedRegistration(cacheKey)
+    if cachedRegistration:
+      result, outputTransform = self.applyCachedRegistration(inputVolume, cachedRegistration)
+      score = cachedRegistration.get('score')
+      self.registrationResidual = cachedRegistration.get('residual')
+    elif self.canRegisterInBackground(inputVolume):
+      self.startBackgroundRegistration(inputVolume, cacheKey)
+      return
+    else:
+      result, outputTransform = self.registerZFrame()
+      if result:
+        score = self.storeRegistrationResult(inputVolume, cacheKey, outputTransform)
+    self.finishRegistration(result, outputTransform, score)
+
+  @traced
+  def onReregister(self):
+    # Warm start from the current transform; the full registration runs if there is none or the frame is not found near it
+    if self.backgroundRegistration or self.templateDetection or self.reregistration:
+      return
+    inputVolume = self.getNodeFromImageRole("CALIBRATION")
+    if not inputVolume or not inputVolume.GetImageData():
+      return
+    if not (self.validRegistration and self.ZFrameCalibrationTransformNode):
+      self.onRegister()
+      return
+    self.registrationPending = False
+    self.registrationResidual = None
+    self.loadTemplateConfiguration()
+
+    outputTransform = self.ZFrameCalibrationTransformNode
+    previousPose = self.getTransformArray(outputTransform)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    # The threshold of the previous registration, as the scanner and protocol are the same
+    parameters = dataclasses.replace(self.getRegistrationParameters(), startingThreshold=self.thresholdSliderWidget.value)
+    # The worker gets its own copy of the voxels; the result is applied on the main thread
+    future = self.logic.executor.submit(self.logic.reregister, slicer.util.arrayFromVolume(inputVolume).copy(), self.vtkMatrixToArray(ijkToRAS),
+                                        parameters, previousPose, self.reregistrationNeighbourhood)
+    self.reregistration = {'future': future, 'previousPose': previousPose, 'ijkToRAS': self.vtkMatrixToArray(ijkToRAS)}
+    self.registrationButton.enabled = False
+    self.validRegistrationLabel.text = "Re-registering..."
+    self.validRegistrationLabel.setStyleSheet("")
+    qt.QTimer.singleShot(50, lambda: self.pollReregistration())
+
+  def pollReregistration(self):
+    reregistration = self.reregistration
+    # Cleared when the module is cleaned up or reloaded
+    if not reregistration:
+      return
+    if not reregistration['future'].done():
+      qt.QTimer.singleShot(50, lambda: self.pollReregistration())
+      return
+    self.reregistration = None
+    self.registrationButton.enabled = True
+    try:
+      registration = reregistration['future'].result()
+    except Exception as e:
+      print(f'Re-registration failed: {e}')
+      registration = None
+    outputTransform = self.ZFrameCalibrationTransformNode
+    if not registration or not registration['valid'] or not outputTransform:
+      print('Frame not found near the current transform; registering from scratch')
+      self.onRegister()
+      return
+
+    previousPose = reregistration['previousPose']
+    self.removeNodeByName('MaskedCalibrationVolume')
+    maskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "MaskedCalibrationVolume")
+    self.setVolumeNodeFromArray(maskedVolume, registration['mask'], reregistration['ijkToRAS'])
+    outputTransform.SetMatrixTransformToParent(self.arrayToVtkMatrix(registration['pose']))
+    self.registrationResidual = registration['residual']
+    motion = registration['motion']
+    print(f'Re-registered from the current transform; frame moved {motion["translation"]:.2f} mm and {motion["rotation"]:.2f} degrees')
+    tracer.annotate(reregistration=True, motionTranslation=motion['translation'], motionRotation=motion['rotation'])
+    self.journal('reregistration', previousMatrix=previousPose.tolist(), translation=motion['translation'], rotation=motion['rotation'])
+    self.finishRegistration(True, outputTransform, registration['score'])
+
+  def storeRegistrationResult(self, inputVolume, cacheKey, outputTransform):
+    # Scores a successful registration against the masked volume and records it in the cache and the history
+    score = None
+    maskedVolume = slicer.mrmlScene.GetFirstNodeByName("MaskedCalibrationVolume")
+    if maskedVolume:
+      score = self.scoreRegistrationResult(outputTransform, maskedVolume, self.zFrameFiducials)
+    self.writeCachedRegistration(cacheKey, outputTransform, score)
+    self.recordRegistrationHistory(inputVolume)
+    return score
+
+  def finishRegistration(self, result, outputTransform, score):
     self.increaseThresholdForRetry = False
+    self.registrationDeadline = None
+    self.registrationCancelEvent.clear()
+    self.cancelRegistrationButton.visible = False
+
+    self.showTemplateModels(outputTransform)
+    self.journal('registration', matrix=self.getTransformArray(outputTransform).tolist(), valid=bool(result), manual=False,
+                 threshold=self.thresholdSliderWidget.value, score=score, residual=self.registrationResidual)
 
+    if result:
+      self.onRegistrationSuccess()
+    else:
+      self.onRegistrationFailure()
+    self.exportTrace()
+    # Only describes this registration; a later one started without a budget must not report it
+    self.registrationStopped = None
+
+  def startRegistrationBudget(self):
+    self.registrationStopped = None
+    self.registrationCancelEvent.clear()
+    self.registrationDeadline = time.perf_counter() + self.registrationTimeBudget if self.registrationTimeBudget > 0 else None
+
+  def getRegistrationStopReason(self):
+    # 'timeout' or 'cancelled' once the registration should stop retrying; no budget is set when registerZFrame is called directly
+    stopReason = ProstateTemplateBiopsyLogic.getStopReason(self.registrationDeadline, self.registrationCancelEvent)
+    if stopReason:
+      self.registrationStopped = stopReason
+    return stopReason
+
+  def onCancelRegistration(self):
+    # The worker checks the event between attempts
+    self.registrationCancelEvent.set()
+    self.cancelRegistrationButton.enabled = False
+    self.validRegistrationLabel.text = "Cancelling..."
+
+  def canRegisterInBackground(self, inputVolume):
+    # The logic only has the native pose solvers; a registration started while streaming is re-validated in registerZFrame
+    return (self.registerInBackground and self.poseSolver in ('native', 'ransac') and inputVolume.GetImageData() is not None
+            and self.getSeriesUIDFromVolume(inputVolume) not in self.speculativeTransforms)
+
+  def getRegistrationParameters(self):
+    return RegistrationParameters(
+      zFrameFiducials=tuple(tuple(fiducial) for fiducial in self.zFrameFiducials),
+      zframeConfig=self.zframeConfig,
+      startingThreshold=self.startingThresholdPercentage,
+      minimumSize=self.fiducialSizeSliderWidget.minimumValue,
+      maximumSize=self.fiducialSizeSliderWidget.maximumValue,
+      borderMargin=int(self.borderMarginSliderWidget.value),
+      removeBorderIslands=self.removeBorderIslandsCheckBox.isChecked(),
+      removeOrientation=self.removeOrientationCheckBox.isChecked(),
+      retryFailed=self.retryFailedRegistrationCheckBox.isChecked(),
+      repairFiducials=self.repairFiducialImageCheckBox.isChecked(),
+      minimumThreshold=self.thresholdSliderWidget.minimum,
+      maximumThreshold=self.thresholdSliderWidget.maximum / 5,
+      fiducialDetector=self.fiducialDetector,
+      projectionSlabSlices=self.projectionSlabSlices,
+      poseSolver=self.poseSolver)
+
+  def getZFrameConfigFilePath(self, index):
+    currentFilePath = os.path.dirname(slicer.util.modulePath(self.__module__))
+    return os.path.join(currentFilePath, f'Resources/Templates/template{index + 1:03d}/zframe{index + 1:03d}.txt')
+
+  def startTemplateDetection(self, inputVolume):
+    # Registers all template configurations on the worker thread; the registration continues with the best fitting one
+    threshold = self.selectStartingThreshold(inputVolume)
+    if threshold is None:
+      threshold = self.defaultThresholdPercentage
+    parameters = self.getRegistrationParameters()
+    candidates = dict()
+    for index in range(self.configFileSelectionBox.count):
+      zframeConfig = f'z{index + 1:03d}'
+      fiducials = ProstateTemplateBiopsyLogic.readZFrameFiducials(self.getZFrameConfigFilePath(index))
+      candidates[zframeConfig] = dataclasses.replace(parameters, zFrameFiducials=tuple(tuple(fiducial) for fiducial in fiducials),
+                                                     zframeConfig=zframeConfig)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    volumeArray = slicer.util.arrayFromVolume(inputVolume).copy()
+    future = self.logic.executor.submit(self.logic.detectTemplate, volumeArray, self.vtkMatrixToArray(ijkToRAS), candidates, threshold)
+    self.templateDetection = {'future': future, 'inputVolume': inputVolume}
+    self.registrationButton.enabled = False
+    self.cancelRegistrationButton.enabled = True
+    self.cancelRegistrationButton.visible = True
+    self.validRegistrationLabel.text = "Detecting template..."
+    self.validRegistrationLabel.setStyleSheet("")
+    qt.QTimer.singleShot(50, lambda: self.pollTemplateDetection())
+
+  def pollTemplateDetection(self):
+    templateDetection = self.templateDetection
+    # Cleared when the module is cleaned up or reloaded
+    if not templateDetection:
+      return
+    future = templateDetection['future']
+    if not future.done() and not self.getRegistrationStopReason():
+      qt.QTimer.singleShot(50, lambda: self.pollTemplateDetection())
+      return
+    self.templateDetection = None
+    self.registrationButton.enabled = True
+    if not future.done():
+      # The registration that follows stops after its first attempt
+      print(f'Template detection stopped ({self.registrationStopped}); keeping {self.zframeConfig}')
+    else:
+      try:
+        self.applyDetectedTemplate(*future.result())
+      except Exception as e:
+        print(f'Template detection failed: {e}')
+    self.registerCalibrationVolume(templateDetection['inputVolume'])
+
+  def applyDetectedTemplate(self, best, results):
+    # Switches the template selection and models to the configuration that fits the calibration image best
+    if best is None:
+      print(f'No template has as many fiducials as were found in the calibration image; keeping {self.zframeConfig}')
+      return
+    print('Template detection scores: ' + ', '.join(f'{zframeConfig} {result["score"]:.2f}{" (valid)" if result["valid"] else ""}'
+                                                  for zframeConfig, result in results.items()))
+    # Nothing fits, e.g. the fiducials are not masked at this threshold; the selected template is kept
+    if results[best]['score'] <= 0 or best == self.zframeConfig:
+      return
+    print(f'Template configuration {best} detected; switching from {self.zframeConfig}')
+    # Journaled by the currentIndexChanged connection
+    self.configFileSelectionBox.currentIndex = int(best[1:]) - 1
+    self.loadTemplateConfiguration()
+
+  def startBackgroundRegistration(self, inputVolume, cacheKey):
+    # Same start as registerZFrame: the threshold set by the operator unless one is selected for this image
+    self.startingThresholdPercentage = self.thresholdSliderWidget.value
+    selectedThreshold = self.selectStartingThreshold(inputVolume)
+    if selectedThreshold is not None:
+      self.startingThresholdPercentage = selectedThreshold
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    # The worker gets its own copy of the voxels and never touches the scene or the widgets
+    volumeArray = slicer.util.arrayFromVolume(inputVolume).copy()
+    progress = queue.Queue()
+    future = self.logic.registerInBackground(volumeArray, self.vtkMatrixToArray(ijkToRAS), self.getRegistrationParameters(), progress.put,
+                                             self.registrationDeadline, self.registrationCancelEvent)
+    self.backgroundRegistration = {'future': future, 'progress': progress, 'inputVolume': inputVolume, 'cacheKey': cacheKey,
+                                   'ijkToRAS': self.vtkMatrixToArray(ijkToRAS)}
+    self.registrationButton.enabled = False
+    # Only a registration on the worker thread can be cancelled; the main thread is busy otherwise
+    self.cancelRegistrationButton.enabled = True
+    self.cancelRegistrationButton.visible = True
+    self.validRegistrationLabel.text = "Registering..."
+    self.validRegistrationLabel.setStyleSheet("")
+    qt.QTimer.singleShot(50, lambda: self.pollBackgroundRegistration())
+
+  def pollBackgroundRegistration(self):
+    backgroundRegistration = self.backgroundRegistration
+    # Cleared when the module is cleaned up or reloaded
+    if not backgroundRegistration:
+      return
+    while True:
+      try:
+        attemptProgress = backgroundRegistration['progress'].get_nowait()
+      except queue.Empty:
+        break
+      if not self.registrationCancelEvent.is_set():
+        self.validRegistrationLabel.text = f'Registering... {attemptProgress["strategy"]} attempt {attemptProgress["attempt"]} (threshold {attemptProgress["threshold"]:.2f})'
+    if not backgroundRegistration['future'].done():
+      qt.QTimer.singleShot(50, lambda: self.pollBackgroundRegistration())
+      return
+    self.backgroundRegistration = None
+    self.registrationButton.enabled = True
+    try:
+      registration = backgroundRegistration['future'].result()
+    except Exception as e:
+      print(f'Background registration failed: {e}')
+      registration = None
+    self.onBackgroundRegistrationFinished(backgroundRegistration['inputVolume'], backgroundRegistration['cacheKey'],
+                                          backgroundRegistration['ijkToRAS'], registration)
+
+  @traced
+  def onBackgroundRegistrationFinished(self, inputVolume, cacheKey, ijkToRAS, registration):
+    if not self.ZFrameCalibrationTransformNode:
+      self.removeNodeByName("ZFrameTransform")
+      self.ZFrameCalibrationTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "ZFrameTransform")
+    outputTransform = self.ZFrameCalibrationTransformNode
+    result = False
+    score = None
+    bestMatrix = None
+    if registration:
+      # The mask of the best attempt replaces the masked volume, as for a registration on the main thread
+      self.removeNodeByName('MaskedCalibrationVolume')
+      maskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "MaskedCalibrationVolume")
+      self.setVolumeNodeFromArray(maskedVolume, registration['mask'], ijkToRAS)
+      # Attempts of both strategies, as the main thread ladder counts its repair attempt too
+      self.registrationAttempts = registration['totalAttempts']
+      # Only the final threshold is shown
+      self.thresholdSliderWidget.value = registration['threshold']
+      print(f'Background registration {"succeeded" if registration["valid"] else "failed"} after {registration["totalAttempts"]} attempts')
+      if registration['pose'] is not None:
+        bestMatrix = registration['pose']
+        outputTransform.SetMatrixTransformToParent(self.arrayToVtkMatrix(bestMatrix))
+      if registration['valid']:
+        self.registrationResidual = registration['residual']
+        result = True
+      elif registration['stopped']:
+        print(f'Registration stopped ({registration["stopped"]}); best score {registration["score"]:.2f}')
+        self.registrationStopped = registration['stopped']
+    if not result:
+      self.keepBestTransform(outputTransform, bestMatrix)
+    if result:
+      score = self.storeRegistrationResult(inputVolume, cacheKey, outputTransform)
+    self.finishRegistration(result, outputTransform, score)
+
+  def exportTrace(self):
+    if not self.caseDirPath or self.traceFormat == 'off':
+      return
+    try:
+      if self.traceFormat == 'json':
+        tracer.exportJSON(f'{self.caseDirPath}/trace-spans.json')
+      else:
+        tracer.exportChromeTrace(f'{self.caseDirPath}/trace.json')
+    except OSError as e:
+      print(f'Could not export trace: {e}')
+
+  def showTemplateModels(self, outputTransform):
     if self.zFrameModelNode and self.zFrameModelNode.GetDisplayNode():
       self.zFrameModelNode.SetAndObserveTransformNodeID(outputTransform.GetID())
       self.zFrameModelNode.GetDisplayNode().SetVisibility2D(True)
@@ -745,57 +2412,69 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
       self.guideHoleLabelsModelNode.GetDisplayNode().SetSliceIntersectionThickness(1)
       self.guideHoleLabelsModelNode.SetDisplayVisibility(True)
 
-    if result:
-      self.onRegistrationSuccess()
-    else:
-      self.onRegistrationFailure()
-
-  def registerZFrame(self):
+  @traced
+  def registerZFrame(self, inputVolume=None, outputTransform=None):
     # If there is a zFrame image selected, perform the calibration step to calculate the CLB matrix
-    inputVolume = self.getNodeFromImageRole("CALIBRATION")
+    # The input and output can be given to register volumes other than the case calibration image
+    self.registrationStopped = None
+    if not inputVolume:
+      inputVolume = self.getNodeFromImageRole("CALIBRATION")
 
-    if self.ZFrameCalibrationTransformNode:
-      outputTransform = self.ZFrameCalibrationTransformNode
-    else:
-      self.removeNodeByName("ZFrameTransform")
-      self.ZFrameCalibrationTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "ZFrameTransform")
+    if not outputTransform:
+      if not self.ZFrameCalibrationTransformNode:
+        self.removeNodeByName("ZFrameTransform")
+        self.ZFrameCalibrationTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "ZFrameTransform")
       outputTransform = self.ZFrameCalibrationTransformNode
 
+    self.registrationAttempts = 0
     if not inputVolume:
       return False, outputTransform
+
+    # Re-validate a registration that was attempted while the series was still being received
+    speculativeMatrix = self.speculativeTransforms.pop(self.getSeriesUIDFromVolume(inputVolume), None)
+    if speculativeMatrix is not None:
+      outputTransform.SetMatrixTransformToParent(speculativeMatrix)
+      zFrameMaskedVolume = self.createMaskedVolumeBySize(inputVolume, False)
+      if self.checkRegistrationResult(outputTransform, zFrameMaskedVolume, self.zFrameFiducials):
+        print("Registration from partially received series validated on complete series")
+        return True, outputTransform
+      print("Registration from partially received series not valid on complete series")
+
+    self.startingThresholdPercentage = self.defaultThresholdPercentage
+    selectedThreshold = self.selectStartingThreshold(inputVolume)
+    if selectedThreshold is not None:
+      self.startingThresholdPercentage = selectedThreshold
+      self.thresholdSliderWidget.value = selectedThreshold
     
     # First try without repair methods
     loopRegistration = True
+    attempt = 0
+    bestScore = None
+    bestMatrix = None
     while loopRegistration:
-      zFrameMaskedVolume = self.createMaskedVolumeBySize(inputVolume, False)
-      if zFrameMaskedVolume.GetImageData().GetScalarRange()[1] > 0:
-        # Crop if not 256x256
-        zFrameMaskedVolumeDims = zFrameMaskedVolume.GetImageData().GetDimensions()
-        if zFrameMaskedVolumeDims[0] != 256 and zFrameMaskedVolumeDims[1] != 256:
-          self.cropVolume(zFrameMaskedVolume, 256, 256)
-        
-        centerOfMassSlice = int(self.findCentroidOfVolume(zFrameMaskedVolume)[2])
-
-        # # Run zFrameRegistration CLI module
-        # params = {'inputVolume': zFrameMaskedVolume, 'startSlice': centerOfMassSlice-3, 'endSlice': centerOfMassSlice+3,
-        #           'outputTransform': outputTransform, 'zframeConfig': self.zframeConfig, 'frameTopology': self.frameTopologyString, 
-        #           'zFrameFids': ''}
-        # cliNode = slicer.cli.run(slicer.modules.zframeregistration, None, params, wait_for_completion=True)
-        # if cliNode.GetStatus() & cliNode.ErrorsMask:
-        #   print(cliNode.GetErrorText())
-        
-        # Run zFrameRegistration Scripted module
-        registrationLogic = ZFrameRegistrationScripted.ZFrameRegistrationScriptedLogic()
-        registrationLogic.run(zFrameMaskedVolume, outputTransform, self.zframeConfig, f'{len(self.zFrameFiducials)}-fiducial', self.frameTopologyString, centerOfMassSlice-3, centerOfMassSlice+3)
-
-        if self.removeOrientationCheckBox.isChecked():
-          self.removeOrientationComponent(outputTransform)
-      else:
-        print("Masked volume empty")
-      regResult = self.checkRegistrationResult(outputTransform, zFrameMaskedVolume, self.zFrameFiducials)
+      attempt += 1
+      self.registrationAttempts = attempt
+      tracer.annotate(attempts=attempt)
+      with tracer.span('registrationAttempt', attempt=attempt, threshold=self.thresholdSliderWidget.value, repair=False) as attemptSpan:
+        zFrameMaskedVolume = self.createMaskedVolumeBySize(inputVolume, False)
+        if zFrameMaskedVolume.GetImageData().GetScalarRange()[1] > 0:
+          self.runZFrameRegistration(zFrameMaskedVolume, outputTransform)
+        else:
+          print("Masked volume empty")
+        regResult = self.checkRegistrationResult(outputTransform, zFrameMaskedVolume, self.zFrameFiducials)
+        attemptSpan.args['valid'] = bool(regResult)
       if not regResult:
         # Try to process at different thresholds
         if self.retryFailedRegistrationCheckBox.isChecked():
+          # Keep the best transform so far in case the time budget runs out
+          if zFrameMaskedVolume.GetImageData().GetScalarRange()[1] > 0:
+            score = self.scoreRegistrationResult(outputTransform, zFrameMaskedVolume, self.zFrameFiducials)
+            if bestScore is None or score > bestScore:
+              bestScore, bestMatrix = score, self.getTransformArray(outputTransform)
+          if self.getRegistrationStopReason():
+            print(f'Registration stopped ({self.registrationStopped}) after {attempt} attempts')
+            self.keepBestTransform(outputTransform, bestMatrix)
+            return False, outputTransform
           if not self.increaseThresholdForRetry:
             if not (self.thresholdSliderWidget.value <= self.thresholdSliderWidget.minimum):
               self.thresholdSliderWidget.value = self.thresholdSliderWidget.value - 0.02
@@ -803,7 +2482,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
               loopRegistration = True
             else:
               self.increaseThresholdForRetry = True
-              self.thresholdSliderWidget.value = self.defaultThresholdPercentage + 0.04
+              self.thresholdSliderWidget.value = self.startingThresholdPercentage + 0.04
               print(f'Retrying; increasing threshold percentage to {self.thresholdSliderWidget.value}')
               loopRegistration = True
           else:
@@ -813,7 +2492,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
               loopRegistration = True
             else:
               print("Retries failed; Moving on to repair attempt")
-              self.thresholdSliderWidget.value = self.defaultThresholdPercentage
+              self.thresholdSliderWidget.value = self.startingThresholdPercentage
               loopRegistration = False
         else:
           loopRegistration = False
@@ -821,33 +2500,157 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
         loopRegistration = False
         return True, outputTransform
       
-    if self.repairFiducialImageCheckBox.isChecked():
-      zFrameMaskedVolume = self.createMaskedVolumeBySize(inputVolume, True)
-      if zFrameMaskedVolume.GetImageData().GetScalarRange()[1] > 0:
-        # Crop if not 256x256
-        zFrameMaskedVolumeDims = zFrameMaskedVolume.GetImageData().GetDimensions()
-        # TODO: Pad images smaller than 256 by 256
-        if zFrameMaskedVolumeDims[0] != 256 and zFrameMaskedVolumeDims[1] != 256:
-          self.cropVolume(zFrameMaskedVolume, 256, 256)
-        
-        centerOfMassSlice = int(self.findCentroidOfVolume(zFrameMaskedVolume)[2])
-        # Run zFrameRegistration CLI module
-        params = {'inputVolume': zFrameMaskedVolume, 'startSlice': centerOfMassSlice-3, 'endSlice': centerOfMassSlice+3,
-                  'outputTransform': outputTransform, 'zframeConfig': self.zframeConfig, 'frameTopology': self.frameTopologyString, 
-                  'zFrameFids': ''}
-        cliNode = slicer.cli.run(slicer.modules.zframeregistration, None, params, wait_for_completion=True)
-        if cliNode.GetStatus() & cliNode.ErrorsMask:
-          print(cliNode.GetErrorText())
-        if self.removeOrientationCheckBox.isChecked():
-          self.removeOrientationComponent(outputTransform)
-      else:
-        print("Masked volume empty")
-
-      regResult = self.checkRegistrationResult(outputTransform, zFrameMaskedVolume, self.zFrameFiducials)
+    if self.repairFiducialImageCheckBox.isChecked() and not self.getRegistrationStopReason():
+      regResult = self.repairRegistration(inputVolume, outputTransform)
+      if not regResult:
+        self.keepBestTransform(outputTransform, bestMatrix)
       return regResult, outputTransform
     
+    self.keepBestTransform(outputTransform, bestMatrix)
     return False, outputTransform
+
+  def keepBestTransform(self, outputTransform, bestMatrix):
+    # After the time budget ran out the best scoring transform is kept for review instead of the last attempt
+    if not self.registrationStopped:
+      return
+    if bestMatrix is None:
+      # Nothing to review; the failure is handled like any other
+      self.registrationStopped = None
+      return
+    outputTransform.SetMatrixTransformToParent(self.arrayToVtkMatrix(bestMatrix))
+
+  def repairRegistration(self, inputVolume, outputTransform):
+    # Last attempt after the retries, with the fiducial count and repair done while masking
+    self.registrationAttempts += 1
+    tracer.annotate(attempts=self.registrationAttempts)
+    zFrameMaskedVolume = self.createMaskedVolumeBySize(inputVolume, True)
+    if zFrameMaskedVolume.GetImageData().GetScalarRange()[1] > 0:
+      # Same in-process registration as the first attempts, rather than the zFrameRegistration CLI module
+      self.runZFrameRegistration(zFrameMaskedVolume, outputTransform)
+    else:
+      print("Masked volume empty")
+
+    return self.checkRegistrationResult(outputTransform, zFrameMaskedVolume, self.zFrameFiducials)
   
+  def selectStartingThreshold(self, inputVolume):
+    # Threshold that registered most earlier images of the same protocol, otherwise the one chosen from the histogram
+    if not inputVolume.GetImageData():
+      return None
+    threshold = self.getHistoricalThreshold(inputVolume)
+    method = 'history'
+    # Kept within the range the retry ladder steps through
+    thresholdRange = (self.thresholdSliderWidget.minimum + 0.01, self.thresholdSliderWidget.maximum / 5)
+    if threshold is None and self.autoThreshold:
+      threshold, details = selectThresholdPercentage(slicer.util.arrayFromVolume(inputVolume), len(self.zFrameFiducials),
+                                                     self.fiducialSizeSliderWidget.minimumValue, self.fiducialSizeSliderWidget.maximumValue,
+                                                     thresholdRange=thresholdRange)
+      method = details.get('method')
+    if threshold is None:
+      return None
+    threshold = round(min(max(threshold, thresholdRange[0]), thresholdRange[1]), 2)
+    print(f'Starting threshold percentage {threshold} selected by {method} threshold')
+    tracer.annotate(startingThreshold=threshold, thresholdMethod=method)
+    return threshold
+
+  def getRegistrationHistory(self):
+    if not self.useRegistrationHistory or not self.casesPathBox.text:
+      return None
+    try:
+      return RegistrationHistory(os.path.join(self.casesPathBox.text, '.registration-history.sqlite'))
+    except sqlite3.Error as e:
+      print(f'Could not open registration history: {e}')
+      return None
+
+  def getProtocolTags(self, volumeNode):
+    # Calibration images loaded directly keep the tags read from their header; others are looked up in the DICOM database
+    protocol = volumeNode.GetAttribute('ProstateTemplateBiopsy.Protocol')
+    if protocol:
+      return json.loads(protocol)
+    instanceUIDs = volumeNode.GetAttribute('DICOM.instanceUIDs')
+    if not instanceUIDs or not slicer.dicomDatabase:
+      return None
+    protocol = {name: slicer.dicomDatabase.instanceValue(instanceUIDs.split()[0], tag) for name, tag in PROTOCOL_TAGS.items()}
+    return protocol if any(protocol.values()) else None
+
+  def getHistoricalThreshold(self, inputVolume):
+    protocol = self.getProtocolTags(inputVolume)
+    history = self.getRegistrationHistory() if protocol else None
+    if not history:
+      return None
+    try:
+      return history.bestThreshold(self.zframeConfig, protocol)
+    except sqlite3.Error as e:
+      print(f'Could not read registration history: {e}')
+      return None
+
+  def recordRegistrationHistory(self, inputVolume):
+    protocol = self.getProtocolTags(inputVolume)
+    history = self.getRegistrationHistory() if protocol else None
+    if not history:
+      return
+    try:
+      history.record(self.zframeConfig, protocol, self.thresholdSliderWidget.value, self.fiducialSizeSliderWidget.minimumValue,
+                     self.fiducialSizeSliderWidget.maximumValue, self.registrationAttempts, self.registrationResidual)
+    except sqlite3.Error as e:
+      print(f'Could not record registration history: {e}')
+
+  def runZFrameRegistration(self, zFrameMaskedVolume, outputTransform):
+    # Crop if not 256x256
+    zFrameMaskedVolumeDims = zFrameMaskedVolume.GetImageData().GetDimensions()
+    # TODO: Pad images smaller than 256 by 256
+    if zFrameMaskedVolumeDims[0] != 256 and zFrameMaskedVolumeDims[1] != 256:
+      self.cropVolume(zFrameMaskedVolume, 256, 256)
+    
+    centerOfMassSlice = int(self.findCentroidOfVolume(zFrameMaskedVolume)[2])
+
+    self.registrationResidual = None
+    if self.poseSolver in ('native', 'ransac'):
+      solution = self.solveZFramePose(zFrameMaskedVolume, centerOfMassSlice)
+      if solution:
+        outputTransform.SetMatrixTransformToParent(self.arrayToVtkMatrix(solution['pose']))
+        self.registrationResidual = solution['residual']
+        print(f'Pose solved from {solution["inliers"]}/{solution["points"]} fiducial points; residual {solution["residual"]:.2f} mm')
+        if self.removeOrientationCheckBox.isChecked():
+          self.removeOrientationComponent(outputTransform)
+        return
+      print("Native pose solver failed; using ZFrameRegistrationScripted")
+
+    # # Run zFrameRegistration CLI module
+    # params = {'inputVolume': zFrameMaskedVolume, 'startSlice': centerOfMassSlice-3, 'endSlice': centerOfMassSlice+3,
+    #           'outputTransform': outputTransform, 'zframeConfig': self.zframeConfig, 'frameTopology': self.frameTopologyString, 
+    #           'zFrameFids': ''}
+    # cliNode = slicer.cli.run(slicer.modules.zframeregistration, None, params, wait_for_completion=True)
+    # if cliNode.GetStatus() & cliNode.ErrorsMask:
+    #   print(cliNode.GetErrorText())
+    
+    # Run zFrameRegistration Scripted module
+    registrationLogic = ZFrameRegistrationScripted.ZFrameRegistrationScriptedLogic()
+    with tracer.span('ZFrameRegistrationScriptedLogic.run', startSlice=centerOfMassSlice-3, endSlice=centerOfMassSlice+3):
+      registrationLogic.run(zFrameMaskedVolume, outputTransform, self.zframeConfig, f'{len(self.zFrameFiducials)}-fiducial', self.frameTopologyString, centerOfMassSlice-3, centerOfMassSlice+3)
+
+    if self.removeOrientationCheckBox.isChecked():
+      self.removeOrientationComponent(outputTransform)
+
+  def getArrayToRAS(self, volumeNode):
+    # Array indices start at the (possibly cropped) extent of the image data
+    extent = volumeNode.GetImageData().GetExtent()
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    extentOffset = np.eye(4)
+    extentOffset[0:3, 3] = [extent[0], extent[2], extent[4]]
+    return self.vtkMatrixToArray(ijkToRAS) @ extentOffset
+
+  def solveZFramePose(self, zFrameMaskedVolume, centerOfMassSlice, slabSlices=3):
+    arrayToRAS = self.getArrayToRAS(zFrameMaskedVolume)
+    solver = ZFramePoseSolver(self.zFrameFiducials)
+    fitLines = self.poseSolver == 'ransac'
+    sliceRange = None if fitLines else (centerOfMassSlice - slabSlices, centerOfMassSlice + slabSlices)
+    with tracer.span('ZFramePoseSolver.solve', sliceRange=sliceRange, fitLines=fitLines) as span:
+      solution = solver.solve(slicer.util.arrayFromVolume(zFrameMaskedVolume), arrayToRAS, sliceRange, fitLines=fitLines)
+      if solution:
+        span.args.update(residual=solution['residual'], inliers=solution['inliers'], points=solution['points'])
+    return solution
+
   def removeOrientationComponent(self, transformNode):
     # Get the transformation matrix
     matrix = vtk.vtkMatrix4x4()
@@ -884,9 +2687,14 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.focusSliceWindowsOnVolume(inputVolume)
     self.validRegistration = True
     self.validRegistrationLabel.text= "Registration Successful"
+    if self.registrationResidual is not None:
+      self.validRegistrationLabel.text = f'Registration Successful (residual {self.registrationResidual:.2f} mm)'
     self.validRegistrationLabel.setStyleSheet("QLabel {background-color: #1A9A30}")
 
     self.displayRegistrationVolume()
+    self.cacheVolumeNode(slicer.mrmlScene.GetFirstNodeByName("MaskedCalibrationVolume"))
+    if self.caseSaveEngine:
+      self.caseSaveEngine.checkpoint()
 
     if self.getNodeFromImageRole("PLANNING"):
       self.onPhaseChange("PLANNING")
@@ -901,9 +2709,38 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.validRegistration = False
     self.validRegistrationLabel.text= "Registration Failed"
     self.validRegistrationLabel.setStyleSheet("QLabel {background-color: #660000}")
+
+    if self.registrationStopped:
+      reason = "Cancelled" if self.registrationStopped == 'cancelled' else "Timed Out"
+      self.validRegistrationLabel.text = f'Registration {reason} - Review Best Transform'
+    elif self.proposeFallbackRegistration and self.proposeRegistration(inputVolume):
+      self.validRegistrationLabel.text = "Registration Failed - Review Proposed Transform"
+
+  @traced
+  def proposeRegistration(self, inputVolume):
+    # Searches pose space against the masked fiducials so that manual registration starts from a close transform
+    maskedVolume = slicer.mrmlScene.GetFirstNodeByName("MaskedCalibrationVolume")
+    if maskedVolume and maskedVolume.GetImageData() and maskedVolume.GetImageData().GetScalarRange()[1] > 0:
+      maskArray = slicer.util.arrayFromVolume(maskedVolume)
+      arrayToRAS = self.getArrayToRAS(maskedVolume)
+    elif inputVolume and inputVolume.GetImageData():
+      inputArray = slicer.util.arrayFromVolume(inputVolume)
+      scalarRange = inputVolume.GetImageData().GetScalarRange()
+      maskArray = inputArray > scalarRange[0] + (scalarRange[1] - scalarRange[0]) * self.defaultThresholdPercentage
+      arrayToRAS = self.getArrayToRAS(inputVolume)
+    else:
+      return False
+    proposal = ZFramePoseSearch(maskArray, arrayToRAS, self.zFrameFiducials).search()
+    if not proposal:
+      return False
+    print(f'Proposed registration from {proposal["evaluations"]} evaluated poses; mean distance {proposal["score"]:.2f} mm')
+    self.ZFrameCalibrationTransformNode.SetMatrixTransformToParent(self.arrayToVtkMatrix(proposal['pose']))
+    self.showTemplateModels(self.ZFrameCalibrationTransformNode)
+    return True
   
   def onUseManualRegistration(self):
     print("Manual Registration Accepted")
+    self.journal('registration', matrix=self.getTransformArray(self.ZFrameCalibrationTransformNode).tolist(), valid=True, manual=True)
 
     self.validRegistration = True
     self.validRegistrationLabel.text= "Manual Registration"
@@ -912,6 +2749,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     if self.getNodeFromImageRole("PLANNING"):
       self.onPhaseChange("PLANNING")
   
+  @traced
   def checkRegistrationResult(self, outputTransform, fiducialVolume, zFrameFiducials):
     # Check the midpoint of each ZFrame fiducial and some points around it for a detected fiducial
     zFrameMidpoints = []
@@ -950,6 +2788,100 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
         return False
     return True
 
+  def scoreRegistrationResult(self, outputTransform, fiducialVolume, zFrameFiducials, samplesPerFiducial=21):
+    # Symmetric coverage of the detected fiducial voxels by the zFrame fiducials
+    return self.logic.scorePose(self.getTransformArray(outputTransform), slicer.util.arrayFromVolume(fiducialVolume),
+                                self.getArrayToRAS(fiducialVolume), zFrameFiducials, samplesPerFiducial)
+
+  def getRegistrationCacheDirectory(self):
+    if not self.cacheRegistration or not self.casesPathBox.text:
+      return None
+    return os.path.join(self.casesPathBox.text, '.registration-cache')
+
+  def getRegistrationCacheKey(self, inputVolume):
+    if not inputVolume or not inputVolume.GetImageData() or not self.getRegistrationCacheDirectory():
+      return None
+    # Key covers the voxel data and geometry of the calibration volume, the template and the masking parameters
+    key = hashlib.sha1()
+    volumeArray = np.ascontiguousarray(slicer.util.arrayFromVolume(inputVolume))
+    key.update(str((volumeArray.shape, volumeArray.dtype.str)).encode())
+    key.update(volumeArray.tobytes())
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    parameters = {
+      'ijkToRAS': self.vtkMatrixToArray(ijkToRAS).round(6).tolist(),
+      'zframeConfig': self.zframeConfig,
+      'zFrameFiducials': self.zFrameFiducials,
+      'frameTopology': self.frameTopologyString,
+      # Without a histogram threshold the slider value is used whenever the history has no match
+      'threshold': 'auto' if self.autoThreshold else round(self.thresholdSliderWidget.value, 4),
+      'fiducialSize': [self.fiducialSizeSliderWidget.minimumValue, self.fiducialSizeSliderWidget.maximumValue],
+      'borderMargin': self.borderMarginSliderWidget.value,
+      'removeOrientation': self.removeOrientationCheckBox.isChecked(),
+      'removeBorderIslands': self.removeBorderIslandsCheckBox.isChecked(),
+      'repairFiducials': self.repairFiducialImageCheckBox.isChecked(),
+      'retryFailed': self.retryFailedRegistrationCheckBox.isChecked(),
+      'poseSolver': self.poseSolver,
+      'fiducialDetector': self.fiducialDetector,
+      'projectionSlabSlices': self.projectionSlabSlices,
+    }
+    key.update(json.dumps(parameters, sort_keys=True).encode())
+    return key.hexdigest()
+
+  def readCachedRegistration(self, cacheKey):
+    if not cacheKey:
+      return None
+    cachePath = os.path.join(self.getRegistrationCacheDirectory(), cacheKey + '.json')
+    if not os.path.exists(cachePath):
+      return None
+    try:
+      with open(cachePath, 'r') as f:
+        cachedRegistration = json.load(f)
+    except (OSError, ValueError) as e:
+      print(f'Could not read cached registration: {e}')
+      return None
+    print(f'Using cached registration {cacheKey}')
+    return cachedRegistration
+
+  def writeCachedRegistration(self, cacheKey, outputTransform, score):
+    if not cacheKey:
+      return
+    cacheDirectory = self.getRegistrationCacheDirectory()
+    cachedRegistration = {
+      'matrix': self.getTransformArray(outputTransform).tolist(),
+      'threshold': self.thresholdSliderWidget.value,
+      'score': score,
+      'residual': self.registrationResidual,
+      'zframeConfig': self.zframeConfig,
+      'created': datetime.datetime.now().isoformat(),
+    }
+    try:
+      os.makedirs(cacheDirectory, exist_ok=True)
+      cachePath = os.path.join(cacheDirectory, cacheKey + '.json')
+      with open(cachePath + '.part', 'w') as f:
+        json.dump(cachedRegistration, f)
+      os.replace(cachePath + '.part', cachePath)
+    except OSError as e:
+      print(f'Could not write cached registration: {e}')
+
+  def applyCachedRegistration(self, inputVolume, cachedRegistration):
+    if not self.ZFrameCalibrationTransformNode:
+      self.removeNodeByName("ZFrameTransform")
+      self.ZFrameCalibrationTransformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "ZFrameTransform")
+    outputTransform = self.ZFrameCalibrationTransformNode
+    outputTransform.SetMatrixTransformToParent(self.arrayToVtkMatrix(np.array(cachedRegistration['matrix'])))
+    # The masked volume is rebuilt at the cached threshold so that it is displayed and cached for this series,
+    # not the one left from a previous registration
+    self.thresholdSliderWidget.value = cachedRegistration['threshold']
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    mask = self.logic.createFiducialMask(slicer.util.arrayFromVolume(inputVolume), cachedRegistration['threshold'],
+                                         self.getRegistrationParameters())
+    self.removeNodeByName('MaskedCalibrationVolume')
+    maskedVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "MaskedCalibrationVolume")
+    self.setVolumeNodeFromArray(maskedVolume, mask, self.vtkMatrixToArray(ijkToRAS))
+    return True, outputTransform
+
   def displayRegistrationVolume(self):
     volumeNode = slicer.mrmlScene.GetFirstNodeByName("MaskedCalibrationVolume")
     if not volumeNode:
@@ -1093,6 +3025,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
 
     self.loadTemplateModels(ZFRAME_MODEL_PATH,'ZFrameModel',TEMPLATE_MODEL_PATH,'TemplateModel',CALIBRATOR_MODEL_PATH,'CalibratorModel',GUIDEHOLES_MODEL_PATH,'GuideHolesModel',GUIDEHOLELABELS_MODEL_PATH,'GuideHoleLabelsModel')
 
+  @traced
   def loadTemplateModels(self, ZFRAME_MODEL_PATH, ZFRAME_MODEL_NAME, TEMPLATE_MODEL_PATH, TEMPLATE_MODEL_NAME, CALIBRATOR_MODEL_PATH, CALIBRATOR_MODEL_NAME, GUIDEHOLES_MODEL_PATH, GUIDEHOLES_MODEL_NAME,  GUIDEHOLELABELS_MODEL_PATH, GUIDEHOLELABELS_MODEL_NAME):
     currentFilePath = os.path.dirname(slicer.util.modulePath(self.__module__))
 
@@ -1170,13 +3103,16 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
       modelDisplayNode.SetSliceIntersectionOpacity(0.75)
       self.guideHoleLabelsModelNode.SetDisplayVisibility(True)
 
+  @traced
   def createMaskedVolumeBySize(self, inputVolume, repair):
     loopRegistration = True
+    thresholds = []
     while loopRegistration:
       thresholdPercent = self.thresholdSliderWidget.value 
+      thresholds.append(thresholdPercent)
+      tracer.annotate(thresholds=thresholds)
       minimumSize = self.fiducialSizeSliderWidget.minimumValue
       maximumSize = self.fiducialSizeSliderWidget.maximumValue
-      zframeConfig = self.zframeConfig
 
       # Create segmentation node
       segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
@@ -1264,13 +3200,15 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
             effect = segmentEditorWidget.activeEffect()
             effect.setParameter("Operation", "REMOVE_SELECTED_ISLAND")
             self.removeSelectedIsland(effect, [indices[0][2], indices[0][1], indices[0][0]])
+            tracer.increment('borderIslandsRemoved')
 
      
 
       # Export segmentation to label map
       self.removeNodeByName('MaskedCalibrationLabelMapVolume')
       labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", "MaskedCalibrationLabelMapVolume")
-      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, labelMapVolumeNode, inputVolume)
+      with tracer.span('exportLabelmap'):
+        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, labelMapVolumeNode, inputVolume)
 
        # Clean up
       segmentEditorWidget.setActiveEffectByName("No editing")
@@ -1279,12 +3217,11 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
       slicer.mrmlScene.RemoveNode(segmentationNode)
       slicer.mrmlScene.RemoveNode(segmentEditorNode)
 
-      # Count number of Islands and attempt repair if one is missing
-      # Does not support 9 fiducial frame
+      # Predict the fiducials from the frame geometry and draw missing ones
       if repair:
-        if not zframeConfig == 'z003':
-          loopRegistration = self.countAndRepairFiducials(labelMapVolumeNode)
-        else: 
+        loopRegistration = self.countAndRepairFiducials(labelMapVolumeNode)
+        if loopRegistration and self.getRegistrationStopReason():
+          print(f'Fiducial repair stopped ({self.registrationStopped})')
           loopRegistration = False
       else:
         loopRegistration = False
@@ -1368,203 +3305,41 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     except IndexError:
       print("Island processing failed")
 
+  @traced
   def countAndRepairFiducials(self, labelMapVolumeNode):
     # Returns False if redoing registration with different parameters
-    if labelMapVolumeNode.GetImageData().GetScalarRange()[1] == 0:
-      numberOfSegments = 0
-    else:
-      segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-      segmentationNode.CreateDefaultDisplayNodes()
-      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelMapVolumeNode, segmentationNode)
-
-      segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-      segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-      segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-      segmentEditorNode.SetOverwriteMode(slicer.vtkMRMLSegmentEditorNode.OverwriteNone)
-      segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
-      segmentEditorWidget.setSegmentationNode(segmentationNode)
-      segmentEditorWidget.setSourceVolumeNode(labelMapVolumeNode)
-
-      segmentEditorWidget.setActiveEffectByName("Islands")
-      effect = segmentEditorWidget.activeEffect()
-      effect.setParameter("Operation", "SPLIT_ISLANDS_TO_SEGMENTS")
-      effect.setParameter("MinimumSize", 0)
-      effect.self().onApply()
-
-      numberOfSegments = segmentationNode.GetSegmentation().GetNumberOfSegments()
-
-      # Cleanup
-      segmentEditorWidget.setActiveEffectByName("No editing")
-      slicer.mrmlScene.RemoveNode(segmentationNode)
-      slicer.mrmlScene.RemoveNode(segmentEditorNode)
-      segmentEditorWidget.deleteLater()
-      segmentEditorWidget = None
-
-    # Attempt repair
-    result = ""
-    print(f'Segments detected: {numberOfSegments}')
-
-    if numberOfSegments > 0:
-      # Determine if the image is salvageable
-      # Isolate middle slice
+    result = "anomaly"
+    if labelMapVolumeNode.GetImageData().GetScalarRange()[1] > 0:
       imageData = labelMapVolumeNode.GetImageData()
-      centroid = self.findCentroidOfVolume(labelMapVolumeNode)
-      middleSlice = int(centroid[2])
       dims = imageData.GetDimensions()
       numpy_array = vtk.util.numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars())
-      numpy_array = numpy_array.reshape(dims[2], dims[1], dims[0])
-      numpy_array = numpy_array.transpose(2,1,0)
-      slice_array = numpy_array[:, :, middleSlice]
-
-      # Calculate bounding box to see if the dimensions are about right and that there are only 1-2 missing fiducials
-      rangeNumber = 15 # how much wiggle room to allow for bounding box
-      leftColumn, rightColumn, topRow, bottomRow = self.calculateBoundingBox(slice_array)
-      width = (rightColumn - leftColumn) * labelMapVolumeNode.GetSpacing()[0]
-      height = (bottomRow - topRow) * labelMapVolumeNode.GetSpacing()[1]
-      # print(f'leftColumn {leftColumn}')
-      # print(f'rightColumn {rightColumn}')
-      # print(f'topRow {topRow}')
-      # print(f'bottomRow {bottomRow}')
-      expectedWidth = abs(self.frameTopology[0][0] - self.frameTopology[2][0])
-      expectedHeight = abs(self.frameTopology[0][1] - self.frameTopology[2][1])
-      widthCorrect = (expectedWidth - rangeNumber) <= width <= (expectedWidth + rangeNumber)
-      heightCorrect = (expectedWidth - rangeNumber) <= width <= (expectedWidth + rangeNumber)
-
-      if numberOfSegments == 7:
-        if widthCorrect and heightCorrect:
-          print("7 fiducials detected; bounding box dimensions correct")
-          return False
-        else:
-          print("7 fiducials detected; however, bounding box dimensions are wrong")
-      if (numberOfSegments == 6 or numberOfSegments == 5) and widthCorrect and heightCorrect:
-        print("5-6 fiducials detected; bounding box dimensions correct; trying to repair")
-        result = self.repairMissingFiducial(slice_array, numpy_array, leftColumn, rightColumn, topRow, bottomRow, middleSlice, labelMapVolumeNode)
-        if result == "success":
-          return False
+      numpy_array = numpy_array.reshape(dims[2], dims[1], dims[0]).copy()
+      result = self.logic.predictMissingFiducials(numpy_array, self.getArrayToRAS(labelMapVolumeNode), self.getRegistrationParameters())
+      if result == "success":
+        labelMapVolumeNode.SetAndObserveImageData(self.numpy_to_vtk_image_data(numpy_array.transpose(2, 1, 0)))
+      if result in ["accepted", "success"]:
+        return False
     if not self.increaseThresholdForRepair:
       if not (self.thresholdSliderWidget.value <= self.thresholdSliderWidget.minimum):
         self.thresholdSliderWidget.value = self.thresholdSliderWidget.value - 0.01
-        print(f'Less than 6 or more than 7 fiducials detected; decreasing threshold percentage to {self.thresholdSliderWidget.value}')
+        print(f'Fiducials could not be repaired; decreasing threshold percentage to {self.thresholdSliderWidget.value}')
         return True
       else:
         self.increaseThresholdForRepair = True
-        self.thresholdSliderWidget.value = self.defaultThresholdPercentage + 0.02
+        self.thresholdSliderWidget.value = self.startingThresholdPercentage + 0.02
         print(f'Switching to increasing to {self.thresholdSliderWidget.value}')
         return True
     else:
       # Try again with the assumption that the thresholding was too lenient
       if not (self.thresholdSliderWidget.value >= (self.thresholdSliderWidget.maximum/5)):
         self.thresholdSliderWidget.value = self.thresholdSliderWidget.value + 0.02
-        print(f'Less than 6 or more than 7 fiducials detected; increasing threshold percentage to {self.thresholdSliderWidget.value}')
+        print(f'Fiducials could not be repaired; increasing threshold percentage to {self.thresholdSliderWidget.value}')
         return True
       else:
         print("Fiducial repair failed")
-        self.thresholdSliderWidget.value = self.defaultThresholdPercentage
+        self.thresholdSliderWidget.value = self.startingThresholdPercentage
         return False
 
-  def calculateBoundingBox(self, slice_array):
-    leftColumn = 0
-    rightColumn = slice_array.shape[0]
-    topRow = 0
-    bottomRow = slice_array.shape[1]
-    for row in range(0, slice_array.shape[0]):
-      if np.any(slice_array[row,:] > 0):
-        leftColumn = row
-        break
-    for row in range(slice_array.shape[0]-1, -1, -1):
-      if np.any(slice_array[row,:] > 0):
-        rightColumn = row
-        break
-    for column in range(0, slice_array.shape[1]):
-      if np.any(slice_array[:,column] > 0):
-        topRow = column
-        break
-    for column in range(slice_array.shape[1]-1, -1, -1):
-      if np.any(slice_array[:,column] > 0):
-        bottomRow = column
-        break
-    return leftColumn, rightColumn, topRow, bottomRow
-
-  def repairMissingFiducial(self, slice_array, numpy_array, leftColumn, rightColumn, topRow, bottomRow, middleSlice, labelMapVolumeNode):
-    # Identify missing fiducial
-    # Shrink margins of image
-    cropped = slice_array[leftColumn:rightColumn, topRow:bottomRow]
-
-    # Probe array for values to look for missing value
-    missingFiducial = 0
-    r = 10
-    thickness = 8
-    adjust = 4
-    length = 4
-    diagLength = int(math.sqrt(length**2 + length**2))
-    # Corners
-    # Top Left
-    if not np.any(cropped[0:r, 0:r] > 0):
-      print("Attempting repair of top left fiducial")
-      startLine = (leftColumn + adjust, topRow + adjust, middleSlice - (length//2))
-      endLine = (leftColumn + adjust, topRow + adjust, middleSlice + (length//2))
-      numpy_array = self.drawThickLine(startLine, endLine, thickness, numpy_array)
-      missingFiducial += 1
-    # Top Right
-    if not np.any(cropped[cropped.shape[0]-r:cropped.shape[0],0:r] > 0):
-      print("Attempting repair of top right fiducial")
-      startLine = (leftColumn + cropped.shape[0] - adjust, topRow + adjust, middleSlice - (length//2))
-      endLine = (leftColumn + cropped.shape[0] - adjust, topRow + adjust, middleSlice + (length//2))
-      numpy_array = self.drawThickLine(startLine, endLine, thickness, numpy_array)
-      missingFiducial += 1
-    # Bottom Left
-    if not np.any(cropped[0:r,cropped.shape[1]-r:cropped.shape[1]] > 0):
-      print("Attempting repair of bottom left fiducial")
-      startLine = (leftColumn + adjust, topRow + cropped.shape[1] - adjust, middleSlice - (length//2))
-      endLine = (leftColumn + adjust, topRow + cropped.shape[1] - adjust, middleSlice + (length//2))
-      numpy_array = self.drawThickLine(startLine, endLine, thickness, numpy_array)
-      missingFiducial += 1
-    # Bottom Right
-    if not np.any(cropped[cropped.shape[0]-r:cropped.shape[0],cropped.shape[1]-r:cropped.shape[1]] > 0):
-      print("Attempting repair of bottom right fiducial")
-      startLine = (leftColumn + cropped.shape[0] - adjust, topRow + cropped.shape[1] - adjust, middleSlice - (length//2))
-      endLine = (leftColumn + cropped.shape[0] - adjust, topRow + cropped.shape[1] - adjust, middleSlice + (length//2))
-      numpy_array = self.drawThickLine(startLine, endLine, thickness, numpy_array)
-      missingFiducial += 1
-
-    # Sides
-    # Middle Left
-    if not np.any(cropped[0:r, cropped.shape[1]//2-r//2:cropped.shape[1]//2+r//2] > 0):
-      print("Attempting repair of middle left fiducial")
-      startLine = (leftColumn + adjust, topRow + cropped.shape[1]//2 - (diagLength//2), middleSlice - (diagLength//2))
-      endLine = (leftColumn + adjust, topRow + cropped.shape[1]//2 + (diagLength//2), middleSlice + (diagLength//2))
-      numpy_array = self.drawThickLine(startLine, endLine, thickness, numpy_array)
-      missingFiducial += 1
-    # Middle Top  
-    if not np.any(cropped[cropped.shape[0]//2-r//2:cropped.shape[0]//2+r//2, 0:r] > 0):
-      print("Attempting repair of middle top fiducial")
-      startLine = (leftColumn + cropped.shape[0]//2 + (diagLength//2), topRow + adjust, middleSlice - (diagLength//2))
-      endLine = (leftColumn + cropped.shape[0]//2 - (diagLength//2), topRow + adjust, middleSlice + (diagLength//2))
-      numpy_array = self.drawThickLine(startLine, endLine, thickness, numpy_array)
-      missingFiducial += 1
-    # Middle Right  
-    if not np.any(cropped[cropped.shape[0]-r:cropped.shape[0], cropped.shape[1]//2-r//2:cropped.shape[1]//2+r//2] > 0):
-      print("Attempting repair of middle right fiducial")
-      startLine = (leftColumn + cropped.shape[0] - adjust, topRow + cropped.shape[1]//2 + (diagLength//2), middleSlice - (diagLength//2))
-      endLine = (leftColumn + cropped.shape[0] - adjust, topRow +  cropped.shape[1]//2 - (diagLength//2), middleSlice + (diagLength//2))
-      numpy_array = self.drawThickLine(startLine, endLine, thickness, numpy_array)
-      missingFiducial += 1
-
-    if 2 >= missingFiducial >= 1:
-      imageData = self.numpy_to_vtk_image_data(numpy_array)
-      labelMapVolumeNode.SetAndObserveImageData(imageData)
-      return "success"
-    else:
-      return "anomaly"
-
-  def drawThickLine(self, start, end, thickness, numpy_array):
-    for dx in range(-thickness//2, thickness//2+1):
-      for dy in range(-thickness//2, thickness//2+1):
-          for dz in range(-thickness//2, thickness//2+1):
-            rr, cc, zz = line_nd([start[0]+dx, start[1]+dy, start[2]+dz], [end[0]+dx, end[1]+dy, end[2]+dz], endpoint=True)
-            numpy_array[rr, cc, zz] = 1
-    return numpy_array
-
   def findCentroidOfVolume(self, inputVolume):
     imageData = inputVolume.GetImageData()
     dimensions = imageData.GetDimensions()
@@ -1619,6 +3394,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
   def onTargetMoved(self, caller, event):
     if caller != self.biopsyFiducialListNode:
       return
+    self.journalTargetsTimer.start()
 
     # Cannot identify which changed, so change all of them
     numFiducials = caller.GetNumberOfControlPoints()
@@ -1654,6 +3430,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
   def onTargetAdded(self, caller, event):
     if caller != self.biopsyFiducialListNode:
       return
+    self.journalTargetsTimer.start()
 
     newFiducialIndex = self.biopsyFiducialListNode.GetNumberOfControlPoints() - 1
 
@@ -1720,6 +3497,7 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
       if self.targetListTableWidget.cellWidget(index, 4) == button:
         self.biopsyFiducialListNode.RemoveNthControlPoint(index)
         self.targetListTableWidget.removeRow(index)
+        self.journalTargetsTimer.start()
 
         # Delete trajectory model
         shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
@@ -1818,8 +3596,10 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     if tableItem.column() != 0:
       return
     self.biopsyFiducialListNode.SetNthControlPointLabel(tableItem.row(), tableItem.text())
+    self.journalTargetsTimer.start()
 
 
+  @traced
   def onGenerateWorksheet(self):
     try:
       from reportlab.pdfgen import canvas
@@ -2009,29 +3789,33 @@ class ProstateTemplateBiopsyWidget(ScriptedLoadableModuleWidget):
     self.seriesList = []
     self.loadedFiles = []
     self.filesToBeLoaded = []
+    self.streamingSeries = dict()
+    self.streamingPendingFiles = []
+    self.streamingDecode = None
+    self.streamingRetries = dict()
+    self.speculativeTransforms = dict()
+    self.seriesLoadQueue = []
+    self.seriesLoad = None
+    self.receivedFiles = []
+    self.receivedDatasets = dict()
     self.continueObserving = True
     self.observationTimer.stop()
+    self.stopDICOMReceiver()
 
     if self.nodeAddedObserver: slicer.mrmlScene.RemoveObserver(self.nodeAddedObserver)
     if self.fiducialAddedObserver: slicer.mrmlScene.RemoveObserver(self.fiducialAddedObserver)
     if self.fiducialModifiedObserver: slicer.mrmlScene.RemoveObserver(self.fiducialModifiedObserver)
 
-    # Rename all volume nodes over 43 characters long otherwise it will fail to save
-    for node in slicer.mrmlScene.GetNodes():
-      if node.GetClassName() == "vtkMRMLScalarVolumeNode":
-        if len(node.GetName()) > 41:
-          newName = node.GetName()[:41]
-          print(f"Renaming {node.GetName()} to {newName}")
-          node.SetName(newName)
-          oldStorageNode = node.GetStorageNode()
-          if oldStorageNode:
-            slicer.mrmlScene.RemoveNode(oldStorageNode)
-          node.AddDefaultStorageNode()
-
-    slicer.app.processEvents()
-
-    sceneSaveFilename = f'{self.caseDirPath}/saved-scene-{time.strftime("%Y%m%d-%H%M%S")}.mrb'
-    if slicer.util.saveScene(sceneSaveFilename):
+    self.exportTrace()
+    if not self.caseSaveEngine:
+      self.caseSaveEngine = CaseSaveEngine(self.caseDirPath, self.compressScene)
+    # Only nodes modified since the last checkpoint are written; the scene is only closed once the voxel data is on disk
+    self.caseSaveEngine.checkpoint()
+    sceneSaveFilename = self.caseSaveEngine.commitScene()
+    writeErrors = self.caseSaveEngine.wait()
+    if writeErrors:
+      print(f"Scene saving failed: {len(writeErrors)} data files could not be written")
+    elif sceneSaveFilename:
       print("Scene saved to: {0}".format(sceneSaveFilename))
       slicer.mrmlScene.Clear(0)
       self.onReload()
@@ -0,0 +1,200 @@
+"""Headless batch registration of archived calibration series.
+
+Registers every DICOM series found under a directory with one template and writes the transforms, scores and
+timings to a JSON report. Series are distributed over several Slicer processes, for example:
+
+  Slicer --no-main-window --python-script <module dir>/ProstateTemplateBiopsyLib/BatchRegistration.py
+         --input C:/w/archive --template z001 --output report.json --workers 4
+
+Only the top-level process needs to run in Slicer if --slicer (or SLICER_EXECUTABLE) gives the executable used
+for the workers; it then only needs pydicom to group the files into series.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+MODULE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def findSeries(inputDir, calibrationOnly=False):
+  import pydicom
+  series = dict()
+  for root, dirs, files in os.walk(inputDir):
+    for file in files:
+      path = os.path.join(root, file)
+      try:
+        header = pydicom.dcmread(path, stop_before_pixels=True)
+      except Exception:
+        continue
+      if 'SeriesInstanceUID' not in header:
+        continue
+      description = str(header.get('SeriesDescription', ''))
+      # Same keyword used for automatic role assignment in the module
+      if calibrationOnly and "template" not in description.casefold():
+        continue
+      seriesUID = str(header.SeriesInstanceUID)
+      if seriesUID not in series:
+        series[seriesUID] = {'seriesUID': seriesUID, 'description': description, 'seriesNumber': str(header.get('SeriesNumber', '')),
+                             'patientID': str(header.get('PatientID', '')), 'studyDate': str(header.get('StudyDate', '')), 'files': []}
+      series[seriesUID]['files'].append(path)
+  return sorted(series.values(), key=lambda s: (s['studyDate'], s['patientID'], s['seriesNumber']))
+
+
+def registerSeries(widget, seriesInfo, zframeConfig):
+  # Runs in Slicer; uses the module widget for the direct DICOM decoding and the registration pipeline
+  import slicer
+  result = {key: seriesInfo[key] for key in ['seriesUID', 'description', 'seriesNumber', 'patientID', 'studyDate']}
+  result['template'] = zframeConfig
+  timings = dict()
+  volumeNode = None
+  outputTransform = None
+  try:
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+      slices = [s for s in executor.map(widget.readDICOMSlice, seriesInfo['files']) if s is not None]
+    volume = widget.assembleDICOMSlices(slices)
+    timings['load'] = time.perf_counter() - start
+    if volume is None:
+      result['error'] = 'Slices do not form a regular volume'
+      return result
+    volumeArray, ijkToRAS, instanceUIDs = volume
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'BatchCalibrationVolume')
+    widget.setVolumeNodeFromArray(volumeNode, volumeArray, ijkToRAS)
+    outputTransform = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'BatchZFrameTransform')
+
+    widget.thresholdSliderWidget.value = widget.defaultThresholdPercentage
+    widget.increaseThresholdForRetry = False
+    start = time.perf_counter()
+    valid, outputTransform = widget.registerZFrame(volumeNode, outputTransform)
+    timings['registration'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    maskedVolume = slicer.mrmlScene.GetFirstNodeByName('MaskedCalibrationVolume')
+    score = widget.scoreRegistrationResult(outputTransform, maskedVolume, widget.zFrameFiducials) if maskedVolume else None
+    timings['scoring'] = time.perf_counter() - start
+
+    result.update({'valid': bool(valid), 'matrix': widget.getTransformArray(outputTransform).tolist(), 'score': score,
+                   'residual': widget.registrationResidual, 'threshold': widget.thresholdSliderWidget.value})
+  except Exception as e:
+    result['error'] = repr(e)
+  finally:
+    result['timings'] = timings
+    for node in [volumeNode, outputTransform]:
+      if node:
+        slicer.mrmlScene.RemoveNode(node)
+    widget.removeNodeByName('MaskedCalibrationVolume')
+  return result
+
+
+def registerSeriesList(seriesList, zframeConfig):
+  import slicer
+  widget = slicer.util.getModuleWidget('ProstateTemplateBiopsy')
+  widget.configFileSelectionBox.currentIndex = int(zframeConfig[1:]) - 1
+  widget.loadTemplateConfiguration()
+  results = []
+  for seriesInfo in seriesList:
+    results.append(registerSeries(widget, seriesInfo, zframeConfig))
+    print(f'Registered series {seriesInfo["seriesUID"]}: {"valid" if results[-1].get("valid") else "failed"}')
+  return results
+
+
+def runWorker(jobPath, resultPath, zframeConfig):
+  with open(jobPath, 'r') as f:
+    seriesList = json.load(f)
+  results = registerSeriesList(seriesList, zframeConfig)
+  with open(resultPath, 'w') as f:
+    json.dump(results, f)
+
+
+def getSlicerExecutable(slicerExecutable):
+  if slicerExecutable:
+    return slicerExecutable
+  if os.environ.get('SLICER_EXECUTABLE'):
+    return os.environ['SLICER_EXECUTABLE']
+  try:
+    import slicer
+    return slicer.app.applicationFilePath()
+  except ImportError:
+    raise RuntimeError('Slicer executable not found; use --slicer or set SLICER_EXECUTABLE')
+
+
+def runBatch(args):
+  startTime = time.perf_counter()
+  seriesList = findSeries(args.input, args.calibration_only)
+  print(f'Found {len(seriesList)} series in {args.input}')
+
+  workers = max(1, min(args.workers, len(seriesList)))
+  if workers == 1 and 'slicer' in sys.modules:
+    results = registerSeriesList(seriesList, args.template)
+  else:
+    slicerExecutable = getSlicerExecutable(args.slicer)
+    with tempfile.TemporaryDirectory() as jobDir:
+      jobs = []
+      for index in range(workers):
+        jobPath = os.path.join(jobDir, f'job{index}.json')
+        resultPath = os.path.join(jobDir, f'result{index}.json')
+        with open(jobPath, 'w') as f:
+          json.dump(seriesList[index::workers], f)
+        command = [slicerExecutable, '--no-splash', '--no-main-window', '--additional-module-paths', MODULE_DIR,
+                   '--python-script', os.path.abspath(__file__), '--worker', jobPath, '--result', resultPath, '--template', args.template]
+        jobs.append((command, resultPath))
+
+      def runJob(job):
+        command, resultPath = job
+        completed = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        if not os.path.exists(resultPath):
+          print(completed.stdout)
+          return []
+        with open(resultPath, 'r') as f:
+          return json.load(f)
+
+      with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = [result for jobResults in executor.map(runJob, jobs) for result in jobResults]
+
+  registeredUIDs = set(result['seriesUID'] for result in results)
+  for seriesInfo in seriesList:
+    if seriesInfo['seriesUID'] not in registeredUIDs:
+      results.append({'seriesUID': seriesInfo['seriesUID'], 'description': seriesInfo['description'], 'template': args.template,
+                      'error': 'Worker did not return a result'})
+
+  report = {'input': args.input, 'template': args.template, 'workers': workers, 'time': time.perf_counter() - startTime,
+            'valid': sum(1 for result in results if result.get('valid')), 'count': len(results), 'results': results}
+  with open(args.output, 'w') as f:
+    json.dump(report, f, indent=1)
+  print(f'{report["valid"]}/{report["count"]} series registered in {report["time"]:.1f} s; report written to {args.output}')
+  return report
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Register archived Z-frame calibration series without the module GUI.')
+  parser.add_argument('--input', help='Directory searched recursively for DICOM calibration series')
+  parser.add_argument('--template', default='z001', choices=['z001', 'z002', 'z003', 'z004', 'z005'], help='Z-frame template configuration')
+  parser.add_argument('--output', default='batch-registration.json', help='JSON report path')
+  parser.add_argument('--workers', type=int, default=os.cpu_count() // 2 or 1, help='Number of Slicer worker processes')
+  parser.add_argument('--slicer', help='Slicer executable used for the workers')
+  parser.add_argument('--calibration-only', action='store_true', help='Only register series whose description contains "template"')
+  parser.add_argument('--worker', help=argparse.SUPPRESS)
+  parser.add_argument('--result', help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  if args.worker:
+    runWorker(args.worker, args.result, args.template)
+    return 0
+  if not args.input:
+    parser.error('--input is required')
+  report = runBatch(args)
+  return 0 if report['valid'] == report['count'] else 1
+
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  if 'slicer' in sys.modules:
+    import slicer
+    slicer.util.exit(exitCode)
+  else:
+    sys.exit(exitCode)
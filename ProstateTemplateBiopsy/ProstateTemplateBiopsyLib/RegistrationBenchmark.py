@@ -0,0 +1,113 @@
+import json
+import os
+import time
+import numpy as np
+import slicer, vtk
+
+from ProstateTemplateBiopsyLib.ZFramePhantom import ZFramePhantom
+
+
+class RegistrationBenchmark:
+  """Times each registration stage of the module widget on synthetic calibration volumes.
+
+  Run from the Slicer Python console with the module opened once, for example:
+
+    from ProstateTemplateBiopsyLib.RegistrationBenchmark import RegistrationBenchmark
+    RegistrationBenchmark(repetitions=10).run('C:/w/benchmark.json')
+  """
+
+  STAGES = ['masking', 'counting', 'registration', 'validation', 'total']
+
+  def __init__(self, widget=None, templateIndices=range(5), repetitions=10, seed=0, phantomOptions=None):
+    self.widget = widget if widget else slicer.util.getModuleWidget('ProstateTemplateBiopsy')
+    self.templateIndices = list(templateIndices)
+    self.repetitions = repetitions
+    self.seed = seed
+    self.phantomOptions = phantomOptions if phantomOptions else {}
+    self.results = {}
+
+  def getTemplateConfigPath(self, templateIndex):
+    modulePath = os.path.dirname(slicer.util.modulePath('ProstateTemplateBiopsy'))
+    templateNumber = f'{templateIndex + 1:03d}'
+    return os.path.join(modulePath, f'Resources/Templates/template{templateNumber}/zframe{templateNumber}.txt')
+
+  def run(self, outputPath=None):
+    widget = self.widget
+    rng = np.random.default_rng(self.seed)
+    previousTemplateIndex = widget.configFileSelectionBox.currentIndex
+    outputTransform = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ZFramePhantomTransform')
+    labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'ZFramePhantomLabelMapVolume')
+    try:
+      for templateIndex in self.templateIndices:
+        widget.configFileSelectionBox.currentIndex = templateIndex
+        widget.loadTemplateConfiguration()
+        phantom = ZFramePhantom(self.getTemplateConfigPath(templateIndex))
+        timings = {stage: [] for stage in self.STAGES}
+        errors = []
+        for repetition in range(self.repetitions):
+          pose = phantom.randomPose(rng)
+          volumeArray, ijkToRAS = phantom.render(pose, seed=int(rng.integers(2**31)), **self.phantomOptions)
+          inputVolume = ZFramePhantom.createVolumeNode(volumeArray, ijkToRAS)
+          widget.thresholdSliderWidget.value = widget.defaultThresholdPercentage
+          outputTransform.SetMatrixTransformToParent(vtk.vtkMatrix4x4())
+
+          totalStart = time.perf_counter()
+          start = time.perf_counter()
+          zFrameMaskedVolume = widget.createMaskedVolumeBySize(inputVolume, False)
+          timings['masking'].append(time.perf_counter() - start)
+
+          # Island counting runs on a copy so that a repair does not change the volume being registered
+          slicer.modules.volumes.logic().CreateLabelVolumeFromVolume(slicer.mrmlScene, labelMapVolumeNode, zFrameMaskedVolume)
+          start = time.perf_counter()
+          widget.countAndRepairFiducials(labelMapVolumeNode)
+          timings['counting'].append(time.perf_counter() - start)
+          widget.thresholdSliderWidget.value = widget.defaultThresholdPercentage
+          widget.increaseThresholdForRepair = False
+
+          start = time.perf_counter()
+          if zFrameMaskedVolume.GetImageData().GetScalarRange()[1] > 0:
+            widget.runZFrameRegistration(zFrameMaskedVolume, outputTransform)
+          timings['registration'].append(time.perf_counter() - start)
+
+          start = time.perf_counter()
+          valid = widget.checkRegistrationResult(outputTransform, zFrameMaskedVolume, widget.zFrameFiducials)
+          timings['validation'].append(time.perf_counter() - start)
+          timings['total'].append(time.perf_counter() - totalStart)
+
+          translationError, rotationError = ZFramePhantom.poseError(widget.getTransformArray(outputTransform), pose)
+          errors.append({'valid': bool(valid), 'translationError': translationError, 'rotationError': rotationError})
+
+        self.results[widget.zframeConfig] = {'timings': timings, 'summary': self.summarize(timings), 'errors': errors}
+        self.printSummary(widget.zframeConfig)
+    finally:
+      widget.configFileSelectionBox.currentIndex = previousTemplateIndex
+      widget.thresholdSliderWidget.value = widget.defaultThresholdPercentage
+      for name in ['ZFramePhantomVolume', 'MaskedCalibrationVolume']:
+        widget.removeNodeByName(name)
+      slicer.mrmlScene.RemoveNode(outputTransform)
+      slicer.mrmlScene.RemoveNode(labelMapVolumeNode)
+
+    if outputPath:
+      with open(outputPath, 'w') as f:
+        json.dump({'repetitions': self.repetitions, 'seed': self.seed, 'phantomOptions': self.phantomOptions,
+                   'results': self.results}, f, indent=2)
+    return self.results
+
+  @staticmethod
+  def summarize(timings):
+    # Latency distribution per stage in milliseconds
+    summary = {}
+    for stage, values in timings.items():
+      if not values:
+        continue
+      values = np.array(values) * 1000
+      summary[stage] = {'min': float(values.min()), 'median': float(np.median(values)), 'p90': float(np.percentile(values, 90)),
+                        'max': float(values.max()), 'mean': float(values.mean())}
+    return summary
+
+  def printSummary(self, zframeConfig):
+    result = self.results[zframeConfig]
+    validCount = sum(error['valid'] for error in result['errors'])
+    print(f'{zframeConfig}: {validCount}/{len(result["errors"])} valid registrations')
+    for stage, values in result['summary'].items():
+      print(f'  {stage:<13} median {values["median"]:8.1f} ms  p90 {values["p90"]:8.1f} ms  max {values["max"]:8.1f} ms')
@@ -0,0 +1,55 @@
+import datetime
+import json
+import sqlite3
+from contextlib import closing
+
+# Header values that identify the scanner, coil and protocol a calibration image was acquired with
+PROTOCOL_TAGS = {
+  'Manufacturer': '0008,0070',
+  'ManufacturerModelName': '0008,1090',
+  'StationName': '0008,1010',
+  'MagneticFieldStrength': '0018,0087',
+  'ReceiveCoilName': '0018,1250',
+  'ProtocolName': '0018,1030',
+}
+
+
+def getProtocolTagsFromDataset(dataset):
+  # Returns None if none of the tags are present, e.g. for volumes not loaded from DICOM
+  protocol = {name: str(dataset.get(name, '') or '') for name in PROTOCOL_TAGS}
+  return protocol if any(protocol.values()) else None
+
+
+class RegistrationHistory:
+  """Successful registrations of a site, stored in a SQLite database in the cases directory.
+
+  Each record holds the template, the threshold percentage and fiducial size range the registration succeeded with,
+  the number of attempts it took and the protocol tags of the calibration image. bestThreshold returns the threshold
+  that registered the most calibration images of the same template and protocol, so that the retry ladder of a new
+  case starts where earlier cases ended.
+  """
+
+  def __init__(self, databasePath):
+    self.databasePath = databasePath
+    with closing(sqlite3.connect(self.databasePath)) as connection, connection:
+      connection.execute('CREATE TABLE IF NOT EXISTS registrations (created TEXT, template TEXT, protocol TEXT, threshold REAL, '
+                         'sizeMinimum REAL, sizeMaximum REAL, attempts INTEGER, residual REAL)')
+      connection.execute('CREATE INDEX IF NOT EXISTS registrationsProtocol ON registrations (template, protocol)')
+
+  @staticmethod
+  def getProtocolKey(protocol):
+    return json.dumps(protocol, sort_keys=True)
+
+  def record(self, template, protocol, threshold, sizeMinimum, sizeMaximum, attempts, residual=None):
+    with closing(sqlite3.connect(self.databasePath)) as connection, connection:
+      connection.execute('INSERT INTO registrations VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                         (datetime.datetime.now().isoformat(), template, self.getProtocolKey(protocol), round(threshold, 2),
+                          sizeMinimum, sizeMaximum, attempts, residual))
+
+  def bestThreshold(self, template, protocol):
+    # Most frequent successful threshold; ties go to the one that needed fewer attempts on average
+    with closing(sqlite3.connect(self.databasePath)) as connection:
+      row = connection.execute('SELECT threshold, COUNT(*) AS successes, AVG(attempts) AS meanAttempts FROM registrations '
+                               'WHERE template = ? AND protocol = ? GROUP BY threshold ORDER BY successes DESC, meanAttempts ASC LIMIT 1',
+                               (template, self.getProtocolKey(protocol))).fetchone()
+    return None if row is None else row[0]
@@ -0,0 +1,195 @@
+import glob
+import json
+import os
+import re
+import shutil
+import time
+import numpy as np
+
+from ProstateTemplateBiopsyLib.ZFramePhantom import ZFramePhantom
+
+
+def getTemplateConfigPath(zframeConfig):
+  # zframeConfig is the template id used by the module, e.g. 'z001'
+  templateNumber = zframeConfig[1:]
+  modulePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  return os.path.join(modulePath, f'Resources/Templates/template{templateNumber}/zframe{templateNumber}.txt')
+
+
+def writeCorpusEntry(corpusDir, name, volumeArray, ijkToRAS, zframeConfig, zFrameToRAS, source):
+  # Same layout as the case volume cache (.npy voxels next to a .json with geometry) plus the known transform
+  os.makedirs(corpusDir, exist_ok=True)
+  np.save(os.path.join(corpusDir, f'{name}.npy'), volumeArray)
+  with open(os.path.join(corpusDir, f'{name}.json'), 'w') as f:
+    json.dump({'name': name, 'ijkToRAS': np.asarray(ijkToRAS).tolist(), 'template': zframeConfig,
+               'zFrameToRAS': np.asarray(zFrameToRAS).tolist(), 'source': source}, f, indent=1)
+
+
+def generateSyntheticCorpus(corpusDir, templates=('z001', 'z002', 'z003', 'z004', 'z005'), count=5, seed=0, phantomOptions=None):
+  rng = np.random.default_rng(seed)
+  phantomOptions = phantomOptions if phantomOptions else {}
+  for zframeConfig in templates:
+    phantom = ZFramePhantom(getTemplateConfigPath(zframeConfig))
+    for index in range(count):
+      pose = phantom.randomPose(rng)
+      volumeArray, ijkToRAS = phantom.render(pose, seed=int(rng.integers(2**31)), **phantomOptions)
+      writeCorpusEntry(corpusDir, f'synthetic_{zframeConfig}_{index:03d}', volumeArray, ijkToRAS, zframeConfig, pose,
+                       {'synthetic': True, 'seed': seed, 'phantomOptions': phantomOptions})
+
+
+def addArchivedCase(caseDirPath, corpusDir, name=None):
+  """Adds the calibration volume of a closed case, with its accepted registration as the known transform.
+
+  Uses the cached calibration volume and the case journal, so only cases recorded by this module version can be added.
+  """
+  records = []
+  with open(os.path.join(caseDirPath, 'case-journal.jsonl'), 'r') as f:
+    for line in f:
+      try:
+        records.append(json.loads(line))
+      except ValueError:
+        continue
+  templateIndex = None
+  calibrationName = None
+  calibrationSeriesUID = None
+  registration = None
+  for record in records:
+    if record['type'] == 'case':
+      templateIndex = record['template']
+    elif record['type'] == 'template':
+      templateIndex = record['index']
+    elif record['type'] == 'imageRole' and record['role'] == 'CALIBRATION':
+      calibrationName = record['name']
+      calibrationSeriesUID = record.get('seriesUID')
+    elif record['type'] == 'registration':
+      registration = record
+  if templateIndex is None or not calibrationName or not registration or not registration['valid']:
+    raise ValueError(f'No accepted registration of a calibration image recorded in {caseDirPath}')
+
+  calibrationFileName = re.sub(r'[^\w-]+', '_', calibrationName)
+  # Volumes of a series are cached by its UID; the name is used only for volumes that have no series UID
+  cacheName = calibrationSeriesUID if calibrationSeriesUID else calibrationFileName
+  cachePath = os.path.join(caseDirPath, 'cache', cacheName)
+  with open(f'{cachePath}.json', 'r') as f:
+    metadata = json.load(f)
+  name = name if name else f'{os.path.basename(os.path.normpath(caseDirPath))}_{calibrationFileName}'
+  os.makedirs(corpusDir, exist_ok=True)
+  shutil.copy2(f'{cachePath}.npy', os.path.join(corpusDir, f'{name}.npy'))
+  with open(os.path.join(corpusDir, f'{name}.json'), 'w') as f:
+    json.dump({'name': name, 'ijkToRAS': metadata['ijkToRAS'], 'template': f'z{templateIndex + 1:03d}',
+               'zFrameToRAS': registration['matrix'], 'source': {'case': caseDirPath, 'manual': registration['manual']}}, f, indent=1)
+  return name
+
+
+class RegistrationRegression:
+  """Runs registerZFrame over a corpus of calibration volumes with known transforms and checks accuracy and time.
+
+  A run fails if any registration is invalid or exceeds the translation (mm) or rotation (degrees) tolerance, or,
+  when a baseline report is given, if the median time of a template exceeds the baseline median by more than
+  timeTolerance (a fraction).
+  """
+
+  def __init__(self, corpusDir, widget=None, translationTolerance=1.0, rotationTolerance=1.0, timeTolerance=0.25, baselinePath=None):
+    import slicer
+    self.corpusDir = corpusDir
+    self.widget = widget if widget else slicer.util.getModuleWidget('ProstateTemplateBiopsy')
+    self.translationTolerance = translationTolerance
+    self.rotationTolerance = rotationTolerance
+    self.timeTolerance = timeTolerance
+    self.baseline = None
+    if baselinePath:
+      with open(baselinePath, 'r') as f:
+        self.baseline = json.load(f)
+    self.report = None
+
+  def run(self, reportPath=None):
+    import slicer
+    from ProstateTemplateBiopsyLib.Tracing import tracer
+    widget = self.widget
+    entries = []
+    for metadataPath in sorted(glob.glob(os.path.join(self.corpusDir, '*.json'))):
+      with open(metadataPath, 'r') as f:
+        entries.append(json.load(f))
+    entries.sort(key=lambda entry: (entry['template'], entry['name']))
+
+    previousTemplateIndex = widget.configFileSelectionBox.currentIndex
+    previousThreshold = widget.thresholdSliderWidget.value
+    outputTransform = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode', 'ZFramePhantomTransform')
+    results = []
+    failures = []
+    loadedTemplate = None
+    try:
+      for entry in entries:
+        if entry['template'] != loadedTemplate:
+          widget.configFileSelectionBox.currentIndex = int(entry['template'][1:]) - 1
+          widget.loadTemplateConfiguration()
+          loadedTemplate = entry['template']
+        volumeArray = np.load(os.path.join(self.corpusDir, f'{entry["name"]}.npy'))
+        inputVolume = ZFramePhantom.createVolumeNode(volumeArray, entry['ijkToRAS'])
+        widget.thresholdSliderWidget.value = widget.defaultThresholdPercentage
+        widget.increaseThresholdForRetry = False
+        outputTransform.SetMatrixTransformToParent(widget.arrayToVtkMatrix(np.eye(4)))
+
+        start = time.perf_counter()
+        with tracer.span('regression', name=entry['name']):
+          valid, outputTransform = widget.registerZFrame(inputVolume, outputTransform)
+        duration = time.perf_counter() - start
+
+        translationError, rotationError = ZFramePhantom.poseError(widget.getTransformArray(outputTransform), np.array(entry['zFrameToRAS']))
+        result = {'name': entry['name'], 'template': entry['template'], 'valid': bool(valid), 'time': duration,
+                  'translationError': translationError, 'rotationError': rotationError}
+        results.append(result)
+        if not valid:
+          failures.append(f'{entry["name"]}: registration not valid')
+        if translationError > self.translationTolerance:
+          failures.append(f'{entry["name"]}: translation error {translationError:.2f} mm exceeds {self.translationTolerance} mm')
+        if rotationError > self.rotationTolerance:
+          failures.append(f'{entry["name"]}: rotation error {rotationError:.2f} degrees exceeds {self.rotationTolerance} degrees')
+    finally:
+      widget.configFileSelectionBox.currentIndex = previousTemplateIndex
+      widget.thresholdSliderWidget.value = previousThreshold
+      widget.increaseThresholdForRetry = False
+      for name in ['ZFramePhantomVolume', 'MaskedCalibrationVolume']:
+        widget.removeNodeByName(name)
+      slicer.mrmlScene.RemoveNode(outputTransform)
+
+    summary = self.summarize(results)
+    if self.baseline:
+      for template, templateSummary in summary.items():
+        baselineSummary = self.baseline['summary'].get(template)
+        if not baselineSummary:
+          continue
+        limit = baselineSummary['medianTime'] * (1 + self.timeTolerance)
+        if templateSummary['medianTime'] > limit:
+          failures.append(f'{template}: median time {templateSummary["medianTime"]:.2f} s exceeds baseline {baselineSummary["medianTime"]:.2f} s by more than {self.timeTolerance:.0%}')
+
+    self.report = {'corpus': self.corpusDir, 'passed': not failures, 'failures': failures, 'summary': summary, 'results': results,
+                   'tolerances': {'translation': self.translationTolerance, 'rotation': self.rotationTolerance, 'time': self.timeTolerance}}
+    self.printReport()
+    if reportPath:
+      with open(reportPath, 'w') as f:
+        json.dump(self.report, f, indent=1)
+    return self.report['passed']
+
+  @staticmethod
+  def summarize(results):
+    summary = {}
+    for template in sorted(set(result['template'] for result in results)):
+      templateResults = [result for result in results if result['template'] == template]
+      times = np.array([result['time'] for result in templateResults])
+      translationErrors = np.array([result['translationError'] for result in templateResults])
+      rotationErrors = np.array([result['rotationError'] for result in templateResults])
+      summary[template] = {'count': len(templateResults),
+                           'valid': sum(result['valid'] for result in templateResults),
+                           'medianTime': float(np.median(times)), 'maxTime': float(times.max()),
+                           'meanTranslationError': float(translationErrors.mean()), 'maxTranslationError': float(translationErrors.max()),
+                           'meanRotationError': float(rotationErrors.mean()), 'maxRotationError': float(rotationErrors.max())}
+    return summary
+
+  def printReport(self):
+    for template, values in self.report['summary'].items():
+      print(f'{template}: {values["valid"]}/{values["count"]} valid, median {values["medianTime"]:.2f} s, '
+            f'max translation error {values["maxTranslationError"]:.2f} mm, max rotation error {values["maxRotationError"]:.2f} degrees')
+    for failure in self.report['failures']:
+      print(f'FAILED {failure}')
+    print('Registration regression ' + ('passed' if self.report['passed'] else 'failed'))
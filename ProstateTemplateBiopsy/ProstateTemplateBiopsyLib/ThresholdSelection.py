@@ -0,0 +1,71 @@
+import numpy as np
+
+
+def multiOtsuThresholds(histogram, binCenters):
+  # Two thresholds maximizing the between-class variance of three classes (background, tissue, fiducials)
+  probabilities = histogram / histogram.sum()
+  cumulativeWeight = np.cumsum(probabilities)
+  cumulativeMean = np.cumsum(probabilities * binCenters)
+  totalMean = cumulativeMean[-1]
+  bins = len(histogram)
+  # Class boundaries after bins i < j; every pair is evaluated at once
+  i, j = np.triu_indices(bins - 1, k=1)
+  w0, m0 = cumulativeWeight[i], cumulativeMean[i]
+  w1, m1 = cumulativeWeight[j] - w0, cumulativeMean[j] - m0
+  w2, m2 = 1 - cumulativeWeight[j], totalMean - cumulativeMean[j]
+  with np.errstate(divide='ignore', invalid='ignore'):
+    variance = np.nan_to_num(m0 ** 2 / w0) + np.nan_to_num(m1 ** 2 / w1) + np.nan_to_num(m2 ** 2 / w2)
+  best = np.argmax(variance)
+  edges = (binCenters[:-1] + binCenters[1:]) / 2
+  return edges[i[best]], edges[j[best]]
+
+
+def otsuThreshold(histogram, binCenters):
+  probabilities = histogram / histogram.sum()
+  cumulativeWeight = np.cumsum(probabilities)[:-1]
+  cumulativeMean = np.cumsum(probabilities * binCenters)[:-1]
+  totalMean = np.sum(probabilities * binCenters)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    variance = np.nan_to_num((totalMean * cumulativeWeight - cumulativeMean) ** 2 / (cumulativeWeight * (1 - cumulativeWeight)))
+  edges = (binCenters[:-1] + binCenters[1:]) / 2
+  return edges[np.argmax(variance)]
+
+
+def selectThresholdPercentage(volumeArray, fiducialCount, minimumSize, maximumSize, bins=256, thresholdRange=(0.0, 1.0)):
+  """Picks the threshold percentage of the scalar range for the first masking attempt from the intensity histogram.
+
+  The upper multi-Otsu threshold (or the Otsu threshold) is used if the number of voxels above it is in the range
+  implied by fiducialCount islands of minimumSize to maximumSize voxels. Otherwise the threshold is the intensity
+  above which that many voxels lie, at the geometric mean of the size range. The percentage is clamped to
+  thresholdRange, e.g. the range the retry ladder steps through. Returns the percentage and a dict with the
+  candidates considered and the 'unclamped' percentage.
+  """
+  values = np.asarray(volumeArray).ravel()
+  low, high = float(values.min()), float(values.max())
+  if high <= low:
+    return None, {}
+  histogram, edges = np.histogram(values, bins=bins, range=(low, high))
+  binCenters = (edges[:-1] + edges[1:]) / 2
+  # Voxels above each bin edge, from the histogram rather than by sorting the volume
+  voxelsAbove = np.concatenate([histogram[::-1].cumsum()[::-1], [0]])
+
+  def countAbove(threshold):
+    return int(voxelsAbove[min(bins, max(0, int(np.searchsorted(edges, threshold))))])
+
+  expectedMinimum = fiducialCount * minimumSize
+  expectedMaximum = fiducialCount * maximumSize
+  candidates = {'multiOtsu': float(multiOtsuThresholds(histogram, binCenters)[1]), 'otsu': float(otsuThreshold(histogram, binCenters))}
+  details = {'candidates': candidates, 'expectedVoxels': [expectedMinimum, expectedMaximum]}
+  def clamp(percentage):
+    details['unclamped'] = float(percentage)
+    return float(min(max(percentage, thresholdRange[0]), thresholdRange[1]))
+
+  for name, threshold in candidates.items():
+    if expectedMinimum <= countAbove(threshold) <= expectedMaximum:
+      details['method'] = name
+      return clamp((threshold - low) / (high - low)), details
+
+  expectedVoxels = fiducialCount * np.sqrt(max(minimumSize, 1) * max(maximumSize, 1))
+  edgeIndex = int(np.argmax(voxelsAbove <= expectedVoxels))
+  details['method'] = 'volume'
+  return clamp((edges[edgeIndex] - low) / (high - low)), details
@@ -0,0 +1,104 @@
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+  """Records nested timing spans and exports them as JSON or as a Chrome trace (chrome://tracing, Perfetto)."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.local = threading.local()
+    self.spans = []
+    self.origin = time.perf_counter()
+    self.enabled = True
+
+  def clear(self):
+    with self.lock:
+      self.spans = []
+      self.origin = time.perf_counter()
+
+  def getStack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack = []
+    return self.local.stack
+
+  def span(self, name, **args):
+    return TraceSpan(self, name, args)
+
+  def annotate(self, **args):
+    # Adds values (retry count, threshold, result) to the innermost open span of this thread
+    stack = self.getStack()
+    if stack:
+      stack[-1].args.update(args)
+
+  def increment(self, name, amount=1):
+    stack = self.getStack()
+    if stack:
+      stack[-1].args[name] = stack[-1].args.get(name, 0) + amount
+
+  def traced(self, function):
+    # Method decorator recording a span named after the function
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      with self.span(function.__name__):
+        return function(*args, **kwargs)
+    return wrapper
+
+  def record(self, span):
+    with self.lock:
+      self.spans.append({'name': span.name,
+                         'start': span.start - self.origin,
+                         'duration': span.end - span.start,
+                         'depth': span.depth,
+                         'thread': threading.get_ident(),
+                         'args': span.args})
+
+  def exportJSON(self, path):
+    with self.lock:
+      spans = sorted(self.spans, key=lambda span: span['start'])
+    with open(path, 'w') as f:
+      json.dump({'spans': spans}, f, indent=1, default=str)
+
+  def exportChromeTrace(self, path):
+    # Complete ("X") events with microsecond timestamps
+    pid = os.getpid()
+    with self.lock:
+      events = [{'name': span['name'], 'ph': 'X', 'pid': pid, 'tid': span['thread'],
+                 'ts': span['start'] * 1e6, 'dur': span['duration'] * 1e6, 'args': span['args']}
+                for span in self.spans]
+    with open(path, 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+class TraceSpan:
+  def __init__(self, tracer, name, args):
+    self.tracer = tracer
+    self.name = name
+    self.args = dict(args)
+    self.depth = 0
+
+  def __enter__(self):
+    stack = self.tracer.getStack()
+    self.depth = len(stack)
+    stack.append(self)
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.end = time.perf_counter()
+    stack = self.tracer.getStack()
+    if stack and stack[-1] is self:
+      stack.pop()
+    if excType is not None:
+      self.args['error'] = repr(excValue)
+    if self.tracer.enabled:
+      self.tracer.record(self)
+    return False
+
+
+# Shared by the module so that spans from the widget and the library nest in one trace
+tracer = Tracer()
+traced = tracer.traced
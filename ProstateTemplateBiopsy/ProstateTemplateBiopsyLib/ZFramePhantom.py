@@ -0,0 +1,139 @@
+import math
+import re
+import numpy as np
+
+
+class ZFramePhantom:
+  """Renders synthetic Z-frame calibration volumes from a zframe00N.txt configuration file.
+
+  Volumes are returned as numpy arrays in KJI order together with their IJK to RAS matrix, so they can be
+  loaded with slicer.util.updateVolumeFromArray or used without Slicer.
+  """
+
+  def __init__(self, configFilePath):
+    self.configFilePath = configFilePath
+    self.fiducials = []
+    self.frameTopology = []
+    with open(configFilePath, 'r') as f:
+      for line in f:
+        if line.startswith('Side 1') or line.startswith('Side 2'):
+          vec = [float(s) for s in re.findall(r'-?\d+\.?\d*', line)]
+          vec.pop(0)
+          self.frameTopology.append(vec)
+        elif line.startswith('Base'):
+          self.frameTopology.append([float(s) for s in re.findall(r'-?\d+\.?\d*', line)])
+        elif line.startswith('Fiducial'):
+          coords_str = line.split(': ')[1].strip('()\n').replace(' ', '')
+          point1_str, point2_str = coords_str.split('),(')
+          self.fiducials.append([float(x) for x in point1_str.split(',')] + [float(x) for x in point2_str.split(',')])
+    self.fiducials = np.array(self.fiducials)
+    # The zFrame origin is not the middle of every frame, e.g. the base of z003 is 115 mm from it
+    self.frameCenter = np.vstack([self.fiducials[:, 0:3], self.fiducials[:, 3:6]]).mean(axis=0)
+
+  def randomPose(self, rng, maxRotation=5.0, maxTranslation=10.0):
+    # Small rotation about each axis (degrees) and translation (mm) of the frame center from isocenter, as the frame
+    # is placed roughly at isocenter; keeps all fiducials out of the border margin of the default volume
+    angles = np.radians(rng.uniform(-maxRotation, maxRotation, 3))
+    cx, cy, cz = np.cos(angles)
+    sx, sy, sz = np.sin(angles)
+    rotationX = np.array([[1, 0, 0], [0, cx, -sx], [0, sx, cx]])
+    rotationY = np.array([[cy, 0, sy], [0, 1, 0], [-sy, 0, cy]])
+    rotationZ = np.array([[cz, -sz, 0], [sz, cz, 0], [0, 0, 1]])
+    pose = np.eye(4)
+    pose[0:3, 0:3] = rotationZ @ rotationY @ rotationX
+    pose[0:3, 3] = rng.uniform(-maxTranslation, maxTranslation, 3) - pose[0:3, 0:3] @ self.frameCenter
+    return pose
+
+  @staticmethod
+  def poseError(estimatedPose, truePose):
+    # Translation error (mm) of the frame origin and rotation error (degrees) between two zFrame to RAS matrices
+    difference = np.linalg.inv(truePose) @ estimatedPose
+    translationError = float(np.linalg.norm(estimatedPose[0:3, 3] - truePose[0:3, 3]))
+    cosine = (np.trace(difference[0:3, 0:3]) - 1) / 2
+    rotationError = math.degrees(math.acos(min(1.0, max(-1.0, cosine))))
+    return translationError, rotationError
+
+  def render(self, zFrameToRAS=None, spacing=(0.9375, 0.9375, 1.5), dimensions=(256, 256, 48),
+             noise=10.0, fiducialRadius=2.0, fiducialIntensity=1000.0, backgroundIntensity=50.0,
+             missingFiducials=(), borderClutter=0, borderMargin=15, endGap=8.0, seed=None):
+    """Returns (volumeArray, ijkToRAS) for the frame placed at zFrameToRAS.
+
+    missingFiducials are indices into the configuration's fiducial list that are left out of the image.
+    borderClutter bright blobs are placed within borderMargin voxels of the in-plane edges of the volume.
+    Each rod stops endGap mm short of its configured ends, as the sealed fiducial tubes do not touch at the frame
+    corners; otherwise the rods would form a single island.
+    """
+    rng = np.random.default_rng(seed)
+    if zFrameToRAS is None:
+      zFrameToRAS = np.eye(4)
+    dimensions = [int(d) for d in dimensions]
+
+    # Axial slices acquired in LPS, centered on the RAS origin
+    ijkToRAS = np.diag([-spacing[0], -spacing[1], spacing[2], 1.0])
+    center = ijkToRAS[0:3, 0:3] @ ((np.array(dimensions) - 1) / 2)
+    ijkToRAS[0:3, 3] = -center
+    rasToIJK = np.linalg.inv(ijkToRAS)
+
+    signal = np.zeros(dimensions[::-1], dtype=np.float64)
+    voxelSize = min(spacing)
+
+    for index, fiducial in enumerate(self.fiducials):
+      if index in missingFiducials:
+        continue
+      length = np.linalg.norm(fiducial[3:6] - fiducial[0:3])
+      gap = min(endGap / length, 0.25) * (fiducial[3:6] - fiducial[0:3])
+      start = (zFrameToRAS @ np.append(fiducial[0:3] + gap, 1.0))[0:3]
+      end = (zFrameToRAS @ np.append(fiducial[3:6] - gap, 1.0))[0:3]
+      # Only evaluate voxels in the bounding box of the rod
+      ijkEnds = (rasToIJK @ np.array([np.append(start, 1.0), np.append(end, 1.0)]).T)[0:3].T
+      margin = fiducialRadius / np.array(spacing) + 2
+      lower = np.maximum(np.floor(ijkEnds.min(axis=0) - margin), 0).astype(int)
+      upper = np.minimum(np.ceil(ijkEnds.max(axis=0) + margin) + 1, dimensions).astype(int)
+      if np.any(upper <= lower):
+        continue
+      k, j, i = np.meshgrid(np.arange(lower[2], upper[2]), np.arange(lower[1], upper[1]), np.arange(lower[0], upper[0]), indexing='ij')
+      ras = np.stack([i, j, k], axis=-1) @ ijkToRAS[0:3, 0:3].T + ijkToRAS[0:3, 3]
+      direction = end - start
+      t = np.clip(((ras - start) @ direction) / (direction @ direction), 0.0, 1.0)
+      distance = np.linalg.norm(ras - (start + t[..., None] * direction), axis=-1)
+      # Linear partial volume over one voxel at the edge of the rod
+      rod = fiducialIntensity * np.clip((fiducialRadius + voxelSize / 2 - distance) / voxelSize, 0.0, 1.0)
+      box = signal[lower[2]:upper[2], lower[1]:upper[1], lower[0]:upper[0]]
+      np.maximum(box, rod, out=box)
+
+    if borderClutter:
+      k, j, i = np.meshgrid(np.arange(dimensions[2]), np.arange(dimensions[1]), np.arange(dimensions[0]), indexing='ij')
+      for blob in range(borderClutter):
+        # Pick an in-plane edge and a center within the border margin of it
+        blobCenter = rng.uniform([0, 0, 0], np.array(dimensions) - 1)
+        axis = rng.integers(0, 2)
+        blobCenter[axis] = rng.uniform(0, borderMargin) if rng.random() < 0.5 else rng.uniform(dimensions[axis] - 1 - borderMargin, dimensions[axis] - 1)
+        radii = rng.uniform(5.0, 15.0, 3) / np.array(spacing)
+        intensity = fiducialIntensity * rng.uniform(0.3, 1.2)
+        inside = ((i - blobCenter[0]) / radii[0]) ** 2 + ((j - blobCenter[1]) / radii[1]) ** 2 + ((k - blobCenter[2]) / radii[2]) ** 2 <= 1.0
+        signal[inside] = np.maximum(signal[inside], intensity)
+
+    # Magnitude image of a complex signal with Gaussian noise gives Rician background noise
+    signal += backgroundIntensity
+    if noise > 0:
+      real = signal + rng.normal(0.0, noise, signal.shape)
+      imaginary = rng.normal(0.0, noise, signal.shape)
+      signal = np.sqrt(real ** 2 + imaginary ** 2)
+
+    volumeArray = np.clip(np.rint(signal), 0, np.iinfo(np.int16).max).astype(np.int16)
+    return volumeArray, ijkToRAS
+
+  @staticmethod
+  def createVolumeNode(volumeArray, ijkToRAS, name='ZFramePhantomVolume'):
+    import slicer, vtk
+    volumeNode = slicer.mrmlScene.GetFirstNodeByName(name)
+    if not volumeNode:
+      volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+      volumeNode.CreateDefaultDisplayNodes()
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        matrix.SetElement(row, column, ijkToRAS[row][column])
+    volumeNode.SetIJKToRASMatrix(matrix)
+    slicer.util.updateVolumeFromArray(volumeNode, volumeArray)
+    return volumeNode
@@ -0,0 +1,94 @@
+import numpy as np
+from scipy import ndimage, optimize
+
+from ProstateTemplateBiopsyLib.ZFramePoseSolver import rotationFromVector
+
+
+class ZFramePoseSearch:
+  """Searches for the zFrame to RAS pose that puts the fiducial lines on the detected fiducial voxels.
+
+  A signed distance map (mm) to the fiducial voxels, negative inside them, is computed once so that the fiducial
+  lines are pulled to the middle of each fiducial. A candidate pose is scored by the mean distance at points sampled
+  along the transformed fiducial lines, truncated so that a few missing or occluded fiducials do not dominate. A coarse
+  translation grid around the detected fiducials is followed by a local simplex search from the best candidates.
+  Used to propose a transform when the automatic registration fails.
+  """
+
+  def __init__(self, maskArray, arrayToRAS, zFrameFiducials, sampleSpacing=2.0, truncation=10.0):
+    self.arrayToRAS = np.asarray(arrayToRAS, dtype=float)
+    self.rasToArray = np.linalg.inv(self.arrayToRAS)
+    self.truncation = truncation
+    mask = maskArray > 0
+    self.hasFiducials = bool(np.any(mask))
+    spacing = np.linalg.norm(self.arrayToRAS[0:3, 0:3], axis=0)
+    # KJI array, so the sampling is given slice spacing first
+    self.distanceMap = None
+    self.fiducialCenter = None
+    if self.hasFiducials:
+      self.distanceMap = ndimage.distance_transform_edt(~mask, sampling=spacing[::-1]) - ndimage.distance_transform_edt(mask, sampling=spacing[::-1])
+      # Median is less affected by leftover clutter than the mean
+      fiducialIJK = np.median(np.argwhere(mask)[:, ::-1], axis=0)
+      self.fiducialCenter = fiducialIJK @ self.arrayToRAS[0:3, 0:3].T + self.arrayToRAS[0:3, 3]
+
+    samples = []
+    for fiducial in np.asarray(zFrameFiducials, dtype=float):
+      start, end = fiducial[0:3], fiducial[3:6]
+      count = max(2, int(np.linalg.norm(end - start) / sampleSpacing) + 1)
+      samples.append(start + np.outer(np.linspace(0, 1, count), end - start))
+    self.modelPoints = np.vstack(samples)
+    self.frameCenter = self.modelPoints.mean(axis=0)
+    self.evaluations = 0
+
+  def scorePoses(self, poses):
+    # poses is P x 4 x 4 (zFrame to RAS); returns P mean truncated distances in mm
+    poses = np.asarray(poses)
+    rasPoints = np.einsum('pij,nj->pni', poses[:, 0:3, 0:3], self.modelPoints) + poses[:, None, 0:3, 3]
+    arrayPoints = rasPoints @ self.rasToArray[0:3, 0:3].T + self.rasToArray[0:3, 3]
+    # map_coordinates takes KJI coordinates; points outside the volume count as fully missed
+    coordinates = arrayPoints.reshape(-1, 3)[:, ::-1].T
+    distances = ndimage.map_coordinates(self.distanceMap, coordinates, order=1, mode='constant', cval=self.truncation)
+    self.evaluations += len(poses)
+    return np.minimum(distances, self.truncation).reshape(len(poses), -1).mean(axis=1)
+
+  def poseFromParameters(self, parameters, basePose):
+    # Rotation vector (radians) about the frame center and translation (mm) applied on top of basePose
+    pose = basePose.copy()
+    rotation = rotationFromVector(parameters[0:3])
+    center = basePose[0:3, 0:3] @ self.frameCenter + basePose[0:3, 3]
+    pose[0:3, 0:3] = rotation @ basePose[0:3, 0:3]
+    pose[0:3, 3] = rotation @ (basePose[0:3, 3] - center) + center + parameters[3:6]
+    return pose
+
+  def search(self, translationRange=64.0, translationStep=8.0, candidates=5, quarterTurns=False):
+    """Returns a dict with the proposed zFrame to RAS 'pose', its 'score' (mean truncated distance, mm) and 'evaluations', or None.
+
+    The frame is assumed to be mounted with its axes close to the RAS axes; quarterTurns also tries the other three
+    90 degree rotations about the slice normal, which may match a symmetric frame equally well.
+    """
+    if not self.hasFiducials:
+      return None
+    self.evaluations = 0
+    offsets = np.arange(-translationRange, translationRange + translationStep / 2, translationStep)
+    grid = np.stack(np.meshgrid(offsets, offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 3)
+    poses = []
+    for turn in range(4 if quarterTurns else 1):
+      angle = turn * np.pi / 2
+      rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+      rotationPoses = np.tile(np.eye(4), (len(grid), 1, 1))
+      rotationPoses[:, 0:3, 0:3] = rotation
+      rotationPoses[:, 0:3, 3] = self.fiducialCenter - rotation @ self.frameCenter + grid
+      poses.append(rotationPoses)
+    poses = np.concatenate(poses)
+    # Scored in chunks to bound the memory used for the sample coordinates
+    scores = np.concatenate([self.scorePoses(poses[index:index + 512]) for index in range(0, len(poses), 512)])
+
+    best = None
+    for candidate in np.argsort(scores)[:candidates]:
+      basePose = poses[candidate]
+      result = optimize.minimize(lambda parameters: self.scorePoses([self.poseFromParameters(parameters, basePose)])[0],
+                                 np.zeros(6), method='Nelder-Mead',
+                                 options={'initial_simplex': np.vstack([np.zeros(6), np.diag([0.05, 0.05, 0.05, 2.0, 2.0, 2.0])]),
+                                          'xatol': 1e-3, 'fatol': 1e-3, 'maxiter': 1000})
+      if best is None or result.fun < best[0]:
+        best = (float(result.fun), self.poseFromParameters(result.x, basePose))
+    return {'pose': best[1], 'score': best[0], 'evaluations': self.evaluations}
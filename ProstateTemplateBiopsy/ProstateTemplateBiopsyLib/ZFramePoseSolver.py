@@ -0,0 +1,240 @@
+import numpy as np
+from scipy import ndimage
+
+
+def rotationFromVector(rotationVector):
+  # Rodrigues' formula
+  angle = np.linalg.norm(rotationVector)
+  if angle < 1e-12:
+    return np.eye(3)
+  axis = rotationVector / angle
+  skew = np.array([[0, -axis[2], axis[1]], [axis[2], 0, -axis[0]], [-axis[1], axis[0], 0]])
+  return np.eye(3) + np.sin(angle) * skew + (1 - np.cos(angle)) * skew @ skew
+
+
+class ZFramePoseSolver:
+  """Estimates the zFrame to RAS pose from a binary fiducial mask without slice-by-slice processing.
+
+  The in-plane centroids of the connected components of all slab slices are computed in one labelling pass. Each
+  centroid is the intersection of a slice with one fiducial rod, so the pose is the rigid transform that puts every
+  centroid on its nearest rod. This is solved with robust Gauss-Newton steps on the point-to-line distances, started
+  from the four 90 degree rotations of the frame about the slice normal. The residual is the RMS point-to-line
+  distance (mm) of the inlier centroids.
+  """
+
+  def __init__(self, zFrameFiducials, inlierDistance=2.0, maximumIterations=30):
+    fiducials = np.array(zFrameFiducials, dtype=float)
+    self.lineStarts = fiducials[:, 0:3]
+    self.lineEnds = fiducials[:, 3:6]
+    self.lineLengths = np.linalg.norm(self.lineEnds - self.lineStarts, axis=1)
+    self.lineDirections = (self.lineEnds - self.lineStarts) / self.lineLengths[:, None]
+    self.frameCenter = np.vstack([self.lineStarts, self.lineEnds]).mean(axis=0)
+    self.inlierDistance = inlierDistance
+    self.maximumIterations = maximumIterations
+
+  def findCentroids(self, maskArray, ijkToRAS, sliceRange=None):
+    # Returns the RAS centroids of the in-plane connected components of the slab (maskArray is KJI)
+    firstSlice = 0
+    if sliceRange is not None:
+      firstSlice = max(0, sliceRange[0])
+      maskArray = maskArray[firstSlice:max(firstSlice, sliceRange[1] + 1)]
+    mask = maskArray > 0
+    # Components are connected within a slice only
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = True
+    labels, count = ndimage.label(mask, structure=structure)
+    if count == 0:
+      return np.zeros((0, 3))
+    kji = np.array(ndimage.center_of_mass(mask, labels, np.arange(1, count + 1)))
+    ijk = np.column_stack([kji[:, 2], kji[:, 1], kji[:, 0] + firstSlice, np.ones(count)])
+    return (ijk @ np.asarray(ijkToRAS).T)[:, 0:3]
+
+  def pointToLineResiduals(self, framePoints):
+    # Perpendicular offsets (N x L x 3) from each point to each fiducial segment, clamped to the segment ends
+    offsets = framePoints[:, None, :] - self.lineStarts[None, :, :]
+    t = np.clip(np.einsum('nlk,lk->nl', offsets, self.lineDirections), 0, self.lineLengths[None, :])
+    return offsets - t[..., None] * self.lineDirections[None, :, :]
+
+  def refine(self, points, rasToFrame):
+    # Gauss-Newton on the point-to-line distances in frame coordinates; rasToFrame is updated as exp(w) * rasToFrame + dt
+    cutoff = 20.0
+    for iteration in range(self.maximumIterations):
+      framePoints = points @ rasToFrame[0:3, 0:3].T + rasToFrame[0:3, 3]
+      residuals = self.pointToLineResiduals(framePoints)
+      distances = np.linalg.norm(residuals, axis=2)
+      nearest = np.argmin(distances, axis=1)
+      nearestDistances = distances[np.arange(len(points)), nearest]
+      inliers = nearestDistances < cutoff
+      if np.count_nonzero(inliers) < 6:
+        return rasToFrame, np.inf, inliers, nearest
+      # Points are assigned to their nearest rod; only the component across the rod direction is penalized
+      directions = self.lineDirections[nearest[inliers]]
+      projectors = np.eye(3)[None, :, :] - directions[:, :, None] * directions[:, None, :]
+      y = framePoints[inliers]
+      r = np.einsum('nij,nj->ni', projectors, residuals[np.arange(len(points)), nearest][inliers])
+      skew = np.zeros((len(y), 3, 3))
+      skew[:, 0, 1], skew[:, 0, 2], skew[:, 1, 2] = -y[:, 2], y[:, 1], -y[:, 0]
+      skew[:, 1, 0], skew[:, 2, 0], skew[:, 2, 1] = y[:, 2], -y[:, 1], y[:, 0]
+      jacobians = np.einsum('nij,njk->nik', projectors, np.concatenate([-skew, np.broadcast_to(np.eye(3), skew.shape)], axis=2))
+      hessian = np.einsum('nji,njk->ik', jacobians, jacobians) + 1e-9 * np.eye(6)
+      gradient = np.einsum('nji,nj->i', jacobians, r)
+      step = -np.linalg.solve(hessian, gradient)
+      rotation = rotationFromVector(step[0:3])
+      update = np.eye(4)
+      update[0:3, 0:3] = rotation
+      update[0:3, 3] = step[3:6]
+      rasToFrame = update @ rasToFrame
+      # Tighten the outlier cutoff once the pose is roughly right
+      cutoff = max(3 * np.median(nearestDistances[inliers]), self.inlierDistance)
+      if np.linalg.norm(step) < 1e-6:
+        break
+    framePoints = points @ rasToFrame[0:3, 0:3].T + rasToFrame[0:3, 3]
+    distances = np.linalg.norm(self.pointToLineResiduals(framePoints), axis=2)
+    nearest = np.argmin(distances, axis=1)
+    nearestDistances = distances[np.arange(len(points)), nearest]
+    inliers = nearestDistances < self.inlierDistance
+    residual = float(np.sqrt(np.mean(nearestDistances[inliers] ** 2))) if np.any(inliers) else np.inf
+    return rasToFrame, residual, inliers, nearest
+
+  @staticmethod
+  def getSliceNormal(ijkToRAS):
+    # Third column of the direction matrix, with its largest component positive as the slice order does not matter
+    normal = np.asarray(ijkToRAS, dtype=float)[0:3, 2]
+    normal = normal / np.linalg.norm(normal)
+    return normal if normal[np.argmax(np.abs(normal))] > 0 else -normal
+
+  def findLineInliers(self, points, sliceNormal=(0.0, 0.0, 1.0), hypotheses=2000, angleTolerance=15.0, seed=0):
+    """Returns a boolean array of the points that lie on one of up to len(zFrameFiducials) straight lines.
+
+    The lines are found by RANSAC: every hypothesis is the line through two random points of different slices, and
+    the distances of all points to all hypotheses are computed at once. Only hypotheses at the angle of one of the
+    fiducials to the frame axis, measured against sliceNormal (RAS), are kept, as the frame is placed with its axis
+    roughly along the slice normal. The line with the most inliers is taken and refitted to them, its points are
+    removed and the next line is taken from the same hypotheses.
+    """
+    if len(points) < 2:
+      return np.zeros(len(points), dtype=bool)
+    rng = np.random.default_rng(seed)
+    first = rng.integers(0, len(points), hypotheses)
+    second = rng.integers(0, len(points), hypotheses)
+    directions = points[second] - points[first]
+    sliceNormal = np.asarray(sliceNormal, dtype=float)
+    # Points of nearby slices give a poorly defined direction
+    valid = np.abs(directions @ sliceNormal) > 5.0
+    directions /= np.maximum(np.linalg.norm(directions, axis=1), 1e-9)[:, None]
+    angles = np.degrees(np.arccos(np.clip(np.abs(directions @ sliceNormal), 0, 1)))
+    fiducialAngles = np.degrees(np.arccos(np.clip(np.abs(self.lineDirections[:, 2]), 0, 1)))
+    valid &= np.any(np.abs(angles[:, None] - fiducialAngles[None, :]) < angleTolerance, axis=1)
+    offsets = points[None, :, :] - points[first][:, None, :]
+    inliers = np.linalg.norm(np.cross(offsets, directions[:, None, :]), axis=2) < self.inlierDistance
+
+    onLine = np.zeros(len(points), dtype=bool)
+    for line in range(len(self.lineStarts)):
+      counts = np.where(valid, np.count_nonzero(inliers & ~onLine[None, :], axis=1), 0)
+      best = int(np.argmax(counts))
+      if counts[best] < 4:
+        break
+      linePoints = inliers[best] & ~onLine
+      # Least squares line through the inliers of the hypothesis
+      center = points[linePoints].mean(axis=0)
+      direction = np.linalg.svd(points[linePoints] - center)[2][0]
+      linePoints = ~onLine & (np.linalg.norm(np.cross(points - center, direction), axis=1) < self.inlierDistance)
+      onLine |= linePoints
+      # Hypotheses through points already taken would find the same line again
+      valid &= ~(onLine[first] | onLine[second])
+    return onLine
+
+  def getInitialPoses(self, points, sliceNormal=(0.0, 0.0, 1.0)):
+    # The frame is placed with its axis roughly along the slice normal (RAS); its rotation about the normal is unknown
+    centroid = points.mean(axis=0)
+    sliceNormal = np.asarray(sliceNormal, dtype=float)
+    # Smallest rotation that turns the frame axis onto the normal
+    axis = np.cross([0.0, 0.0, 1.0], sliceNormal)
+    toNormal = rotationFromVector(axis / max(np.linalg.norm(axis), 1e-12) * np.arctan2(np.linalg.norm(axis), sliceNormal[2]))
+    initialPoses = []
+    for quarterTurns in range(4):
+      angle = quarterTurns * np.pi / 2
+      rotation = toNormal @ np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+      for offset in [-10.0, 0.0, 10.0]:
+        frameToRAS = np.eye(4)
+        frameToRAS[0:3, 0:3] = rotation
+        frameToRAS[0:3, 3] = centroid + offset * sliceNormal - rotation @ self.frameCenter
+        initialPoses.append(frameToRAS)
+    return initialPoses
+
+  def solve(self, maskArray, ijkToRAS, sliceRange=None, initialPoses=None, fitLines=False):
+    """Returns a dict with the zFrame to RAS 'pose', 'residual' (mm), 'inliers', 'points' and 'fiducialCounts', or None.
+
+    With fitLines, centroids that are not on a straight line found by findLineInliers are left out before the pose
+    is solved, and 'points' is the number of centroids found before that.
+    """
+    solutions = self.solveAll(maskArray, ijkToRAS, sliceRange, initialPoses, fitLines)
+    return solutions[0] if solutions else None
+
+  def solveAll(self, maskArray, ijkToRAS, sliceRange=None, initialPoses=None, fitLines=False):
+    # The solution from each initial pose, best first: the pose that explains the most centroids, then the smallest residual
+    points = self.findCentroids(maskArray, ijkToRAS, sliceRange)
+    centroidCount = len(points)
+    sliceNormal = self.getSliceNormal(ijkToRAS)
+    if fitLines:
+      points = points[self.findLineInliers(points, sliceNormal)]
+    if len(points) < 6:
+      return []
+    if initialPoses is None:
+      initialPoses = self.getInitialPoses(points, sliceNormal)
+    solutions = []
+    for frameToRAS in initialPoses:
+      rasToFrame, residual, inliers, nearest = self.refine(points, np.linalg.inv(frameToRAS))
+      if not np.isfinite(residual):
+        continue
+      solutions.append({'pose': np.linalg.inv(rasToFrame), 'residual': residual, 'inliers': int(np.count_nonzero(inliers)), 'points': centroidCount,
+                        'fiducialCounts': np.bincount(nearest[inliers], minlength=len(self.lineStarts)).tolist()})
+    return sorted(solutions, key=lambda solution: (-solution['inliers'], solution['residual']))
+
+  def predictMissingFiducials(self, mask, ijkToRAS, slabSlices=3, maximumMissing=2):
+    """Draws the fiducials missing from the mask (KJI) into it where the detected fiducials put them.
+
+    The pose is solved from the detected fiducials in the slab around the center of the mask. A frame with a missing
+    fiducial can be symmetric, so of the poses that explain about as many fiducial points as the best one, the one
+    closest to the frame axes being aligned with the RAS axes is used, as the frame is mounted that way. Fiducials
+    with less than a fifth of their points in the slab on the mask are missing and are drawn in the slab.
+    Returns "accepted" if no fiducial is missing, "success" if up to maximumMissing were drawn, otherwise "anomaly",
+    and the zFrame to RAS pose the fiducials were predicted from (None if there is none).
+    """
+    if not np.any(mask):
+      return "anomaly", None
+    centerOfMassSlice = int(ndimage.center_of_mass(mask)[0])
+    firstSlice, lastSlice = centerOfMassSlice - slabSlices, centerOfMassSlice + slabSlices
+    solutions = self.solveAll(mask, ijkToRAS, (firstSlice, lastSlice))
+    if not solutions:
+      return "anomaly", None
+
+    def rotationAngle(solution):
+      return np.arccos(min(1.0, max(-1.0, (np.trace(solution['pose'][0:3, 0:3]) - 1) / 2)))
+
+    pose = min([solution for solution in solutions if solution['inliers'] >= 0.95 * solutions[0]['inliers']], key=rotationAngle)['pose']
+
+    # Points about a voxel apart along each fiducial at that pose, in KJI array coordinates
+    ijkToRAS = np.asarray(ijkToRAS, dtype=float)
+    samples = np.linspace(0.0, 1.0, int(self.lineLengths.max() / np.linalg.norm(ijkToRAS[0:3, 0:3], axis=0).min()) + 2)
+    points = self.lineStarts[:, None, :] + samples[None, :, None] * (self.lineEnds - self.lineStarts)[:, None, :]
+    kji = np.rint(np.concatenate([points, np.ones(points.shape[:2] + (1,))], axis=2) @ (np.linalg.inv(ijkToRAS) @ pose).T)[..., 2::-1].astype(int)
+    inSlab = (np.all((kji >= 0) & (kji < mask.shape), axis=2) & (kji[..., 0] >= firstSlice) & (kji[..., 0] <= lastSlice))
+    onMask = np.zeros(inSlab.shape, dtype=bool)
+    onMask[inSlab] = mask[tuple(kji[inSlab].T)] > 0
+    # Fiducials that do not cross the slab cannot be checked
+    coverage = np.count_nonzero(onMask, axis=1) / np.maximum(np.count_nonzero(inSlab, axis=1), 1)
+    missing = np.flatnonzero((coverage < 0.2) & np.any(inSlab, axis=1))
+    if len(missing) == 0:
+      print(f'All {len(self.lineStarts)} fiducials detected')
+      return "accepted", pose
+    if len(missing) > maximumMissing:
+      print(f'{len(missing)} fiducials missing; too many to repair')
+      return "anomaly", pose
+
+    print(f'Drawing missing fiducials {", ".join(str(index + 1) for index in missing)} predicted from the frame geometry')
+    offsets = np.stack(np.meshgrid([-1, 0, 1], [-1, 0, 1], [-1, 0, 1], indexing='ij'), axis=-1).reshape(-1, 3)
+    voxels = (kji[missing][inSlab[missing]][:, None, :] + offsets[None, :, :]).reshape(-1, 3)
+    voxels = voxels[np.all((voxels >= 0) & (voxels < mask.shape), axis=1)]
+    mask[tuple(voxels.T)] = 1
+    return "success", pose
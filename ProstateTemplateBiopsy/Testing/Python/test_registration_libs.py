@@ -0,0 +1,103 @@
+"""Registration library tests on rendered zFrame phantoms; they run with pytest outside of Slicer.
+
+  python -m pytest ProstateTemplateBiopsy/Testing/Python
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+
+from ProstateTemplateBiopsyLib.RegistrationHistory import RegistrationHistory
+from ProstateTemplateBiopsyLib.RegistrationRegression import getTemplateConfigPath
+from ProstateTemplateBiopsyLib.ThresholdSelection import selectThresholdPercentage
+from ProstateTemplateBiopsyLib.ZFramePhantom import ZFramePhantom
+from ProstateTemplateBiopsyLib.ZFramePoseSolver import ZFramePoseSolver
+
+TEMPLATES = ['z001', 'z002', 'z003', 'z004', 'z005']
+# Defaults of RegistrationRegression
+TRANSLATION_TOLERANCE = 1.0
+ROTATION_TOLERANCE = 1.0
+# Defaults of RegistrationParameters and Defaults.ini
+THRESHOLD_PERCENTAGE = 0.08
+MINIMUM_THRESHOLD = 0.0
+MAXIMUM_THRESHOLD = 0.2
+MINIMUM_SIZE = 300
+MAXIMUM_SIZE = 2000
+
+
+def renderPhantom(zframeConfig, seed, **options):
+  phantom = ZFramePhantom(getTemplateConfigPath(zframeConfig))
+  zFrameToRAS = phantom.randomPose(np.random.default_rng(seed))
+  volumeArray, ijkToRAS = phantom.render(zFrameToRAS, seed=seed, **options)
+  return phantom, zFrameToRAS, volumeArray, ijkToRAS
+
+
+def createMask(volumeArray, thresholdPercentage=THRESHOLD_PERCENTAGE):
+  # Same threshold and island size filter as the registration
+  low, high = float(volumeArray.min()), float(volumeArray.max())
+  labels, count = ndimage.label(volumeArray >= int((high - low) * thresholdPercentage + low))
+  sizes = np.bincount(labels.ravel())
+  keep = (sizes >= MINIMUM_SIZE) & (sizes < MAXIMUM_SIZE)
+  keep[0] = False
+  return keep[labels].astype(np.uint8)
+
+
+def assertPoseError(estimatedPose, truePose):
+  translationError, rotationError = ZFramePhantom.poseError(estimatedPose, truePose)
+  assert translationError < TRANSLATION_TOLERANCE
+  assert rotationError < ROTATION_TOLERANCE
+
+
+@pytest.mark.parametrize('zframeConfig', TEMPLATES)
+@pytest.mark.parametrize('fitLines', [False, True])
+def test_solve(zframeConfig, fitLines):
+  phantom, zFrameToRAS, volumeArray, ijkToRAS = renderPhantom(zframeConfig, seed=1)
+  mask = createMask(volumeArray)
+  centerOfMassSlice = int(ndimage.center_of_mass(mask)[0])
+  sliceRange = None if fitLines else (centerOfMassSlice - 3, centerOfMassSlice + 3)
+  solution = ZFramePoseSolver(phantom.fiducials).solve(mask, ijkToRAS, sliceRange, fitLines=fitLines)
+  assert solution is not None
+  assertPoseError(solution['pose'], zFrameToRAS)
+
+
+@pytest.mark.parametrize('zframeConfig', TEMPLATES)
+def test_predictMissingFiducials(zframeConfig):
+  phantom, zFrameToRAS, volumeArray, ijkToRAS = renderPhantom(zframeConfig, seed=2, missingFiducials=(1,))
+  mask = createMask(volumeArray)
+  solver = ZFramePoseSolver(phantom.fiducials)
+  result, pose = solver.predictMissingFiducials(mask, ijkToRAS)
+  assert result == 'success'
+  assertPoseError(pose, zFrameToRAS)
+  # The drawn fiducial completes the frame
+  result, pose = solver.predictMissingFiducials(mask, ijkToRAS)
+  assert result == 'accepted'
+  assertPoseError(pose, zFrameToRAS)
+
+
+@pytest.mark.parametrize('zframeConfig', TEMPLATES)
+def test_selectThresholdPercentage(zframeConfig):
+  phantom, zFrameToRAS, volumeArray, ijkToRAS = renderPhantom(zframeConfig, seed=3, borderClutter=2)
+  threshold, details = selectThresholdPercentage(volumeArray, len(phantom.fiducials), MINIMUM_SIZE, MAXIMUM_SIZE,
+                                                 thresholdRange=(MINIMUM_THRESHOLD, MAXIMUM_THRESHOLD))
+  assert MINIMUM_THRESHOLD <= threshold <= MAXIMUM_THRESHOLD
+  assert details['method'] in ['multiOtsu', 'otsu', 'volume']
+  # The phantom fiducials are masked at the selected threshold
+  assert np.count_nonzero(createMask(volumeArray, threshold)) >= len(phantom.fiducials) * MINIMUM_SIZE
+
+
+def test_bestThreshold(tmp_path):
+  history = RegistrationHistory(str(tmp_path / 'registration-history.db'))
+  protocol = {'Manufacturer': 'SIEMENS', 'SequenceName': '*tse2d1_7'}
+  assert history.bestThreshold('z001', protocol) is None
+  history.record('z001', protocol, 0.08, MINIMUM_SIZE, MAXIMUM_SIZE, 1)
+  history.record('z001', protocol, 0.12, MINIMUM_SIZE, MAXIMUM_SIZE, 3)
+  history.record('z001', protocol, 0.12, MINIMUM_SIZE, MAXIMUM_SIZE, 2)
+  assert history.bestThreshold('z001', protocol) == pytest.approx(0.12)
+  # Another database connection reads the same records
+  assert RegistrationHistory(history.databasePath).bestThreshold('z001', dict(protocol)) == pytest.approx(0.12)
+  assert history.bestThreshold('z002', protocol) is None
+  assert history.bestThreshold('z001', {'Manufacturer': 'GE', 'SequenceName': '*tse2d1_7'}) is None